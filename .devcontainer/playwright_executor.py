@@ -1,171 +1,332 @@
 import asyncio
-from playwright.async_api import async_playwright
 import argparse
+from collections import OrderedDict
 from datetime import datetime
-import os
+import hashlib
+import sys
 import json
+import uuid
 from pathlib import Path
-import tempfile
 import base64
 
-async def execute_playwright_script(url: str, script: str, output_dir: str = ".screenshots", capture_logs: bool = False):
+# Scripts run on the backend's browser pool, the same one the performance
+# audit uses. Only the images that copy the whole repository (Dockerfile,
+# DockerfileAppBuilderCloud) have backend/ next to this file; elsewhere every
+# run returns a setup error instead of the script failing at import.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+try:
+    from browser_audit import BrowserPool, BrowserUnavailable
+except ImportError as e:
+    BrowserPool = None
+    BROWSER_POOL_IMPORT_ERROR = f"backend browser pool not available: {str(e)}"
+
+    class BrowserUnavailable(Exception):
+        pass
+
+AUTOMATION_OUTPUT_DIR = 'automation_output'
+SCREENSHOT_SUFFIXES = ('.png', '.jpg', '.jpeg')
+DEFAULT_SCRIPT_TIMEOUT = 60
+NAVIGATION_TIMEOUT_MS = 30000
+COMPILED_SCRIPT_CACHE_SIZE = 256
+# Seconds a script waits for a free browser context
+DEFAULT_ACQUIRE_TIMEOUT = 60
+# Contexts a browser serves before it is relaunched
+RECYCLE_BROWSER_AFTER = 500
+
+_compiled_scripts = OrderedDict()
+
+def compile_script(script: str):
     """
-    Executes a Playwright script and captures outputs.
+    Wraps a script body in `async def run_test(page, output_dir)` and compiles it.
+    Returns (source, code). Compiled code is cached by source, so repeated
+    scripts skip the compile step.
+    """
+    # Decode script if base64 encoded
+    if script.startswith('base64:'):
+        script = base64.b64decode(script[7:]).decode('utf-8')
+
+    # Add proper indentation to the script
+    indented_script = ""
+    for line in script.split('\n'):
+        if line.strip():
+            indented_script += "    " + line + "\n"
+        else:
+            indented_script += "\n"
+
+    test_script = f"""async def run_test(page, output_dir):
+{indented_script}"""
+
+    key = hashlib.sha256(test_script.encode('utf-8')).hexdigest()
+    code = _compiled_scripts.get(key)
+    if code is None:
+        code = compile(test_script, f"<playwright script {key[:12]}>", "exec")
+        _compiled_scripts[key] = code
+        while len(_compiled_scripts) > COMPILED_SCRIPT_CACHE_SIZE:
+            _compiled_scripts.popitem(last=False)
+    _compiled_scripts.move_to_end(key)
+    return test_script, code
+
+class PlaywrightExecutor:
     """
-    # Create output directory
-    
-    automation_output_dir = 'automation_output'
-
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(automation_output_dir, exist_ok=True)
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    run_dir = Path(automation_output_dir) / timestamp
-    run_dir.mkdir(exist_ok=True)
-
-    screenshot_dir = Path(output_dir)
-    screenshot_dir.mkdir(exist_ok=True)
-    
-    result = {
-        "status": "success",
-        "data": {
-            "screenshots": [],
-            "console_logs": [],
-            "error": None,
-            "output": None
+    Long-lived script runner on top of a warm BrowserPool. Up to `contexts`
+    scripts run concurrently, each in its own context and output directory
+    and bounded by a timeout; a script waits at most `acquire_timeout` seconds
+    for a free context. Pass `on_event` to run() to receive console messages
+    and screenshots as they happen.
+    """
+    def __init__(self, contexts: int = 4, output_dir: str = ".screenshots",
+                 timeout: float = DEFAULT_SCRIPT_TIMEOUT, acquire_timeout: float = DEFAULT_ACQUIRE_TIMEOUT):
+        self.pool = None
+        if BrowserPool is not None:
+            self.pool = BrowserPool(contexts, RECYCLE_BROWSER_AFTER, acquire_timeout=acquire_timeout)
+        self.output_dir = output_dir
+        self.timeout = timeout
+
+    async def start(self):
+        if self.pool is not None:
+            await self.pool.start()
+
+    async def stop(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def run(self, url: str, script: str, output_dir: str = None, capture_logs: bool = False,
+                  timeout: float = None, on_event=None):
+        """
+        Executes a Playwright script in a pooled context and captures outputs.
+        Returns the same result shape as execute_playwright_script.
+        """
+        timeout = timeout or self.timeout
+        screenshot_dir = Path(output_dir or self.output_dir)
+        screenshot_dir.mkdir(parents=True, exist_ok=True)
+
+        # Timestamp plus a short id: concurrent runs started in the same
+        # second must not share a directory
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        run_dir = Path(AUTOMATION_OUTPUT_DIR) / f"{timestamp}_{uuid.uuid4().hex[:8]}"
+        run_dir.mkdir(parents=True, exist_ok=True)
+
+        def emit(event_type: str, **data):
+            if on_event is not None:
+                on_event({"type": event_type, **data})
+
+        result = {
+            "status": "success",
+            "data": {
+                "screenshots": [],
+                "console_logs": [],
+                "error": None,
+                "output": None
+            }
         }
-    }
 
-    try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context()
+        try:
+            if self.pool is None:
+                raise BrowserUnavailable(BROWSER_POOL_IMPORT_ERROR)
+            context, release = await self.pool.new_context()
+        except BrowserUnavailable as e:
+            result["status"] = "error"
+            result["data"]["error"] = f"Setup error: {str(e)}"
+            emit("result", result=result)
+            return result
+
+        console_logs = []
+        try:
             page = await context.new_page()
-            
+
             # Store console logs if requested
-            console_logs = []
             if capture_logs:
-                page.on("console", lambda msg: console_logs.append(f"{msg.type}: {msg.text}"))
-            
+                def on_console(msg):
+                    console_logs.append(f"{msg.type}: {msg.text}")
+                    emit("console", level=msg.type, text=msg.text)
+                page.on("console", on_console)
+
+            # Report screenshots the script takes as soon as they are written
+            take_screenshot = page.screenshot
+            async def screenshot(*args, **kwargs):
+                data = await take_screenshot(*args, **kwargs)
+                if kwargs.get("path"):
+                    emit("screenshot", path=str(kwargs["path"]))
+                return data
+            page.screenshot = screenshot
+
+            async def save_screenshot(name: str):
+                path = run_dir / name
+                await page.screenshot(path=str(path), full_page=True, type="jpeg", quality=50)
+                result["data"]["screenshots"].append(str(path))
+                # Save additional screenshot to .screenshot folder
+                await take_screenshot(path=str(screenshot_dir / "screenshot.jpeg"), full_page=True,
+                                      type="jpeg", quality=50)
+
             try:
                 # Navigate to URL first
-                await page.goto(url, wait_until="networkidle", timeout=30000)
-                
-                # Decode script if base64 encoded
-                if script.startswith('base64:'):
-                    script = base64.b64decode(script[7:]).decode('utf-8')
-                
-                # Add proper indentation to the script
-                indented_script = ""
-                for line in script.split('\n'):
-                    if line.strip():
-                        indented_script += "    " + line + "\n"
-                    else:
-                        indented_script += "\n"
-                
-                # Create test script with proper indentation
-                test_script = f"""async def run_test(page, output_dir):
-{indented_script}"""
+                await page.goto(url, wait_until="networkidle", timeout=NAVIGATION_TIMEOUT_MS)
+
+                test_script, code = compile_script(script)
 
                 # Write the test script to a file for debugging
-                test_script_path = run_dir / "test_script.py"
-                with open(test_script_path, "w") as f:
+                with open(run_dir / "test_script.py", "w") as f:
                     f.write(test_script)
 
-                # Save script to temp file for execution
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-                    f.write(test_script)
-                    script_path = f.name
-
-                # Import and execute the script
-                import importlib.util
-                spec = importlib.util.spec_from_file_location("dynamic_script", script_path)
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-                
-                # Run the test
-                output = await module.run_test(page, str(run_dir))
+                # Each run gets its own globals, so scripts can't leak state
+                namespace = {"__name__": "dynamic_script"}
+                exec(code, namespace)
+                output = await asyncio.wait_for(namespace["run_test"](page, str(run_dir)), timeout)
                 if output is not None:
                     result["data"]["output"] = output
-                
+
                 # Take a screenshot if none were taken
-                screenshot_files = list(run_dir.glob('*.{png,jpg,jpeg}'))
+                screenshot_files = sorted(f for f in run_dir.iterdir() if f.suffix.lower() in SCREENSHOT_SUFFIXES)
                 if not screenshot_files:
-                    final_screenshot = run_dir / f"final_{timestamp}.png"
-                    await page.screenshot(
-                        path=str(final_screenshot),
-                        full_page=True,
-                        type="jpeg",
-                        quality = 50
-                    )
-                    result["data"]["screenshots"].append(str(final_screenshot))
-
-                    # Save additional screenshot to .screenshot folder
-                    await page.screenshot(
-                        path=str(screenshot_dir / "screenshot.jpeg"),
-                        full_page=True,
-                        type="jpeg",
-                        quality = 50
-                    )
+                    await save_screenshot(f"final_{timestamp}.jpeg")
                 else:
                     result["data"]["screenshots"].extend(str(f) for f in screenshot_files)
 
-                # Save console logs if captured
-                if capture_logs and console_logs:
-                    log_path = run_dir / f"console_{timestamp}.log"
-                    with open(log_path, "w", encoding="utf-8") as f:
-                        f.write("\n".join(console_logs))
-                    result["data"]["console_logs"].append(str(log_path))
-
+            except asyncio.TimeoutError:
+                result["status"] = "error"
+                result["data"]["error"] = f"Script error: timed out after {timeout}s"
+                await self._error_screenshot(save_screenshot, timestamp)
             except Exception as e:
                 result["status"] = "error"
                 result["data"]["error"] = f"Script error: {str(e)}"
-                error_screenshot = run_dir / f"error_{timestamp}.png"
-                await page.screenshot(
-                        path=str(error_screenshot),
-                        full_page=True,
-                        type="jpeg",
-                        quality = 50
-                    )
-                result["data"]["screenshots"].append(str(error_screenshot))
+                await self._error_screenshot(save_screenshot, timestamp)
+        except Exception as e:
+            result["status"] = "error"
+            result["data"]["error"] = f"Setup error: {str(e)}"
+        finally:
+            await release()
 
-                # Save additional screenshot to .screenshot folder
-                await page.screenshot(
-                        path=str(screenshot_dir / "screenshot.jpeg"),
-                        full_page=True,
-                        type="jpeg",
-                        quality = 50
-                    )
-            
-            finally:
-                if os.path.exists(script_path):
-                    os.unlink(script_path)
-                await browser.close()
+        # Save console logs if captured
+        if capture_logs and console_logs:
+            log_path = run_dir / f"console_{timestamp}.log"
+            with open(log_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(console_logs))
+            result["data"]["console_logs"].append(str(log_path))
+
+        emit("result", result=result)
+        return result
 
+    async def _error_screenshot(self, save_screenshot, timestamp: str):
+        # The page may be hung or closed; a missing error screenshot is not
+        # worth failing over
+        try:
+            await asyncio.wait_for(save_screenshot(f"error_{timestamp}.jpeg"), 10)
+        except Exception:
+            pass
+
+async def execute_playwright_script(url: str, script: str, output_dir: str = ".screenshots", capture_logs: bool = False,
+                                    timeout: float = DEFAULT_SCRIPT_TIMEOUT, executor: PlaywrightExecutor = None):
+    """
+    Executes a Playwright script and captures outputs.
+    Pass a started `executor` to reuse its warm browsers; otherwise a
+    single-context executor is started and stopped for this call.
+    """
+    if executor is not None:
+        return await executor.run(url, script, output_dir, capture_logs, timeout)
+
+    try:
+        async with PlaywrightExecutor(contexts=1, output_dir=output_dir, timeout=timeout) as one_shot:
+            return await one_shot.run(url, script, output_dir, capture_logs, timeout)
     except Exception as e:
-        result["status"] = "error"
-        result["data"]["error"] = f"Setup error: {str(e)}"
+        return {
+            "status": "error",
+            "data": {
+                "screenshots": [],
+                "console_logs": [],
+                "error": f"Setup error: {str(e)}",
+                "output": None
+            }
+        }
 
-    return result
+async def serve(contexts: int, output_dir: str, timeout: float, acquire_timeout: float = DEFAULT_ACQUIRE_TIMEOUT):
+    """
+    Runs scripts read from stdin, one JSON request per line:
+      {"id": "...", "url": "...", "script": "...", "capture_logs": true, "timeout": 30}
+    and writes one JSON event per line to stdout, each tagged with the request
+    id: "console" and "screenshot" events while the script runs, then "result".
+    Requests run concurrently; the service exits at end of input once all
+    running scripts have finished.
+    """
+    def write(event: dict):
+        sys.stdout.write(json.dumps(event, default=str) + "\n")
+        sys.stdout.flush()
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    async with PlaywrightExecutor(contexts, output_dir, timeout, acquire_timeout) as executor:
+        write({"type": "ready", "slots": contexts})
+
+        async def handle(request: dict):
+            request_id = request.get("id") or uuid.uuid4().hex
+            try:
+                await executor.run(
+                    request["url"], request["script"], request.get("output"),
+                    bool(request.get("capture_logs")), request.get("timeout"),
+                    on_event=lambda event: write({"id": request_id, **event})
+                )
+            except Exception as e:
+                write({"id": request_id, "type": "result",
+                       "result": {"status": "error", "data": {"error": f"Setup error: {str(e)}"}}})
+
+        running = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                write({"type": "error", "error": f"Invalid request: {str(e)}"})
+                continue
+            task = asyncio.ensure_future(handle(request))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        await asyncio.gather(*running)
 
 def main():
     parser = argparse.ArgumentParser(description="Execute Playwright automation script")
-    parser.add_argument("url", help="URL to automate")
-    parser.add_argument("--script", required=True, help="Playwright script to execute (plain text or base64 encoded with 'base64:' prefix)")
+    parser.add_argument("url", nargs="?", help="URL to automate")
+    parser.add_argument("--script", help="Playwright script to execute (plain text or base64 encoded with 'base64:' prefix)")
     parser.add_argument("--output", "-o", default=".screenshots",
                         help="Output directory for screenshots and logs")
     parser.add_argument("--capture-logs", action="store_true", help="Capture console logs")
-    
+    parser.add_argument("--timeout", type=float, default=DEFAULT_SCRIPT_TIMEOUT,
+                        help="Seconds a script may run before it is stopped")
+    parser.add_argument("--serve", action="store_true",
+                        help="Keep browsers warm and run JSON-line requests from stdin")
+    parser.add_argument("--contexts", type=int, default=4,
+                        help="Concurrent scripts in --serve mode")
+    parser.add_argument("--acquire-timeout", type=float, default=DEFAULT_ACQUIRE_TIMEOUT,
+                        help="Seconds a script waits for a free browser context in --serve mode")
+
     args = parser.parse_args()
-    
+
+    if args.serve:
+        asyncio.run(serve(args.contexts, args.output, args.timeout, args.acquire_timeout))
+        return
+    if not args.url or not args.script:
+        parser.error("url and --script are required unless --serve is given")
+
     result = asyncio.run(execute_playwright_script(
         args.url,
         args.script,
         args.output,
-        args.capture_logs
+        args.capture_logs,
+        args.timeout
     ))
-    
+
     print(json.dumps(result))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from bson import Binary
+import asyncio
+import hashlib
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+# Content-addressed store for generated file bodies. Each distinct body is
+# written once, keyed by its sha256; records in generated_code, test_results
+# and deployment_info hold {name, file_type, sha256, size} references instead
+# of full copies. Bodies above `compress_min_bytes` are zlib-compressed, and
+# anything still above `inline_max_bytes` after compression goes to GridFS so
+# artifact documents stay small.
+#
+# Artifacts are shared between records, so they can't expire with them.
+# Instead a sweep every `gc_interval` seconds deletes artifacts (and their
+# GridFS files) that no record in `referencing` points to and that haven't
+# been stored or reused for `gc_grace` seconds; the grace period covers
+# records still waiting in the write-behind buffer.
+class ArtifactStore:
+    def __init__(self, collection, bucket=None, inline_max_bytes: int = 1024 * 1024,
+                 compress_min_bytes: int = 1024, known_hashes: int = 4096, referencing=(),
+                 gc_interval: float = 3600, gc_grace: float = 86400):
+        self.collection = collection
+        self.bucket = bucket
+        self.inline_max_bytes = inline_max_bytes
+        self.compress_min_bytes = compress_min_bytes
+        self.known_hashes = known_hashes
+        self.referencing = list(referencing)
+        self.gc_interval = gc_interval
+        self.gc_grace = gc_grace
+        # Hashes this process has stored or seen recently -> when, so repeats
+        # skip the round trip. Entries are trusted for a fraction of the grace
+        # period, so a sweep can't delete an artifact a new record relies on.
+        self._known = OrderedDict()
+        self._known_ttl = gc_grace / 4
+        self._task = None
+        self._stats = {"writes": 0, "dedup_hits": 0, "gridfs_writes": 0,
+                       "bytes_in": 0, "bytes_stored": 0, "reads": 0,
+                       "gc_runs": 0, "gc_deleted": 0, "gc_errors": 0}
+
+    async def put(self, content: str) -> str:
+        digest = content_hash(content)
+        now = datetime.utcnow()
+        seen = self._known.get(digest)
+        if seen is not None and (now - seen).total_seconds() < self._known_ttl:
+            self._known.move_to_end(digest)
+            self._stats["dedup_hits"] += 1
+            return digest
+
+        # Marks the artifact as used again, which keeps it out of the sweep
+        reused = await self.collection.update_one({"_id": digest}, {"$set": {"last_used_at": now}})
+        if reused.matched_count:
+            self._stats["dedup_hits"] += 1
+            self._remember(digest, now)
+            return digest
+
+        raw = content.encode("utf-8")
+        data, encoding = raw, "identity"
+        if len(raw) >= self.compress_min_bytes:
+            compressed = await asyncio.to_thread(zlib.compress, raw, 6)
+            if len(compressed) < len(raw):
+                data, encoding = compressed, "zlib"
+
+        doc = {"_id": digest, "encoding": encoding, "size": len(raw),
+               "stored_size": len(data), "created_at": now, "last_used_at": now}
+        gridfs_id = None
+        if len(data) > self.inline_max_bytes and self.bucket is not None:
+            gridfs_id = await self.bucket.upload_from_stream(digest, data, metadata={"encoding": encoding})
+            doc["gridfs_id"] = gridfs_id
+        else:
+            doc["data"] = Binary(data)
+
+        # $setOnInsert keeps the first writer's copy when two requests race
+        insert = {key: value for key, value in doc.items() if key != "last_used_at"}
+        result = await self.collection.update_one({"_id": digest},
+                                                  {"$setOnInsert": insert, "$set": {"last_used_at": now}},
+                                                  upsert=True)
+        if result.upserted_id is None:
+            self._stats["dedup_hits"] += 1
+            if gridfs_id is not None:
+                await self.bucket.delete(gridfs_id)
+        else:
+            self._stats["writes"] += 1
+            self._stats["gridfs_writes"] += gridfs_id is not None
+            self._stats["bytes_in"] += len(raw)
+            self._stats["bytes_stored"] += len(data)
+        self._remember(digest, now)
+        return digest
+
+    async def get(self, digest: str) -> str:
+        doc = await self.collection.find_one({"_id": digest})
+        if doc is None:
+            raise KeyError(digest)
+        self._stats["reads"] += 1
+        if "gridfs_id" in doc:
+            stream = await self.bucket.open_download_stream(doc["gridfs_id"])
+            data = await stream.read()
+        else:
+            data = bytes(doc["data"])
+        if doc["encoding"] == "zlib":
+            data = await asyncio.to_thread(zlib.decompress, data)
+        return data.decode("utf-8")
+
+    async def put_files(self, files: list) -> list:
+        # files: [{name, content, file_type}] -> [{name, file_type, sha256, size}]
+        digests = await asyncio.gather(*(self.put(file["content"]) for file in files))
+        return [
+            {"name": file["name"], "file_type": file["file_type"], "sha256": digest,
+             "size": len(file["content"].encode("utf-8"))}
+            for file, digest in zip(files, digests)
+        ]
+
+    async def get_files(self, refs: list) -> list:
+        contents = await asyncio.gather(*(self.get(ref["sha256"]) for ref in refs))
+        return [
+            {"name": ref["name"], "file_type": ref["file_type"], "content": content}
+            for ref, content in zip(refs, contents)
+        ]
+
+    async def collect_garbage(self) -> int:
+        # Deletes unreferenced artifacts past the grace period; returns how many
+        cutoff = datetime.utcnow() - timedelta(seconds=self.gc_grace)
+        stale = {"$or": [{"last_used_at": {"$lt": cutoff}},
+                         {"last_used_at": {"$exists": False}, "created_at": {"$lt": cutoff}}]}
+
+        deleted = 0
+        async for doc in self.collection.find(stale, {"_id": 1}):
+            if await self._is_referenced(doc["_id"]):
+                continue
+            # Re-checked on delete, in case a put() reused it meanwhile
+            removed = await self.collection.find_one_and_delete({"_id": doc["_id"], **stale},
+                                                                {"gridfs_id": 1})
+            if removed is None:
+                continue
+            if "gridfs_id" in removed and self.bucket is not None:
+                await self.bucket.delete(removed["gridfs_id"])
+            self._known.pop(doc["_id"], None)
+            deleted += 1
+        self._stats["gc_runs"] += 1
+        self._stats["gc_deleted"] += deleted
+        if deleted:
+            logger.info(f"Deleted {deleted} unreferenced artifacts")
+        return deleted
+
+    async def _is_referenced(self, digest: str) -> bool:
+        # One indexed lookup per stale candidate (files.sha256 is indexed in
+        # each referencing collection), so memory doesn't grow with the
+        # number of records
+        for collection in self.referencing:
+            if await collection.find_one({"files.sha256": digest}, {"_id": 1}) is not None:
+                return True
+        return False
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            try:
+                await self.collect_garbage()
+            except Exception as e:
+                self._stats["gc_errors"] += 1
+                logger.warning(f"Artifact garbage collection failed: {str(e)}")
+
+    def _remember(self, digest: str, now: datetime):
+        self._known[digest] = now
+        self._known.move_to_end(digest)
+        while len(self._known) > self.known_hashes:
+            self._known.popitem(last=False)
+
+    def stats(self) -> dict:
+        ratio = self._stats["bytes_stored"] / self._stats["bytes_in"] if self._stats["bytes_in"] else 0.0
+        return {"known_hashes": len(self._known), "compression_ratio": round(ratio, 4), **self._stats}
@@ -0,0 +1,316 @@
+from urllib.parse import urlparse
+import asyncio
+import logging
+import mimetypes
+import os
+import posixpath
+import time
+
+logger = logging.getLogger(__name__)
+
+# Measured performance audit of generated sites in headless Chromium.
+# Off by default: the production image is Alpine, where Playwright can't be
+# installed. Set BROWSER_AUDIT_ENABLED=true where it can, either with a local
+# browser (`pip install playwright && playwright install chromium`, as the
+# dev container images do) or with BROWSER_WS_ENDPOINT pointing at a remote
+# Playwright server, e.g. `npx playwright run-server` in the official
+# Playwright image. Unavailable audits make /api/test-website fall back to
+# the static scores.
+BROWSER_AUDIT_ENABLED = os.environ.get('BROWSER_AUDIT_ENABLED', 'false').lower() == 'true'
+BROWSER_WS_ENDPOINT = os.environ.get('BROWSER_WS_ENDPOINT')
+BROWSER_POOL_SIZE = int(os.environ.get('BROWSER_POOL_SIZE', '4'))
+BROWSER_MAX_AUDITS = int(os.environ.get('BROWSER_MAX_AUDITS', '200'))
+# Seconds an audit waits for a free context before reporting unavailable
+BROWSER_ACQUIRE_TIMEOUT = float(os.environ.get('BROWSER_ACQUIRE_TIMEOUT', '30'))
+BROWSER_AUDIT_TIMEOUT = float(os.environ.get('BROWSER_AUDIT_TIMEOUT', '20'))
+BROWSER_AUDIT_MAX_PAGES = int(os.environ.get('BROWSER_AUDIT_MAX_PAGES', '3'))
+# Milliseconds to keep observing after the load event, for late layout shifts
+BROWSER_AUDIT_SETTLE_MS = int(os.environ.get('BROWSER_AUDIT_SETTLE_MS', '500'))
+
+# Generated files are served from memory under this origin via request
+# interception. Requests to any other origin are blocked, so audits are
+# deterministic and generated code can't reach internal services.
+AUDIT_ORIGIN = "http://site.audit"
+
+# (good, poor) thresholds per metric; scores fall linearly from 100 at
+# good to 0 at poor. Timings in ms, bytes in bytes.
+METRIC_THRESHOLDS = {
+    "first_contentful_paint_ms": (1800, 3000),
+    "load_ms": (2500, 6000),
+    "cumulative_layout_shift": (0.1, 0.25),
+    "dom_elements": (800, 1500),
+    "resource_bytes": (500 * 1024, 2 * 1024 * 1024),
+}
+CONSOLE_ERROR_PENALTY = 5
+MAX_COUNTED_CONSOLE_ERRORS = 4
+
+# Installed before any page script runs
+_OBSERVER_SCRIPT = """
+window.__audit = {cls: 0, lcp: 0};
+try {
+  new PerformanceObserver((list) => {
+    for (const entry of list.getEntries()) {
+      if (!entry.hadRecentInput) window.__audit.cls += entry.value;
+    }
+  }).observe({type: "layout-shift", buffered: true});
+  new PerformanceObserver((list) => {
+    const entries = list.getEntries();
+    window.__audit.lcp = entries[entries.length - 1].startTime;
+  }).observe({type: "largest-contentful-paint", buffered: true});
+} catch (e) {}
+"""
+
+_COLLECT_SCRIPT = """() => {
+  const nav = performance.getEntriesByType("navigation")[0] || {};
+  const fcp = performance.getEntriesByName("first-contentful-paint")[0];
+  return {
+    dom_content_loaded_ms: nav.domContentLoadedEventEnd || 0,
+    load_ms: nav.loadEventEnd || 0,
+    first_contentful_paint_ms: fcp ? fcp.startTime : 0,
+    largest_contentful_paint_ms: window.__audit ? window.__audit.lcp : 0,
+    cumulative_layout_shift: window.__audit ? window.__audit.cls : 0,
+    dom_elements: document.getElementsByTagName("*").length,
+    resource_count: performance.getEntriesByType("resource").length
+  };
+}"""
+
+def metric_score(value: float, good: float, poor: float) -> float:
+    if value <= good:
+        return 100.0
+    if value >= poor:
+        return 0.0
+    return 100.0 * (poor - value) / (poor - good)
+
+def performance_score(metrics: dict) -> int:
+    scores = [metric_score(metrics.get(name, 0), good, poor) for name, (good, poor) in METRIC_THRESHOLDS.items()]
+    return round(sum(scores) / len(scores))
+
+class BrowserUnavailable(Exception):
+    pass
+
+# One shared Chromium per process, launched on first use (or by start()) and
+# relaunched after `recycle_after` contexts or a crash. Each caller gets its
+# own context (cookies, cache and storage isolated), which costs milliseconds
+# instead of a browser launch; `size` caps concurrent contexts, and a caller
+# waits at most `acquire_timeout` seconds for one. This is also the pool the
+# .devcontainer Playwright executor runs scripts on.
+class BrowserPool:
+    def __init__(self, size: int, recycle_after: int, ws_endpoint: str = None, acquire_timeout: float = 30,
+                 launch_options: dict = None):
+        self.size = size
+        self.recycle_after = recycle_after
+        self.ws_endpoint = ws_endpoint
+        self.acquire_timeout = acquire_timeout
+        self.launch_options = launch_options or {"headless": True}
+        self._slots = asyncio.Semaphore(size)
+        self._launch_lock = asyncio.Lock()
+        self._playwright = None
+        self._browser = None
+        self._contexts_on_browser = 0
+        self._unavailable = None
+        self._stats = {"launches": 0, "contexts": 0, "in_use": 0, "launch_errors": 0, "acquire_timeouts": 0,
+                       "last_launch_ms": 0.0}
+
+    async def start(self):
+        # Launches the browser now instead of on first use
+        async with self._launch_lock:
+            await self._launch()
+
+    async def _launch(self):
+        # Caller holds _launch_lock; no-op while the browser is running
+        if self._unavailable is not None:
+            raise BrowserUnavailable(self._unavailable)
+        if self._browser is not None and self._browser.is_connected():
+            return
+        await self._close_browser()
+        try:
+            from playwright.async_api import async_playwright
+        except ImportError:
+            self._unavailable = "playwright is not installed"
+            logger.warning("Browser pool disabled: playwright is not installed")
+            raise BrowserUnavailable(self._unavailable)
+        started = time.perf_counter()
+        try:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            if self.ws_endpoint:
+                self._browser = await self._playwright.chromium.connect(self.ws_endpoint)
+            else:
+                self._browser = await self._playwright.chromium.launch(**self.launch_options)
+        except Exception as e:
+            self._stats["launch_errors"] += 1
+            logger.error(f"Could not start browser: {str(e)}")
+            raise BrowserUnavailable(str(e).splitlines()[0])
+        self._stats["launches"] += 1
+        self._stats["last_launch_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self._contexts_on_browser = 0
+
+    async def _get_browser(self):
+        async with self._launch_lock:
+            # Recycle only between contexts, never under a running one
+            if self._browser is not None and self._contexts_on_browser >= self.recycle_after \
+                    and not self._stats["in_use"]:
+                await self._close_browser()
+            await self._launch()
+            self._contexts_on_browser += 1
+            self._stats["in_use"] += 1
+            return self._browser
+
+    async def new_context(self, **context_options):
+        # Returns (context, release); release() closes the context and frees
+        # the slot. Waits up to acquire_timeout for a free slot first.
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._stats["acquire_timeouts"] += 1
+            raise BrowserUnavailable(f"No browser context free within {self.acquire_timeout:g}s")
+        try:
+            browser = await self._get_browser()
+        except BaseException:
+            self._slots.release()
+            raise
+        try:
+            context = await browser.new_context(**context_options)
+        except BaseException:
+            self._stats["in_use"] -= 1
+            self._slots.release()
+            raise
+        self._stats["contexts"] += 1
+
+        async def release():
+            try:
+                await context.close()
+            except Exception as e:
+                logger.warning(f"Could not close browser context: {str(e)}")
+            finally:
+                self._stats["in_use"] -= 1
+                self._slots.release()
+        return context, release
+
+    async def _close_browser(self):
+        browser, self._browser = self._browser, None
+        if browser is not None:
+            try:
+                await browser.close()
+            except Exception as e:
+                logger.warning(f"Could not close browser: {str(e)}")
+
+    async def close(self):
+        async with self._launch_lock:
+            await self._close_browser()
+            if self._playwright is not None:
+                await self._playwright.stop()
+                self._playwright = None
+
+    def stats(self) -> dict:
+        return {"size": self.size, "connected": bool(self._browser and self._browser.is_connected()),
+                "available": self._unavailable is None, **self._stats}
+
+class BrowserAuditor:
+    def __init__(self, pool: BrowserPool, enabled: bool = True):
+        self.pool = pool
+        self.enabled = enabled
+        self._stats = {"audits": 0, "pages": 0, "errors": 0, "total_ms": 0.0}
+
+    async def audit(self, files: list) -> dict:
+        # files: [{name, content, file_type}]. Loads up to
+        # BROWSER_AUDIT_MAX_PAGES HTML pages in parallel and returns
+        # per-page metrics plus overall scores.
+        if not self.enabled:
+            return {"available": False, "reason": "disabled"}
+        pages = [file["name"] for file in files if file["file_type"] == "html"][:BROWSER_AUDIT_MAX_PAGES]
+        if not pages:
+            return {"available": False, "reason": "no html pages"}
+        started = time.perf_counter()
+        site = {posixpath.normpath(file["name"].lstrip("/")): file["content"] for file in files}
+        try:
+            results = await asyncio.gather(*(self._audit_page(site, page) for page in pages))
+        except BrowserUnavailable as e:
+            return {"available": False, "reason": str(e)}
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._stats["audits"] += 1
+        self._stats["pages"] += len(pages)
+        self._stats["total_ms"] += elapsed_ms
+
+        measured = [result for result in results if "error" not in result]
+        report = {"available": True, "duration_ms": round(elapsed_ms, 1), "pages": results}
+        if measured:
+            report["performance_score"] = round(sum(result["performance_score"] for result in measured) / len(measured))
+            console_errors = sum(min(len(result["console_errors"]), MAX_COUNTED_CONSOLE_ERRORS) for result in measured)
+            report["best_practices_penalty"] = console_errors * CONSOLE_ERROR_PENALTY
+        return report
+
+    async def _audit_page(self, site: dict, page_name: str) -> dict:
+        try:
+            context, release = await self.pool.new_context(viewport={"width": 1280, "height": 800})
+        except BrowserUnavailable:
+            raise
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Could not open browser context for {page_name}: {str(e)}")
+            return {"page": page_name, "error": str(e)}
+        served_bytes = 0
+        blocked = []
+        missing = []
+        console_errors = []
+
+        async def serve(route):
+            nonlocal served_bytes
+            url = urlparse(route.request.url)
+            if f"{url.scheme}://{url.netloc}" != AUDIT_ORIGIN:
+                blocked.append(route.request.url)
+                await route.abort("blockedbyclient")
+                return
+            path = posixpath.normpath(url.path.lstrip("/") or "index.html")
+            if path not in site:
+                missing.append(path)
+                await route.fulfill(status=404, body="")
+                return
+            body = site[path].encode("utf-8")
+            served_bytes += len(body)
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            await route.fulfill(status=200, body=body, content_type=content_type)
+
+        try:
+            await context.add_init_script(_OBSERVER_SCRIPT)
+            await context.route("**/*", serve)
+            page = await context.new_page()
+
+            def on_console(message):
+                if message.type == "error":
+                    console_errors.append(message.text)
+            page.on("console", on_console)
+            page.on("pageerror", lambda error: console_errors.append(str(error)))
+            await page.goto(f"{AUDIT_ORIGIN}/{page_name}", wait_until="load",
+                            timeout=BROWSER_AUDIT_TIMEOUT * 1000)
+            await page.wait_for_timeout(BROWSER_AUDIT_SETTLE_MS)
+            metrics = await page.evaluate(_COLLECT_SCRIPT)
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.warning(f"Browser audit of {page_name} failed: {str(e)}")
+            return {"page": page_name, "error": str(e)}
+        finally:
+            await release()
+
+        metrics = {name: round(value, 4) if isinstance(value, float) else value for name, value in metrics.items()}
+        metrics["resource_bytes"] = served_bytes
+        # Requests we blocked surface as console errors; they aren't the page's fault
+        console_errors = [text for text in console_errors if "ERR_BLOCKED_BY_CLIENT" not in text]
+        return {
+            "page": page_name,
+            "metrics": metrics,
+            "performance_score": performance_score(metrics),
+            "console_errors": console_errors[:20],
+            "missing_resources": sorted(set(missing)),
+            "blocked_requests": len(blocked)
+        }
+
+    def stats(self) -> dict:
+        audits = self._stats["audits"]
+        return {**self._stats, "total_ms": round(self._stats["total_ms"], 1),
+                "avg_ms": round(self._stats["total_ms"] / audits, 1) if audits else 0.0,
+                "pool": self.pool.stats()}
+
+browser_auditor = BrowserAuditor(BrowserPool(BROWSER_POOL_SIZE, BROWSER_MAX_AUDITS, BROWSER_WS_ENDPOINT,
+                                             acquire_timeout=BROWSER_ACQUIRE_TIMEOUT),
+                                 enabled=BROWSER_AUDIT_ENABLED)
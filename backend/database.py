@@ -0,0 +1,146 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+import logging
+import os
+import threading
+import time
+
+from metrics import MongoCommandMetrics
+
+logger = logging.getLogger(__name__)
+
+# Pool and timeout settings, in milliseconds where the name says so
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '30000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '10000'))
+
+# Counts pool events so utilization can be compared against MONGO_MAX_POOL_SIZE
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_wait_total = 0.0
+        self.pool_clears = 0
+        self._waiting = {}
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_check_out_started(self, event):
+        # Events carry no operation id; Motor runs each operation on one
+        # executor thread, so start and finish are paired by thread
+        self._waiting[threading.get_ident()] = time.monotonic()
+
+    def connection_check_out_failed(self, event):
+        self._waiting.pop(threading.get_ident(), None)
+        self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        started = self._waiting.pop(threading.get_ident(), None)
+        if started is not None:
+            self.checkout_wait_total += time.monotonic() - started
+        self.checkouts += 1
+        self.checked_out += 1
+        self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def stats(self) -> dict:
+        return {
+            "open_connections": self.open,
+            "checked_out": self.checked_out,
+            "peak_checked_out": self.peak_checked_out,
+            "utilization": round(self.checked_out / MONGO_MAX_POOL_SIZE, 4) if MONGO_MAX_POOL_SIZE else 0.0,
+            "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures,
+            "avg_checkout_wait_ms": round(self.checkout_wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "pool_clears": self.pool_clears
+        }
+
+# Owns the Motor client. Nothing connects at import: connect() runs from the
+# FastAPI startup hook and close() from shutdown.
+class Database:
+    def __init__(self, url: str, name: str):
+        self.url = url
+        self.name = name
+        self.client = None
+        self.monitor = PoolMonitor()
+        self._last_ping = {"ok": False, "latency_ms": None, "error": "not connected"}
+
+    @property
+    def db(self):
+        if self.client is None:
+            raise RuntimeError("Database is not connected")
+        return self.client[self.name]
+
+    async def connect(self):
+        self.client = AsyncIOMotorClient(
+            self.url,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            event_listeners=[self.monitor, MongoCommandMetrics()]
+        )
+        # The client connects lazily; ping so a dead server shows up now
+        if await self.ping():
+            logger.info("Connected to MongoDB")
+        else:
+            logger.error(f"MongoDB is not reachable: {self._last_ping['error']}")
+        return self.db
+
+    async def ping(self) -> bool:
+        if self.client is None:
+            return False
+        started = time.monotonic()
+        try:
+            await self.client.admin.command("ping")
+        except Exception as e:
+            self._last_ping = {"ok": False, "latency_ms": None, "error": str(e)}
+            return False
+        self._last_ping = {"ok": True, "latency_ms": round((time.monotonic() - started) * 1000, 3), "error": None}
+        return True
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+            logger.info("MongoDB connection closed")
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.client is not None,
+            "last_ping": self._last_ping,
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            **self.monitor.stats()
+        }
@@ -0,0 +1,120 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Audit collections get a unique id, a timestamp index and, where records are
+# looked up by idea, an idea_hash index. Retention is set per collection with
+# MONGO_TTL_<COLLECTION> (seconds); when set, the single-field timestamp index
+# doubles as the TTL index. Collections holding artifact refs index
+# files.sha256 for the artifact store's garbage collection sweep.
+AUDIT_COLLECTIONS = {
+    "status_checks": [
+        [("timestamp", -1), ("id", -1)],
+        [("client_name", 1), ("timestamp", -1), ("id", -1)],
+    ],
+    "website_analyses": [[("idea_hash", 1), ("timestamp", -1)]],
+    "website_plans": [[("idea_hash", 1), ("timestamp", -1)]],
+    "generated_code": [[("idea_hash", 1), ("timestamp", -1)], [("files.sha256", 1)]],
+    "test_results": [[("files.sha256", 1)]],
+    "deployment_info": [[("files.sha256", 1)]],
+    "github_pushes": [[("username", 1), ("repo", 1), ("timestamp", -1)]],
+}
+
+def collection_ttl(collection_name: str):
+    value = os.environ.get(f"MONGO_TTL_{collection_name.upper()}")
+    return int(value) if value else None
+
+def index_name(keys) -> str:
+    # Same naming scheme Mongo uses by default, so indexes created elsewhere match
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+def declared_indexes() -> dict:
+    # {collection: [(keys, options)]}
+    declared = {}
+    for collection_name, extra_indexes in AUDIT_COLLECTIONS.items():
+        timestamp_options = {}
+        ttl = collection_ttl(collection_name)
+        if ttl is not None:
+            timestamp_options["expireAfterSeconds"] = ttl
+        declared[collection_name] = [
+            ([("id", 1)], {"unique": True}),
+            ([("timestamp", 1)], timestamp_options),
+        ] + [(keys, {}) for keys in extra_indexes]
+
+    jobs_ttl = collection_ttl("jobs")
+    declared["jobs"] = [
+        ([("id", 1)], {"unique": True}),
+        ([("status", 1), ("priority", -1), ("created_at", 1)], {}),
+        ([("finished_at", 1)], {"expireAfterSeconds": jobs_ttl} if jobs_ttl is not None else {}),
+    ]
+    # Usage documents are keyed key:model:day; this serves per-key reports
+    declared["api_usage"] = [
+        ([("key", 1), ("day", -1)], {}),
+    ]
+    # Serves the artifact garbage collection sweep
+    declared["artifacts"] = [
+        ([("last_used_at", 1)], {}),
+    ]
+    # Pipeline state shared between workers; expires_at is set by the writer
+    declared["pipeline_jobs"] = [
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ]
+    declared["pipeline_events"] = [
+        ([("job_id", 1), ("sequence", 1)], {"unique": True}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ]
+    declared["response_cache"] = [
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ]
+    return declared
+
+def _matches(current: dict, options: dict) -> bool:
+    return (bool(current.get("unique")) == bool(options.get("unique"))
+            and current.get("expireAfterSeconds") == options.get("expireAfterSeconds"))
+
+async def apply_schema(db) -> dict:
+    # Idempotent: creates missing indexes, updates changed TTLs in place with
+    # collMod, and rebuilds indexes whose other options changed
+    report = {}
+    for collection_name, indexes in declared_indexes().items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        changes = {"created": [], "updated": [], "rebuilt": []}
+        for keys, options in indexes:
+            name = index_name(keys)
+            current = existing.get(name)
+            if current is None:
+                await collection.create_index(keys, name=name, **options)
+                changes["created"].append(name)
+            elif _matches(current, options):
+                continue
+            elif ("expireAfterSeconds" in current and "expireAfterSeconds" in options
+                  and bool(current.get("unique")) == bool(options.get("unique"))):
+                await db.command("collMod", collection_name, index={
+                    "keyPattern": dict(keys), "expireAfterSeconds": options["expireAfterSeconds"]
+                })
+                changes["updated"].append(name)
+            else:
+                await collection.drop_index(name)
+                await collection.create_index(keys, name=name, **options)
+                changes["rebuilt"].append(name)
+        if any(changes.values()):
+            logger.info(f"Indexes for {collection_name}: {changes}")
+        report[collection_name] = changes
+    return report
+
+async def index_usage(db) -> dict:
+    usage = {}
+    for collection_name in declared_indexes():
+        stats = await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(None)
+        usage[collection_name] = [
+            {
+                "name": stat["name"],
+                "key": stat["key"],
+                "ops": stat.get("accesses", {}).get("ops", 0),
+                "since": stat.get("accesses", {}).get("since")
+            }
+            for stat in stats
+        ]
+    return usage
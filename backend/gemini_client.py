@@ -0,0 +1,455 @@
+from fastapi import HTTPException, Request
+from google.ai import generativelanguage as glm
+from google.api_core import client_options as client_options_lib
+from google.api_core import exceptions as google_exceptions
+import google.generativeai as genai
+from google.generativeai.types import generation_types
+from collections import OrderedDict
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+
+from metrics import GEMINI_ERRORS, GEMINI_IN_FLIGHT, gemini_error_type, observe_gemini_call, token_counts
+from prompts import estimate_tokens
+from rate_limiter import RateLimiterRegistry, RateLimitExceeded, UsageLedger, backoff_delay
+from structured_output import gemini_response_schema
+from tracing import span, start_span
+
+logger = logging.getLogger(__name__)
+
+# Per-call timeout (seconds) and cap on concurrent in-flight model calls per worker
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', '120'))
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', '32'))
+
+# How often (seconds) a pending call checks whether the HTTP client went away
+DISCONNECT_POLL_INTERVAL = 1.0
+
+# Default model for every call unless a caller asks for another one
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-pro')
+
+# Model name prefixes that accept response_mime_type="application/json"
+GEMINI_JSON_MODE_MODELS = tuple(
+    prefix.strip() for prefix in os.environ.get('GEMINI_JSON_MODE_MODELS', 'gemini-1.5,gemini-2').split(',')
+    if prefix.strip()
+)
+
+# Model name prefixes that also accept a response_schema in JSON mode
+GEMINI_RESPONSE_SCHEMA_MODELS = tuple(
+    prefix.strip() for prefix in os.environ.get('GEMINI_RESPONSE_SCHEMA_MODELS', 'gemini-1.5,gemini-2').split(',')
+    if prefix.strip()
+)
+
+# Pre-built model instances kept per (API key, model name)
+GEMINI_POOL_SIZE = int(os.environ.get('GEMINI_POOL_SIZE', '64'))
+GEMINI_POOL_TTL = float(os.environ.get('GEMINI_POOL_TTL', '3600'))
+
+# Admission per (API key, model): GEMINI_RATE_LIMIT_RPM sustained calls per
+# minute with bursts of GEMINI_RATE_LIMIT_BURST. The rate backs off on upstream
+# 429s and recovers on success. A call waits at most GEMINI_QUEUE_TIMEOUT
+# seconds for admission and retries, then fails with 429. The limits are for
+# the whole deployment: each of the BACKEND_WORKERS processes (exported by
+# entrypoint.sh) enforces its share.
+GEMINI_RATE_LIMIT_RPM = float(os.environ.get('GEMINI_RATE_LIMIT_RPM', '60'))
+GEMINI_RATE_LIMIT_BURST = int(os.environ.get('GEMINI_RATE_LIMIT_BURST', '10'))
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get('GEMINI_QUEUE_TIMEOUT', '30'))
+
+# Retries with exponential backoff and full jitter on retryable upstream errors
+GEMINI_MAX_RETRIES = int(os.environ.get('GEMINI_MAX_RETRIES', '3'))
+GEMINI_RETRY_BASE_DELAY = float(os.environ.get('GEMINI_RETRY_BASE_DELAY', '1'))
+GEMINI_RETRY_MAX_DELAY = float(os.environ.get('GEMINI_RETRY_MAX_DELAY', '20'))
+RETRYABLE_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable,
+                    google_exceptions.InternalServerError)
+
+# Non-standard status used when the client closed the connection mid-request
+CLIENT_CLOSED_REQUEST = 499
+
+_gemini_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+rate_limiters = RateLimiterRegistry(GEMINI_RATE_LIMIT_RPM, GEMINI_RATE_LIMIT_BURST,
+                                    workers=int(os.environ.get('BACKEND_WORKERS', '1')))
+
+# The server binds the api_usage collection and starts the flush loop
+usage_ledger = UsageLedger(flush_interval=float(os.environ.get('GEMINI_USAGE_FLUSH_INTERVAL', '10')),
+                           max_keys=int(os.environ.get('GEMINI_USAGE_MAX_KEYS', '1024')))
+
+# Gemini API integration
+# Each API key gets its own transport instead of mutating the process-wide
+# genai.configure() state, so concurrent requests with different keys are safe.
+# Entries are looked up and inserted without awaiting, so the event loop
+# serialises access and no lock is needed.
+_model_pool = OrderedDict()
+_pool_stats = {"hits": 0, "misses": 0, "evictions": 0, "closed": 0}
+
+def _pool_key(api_key: str, model_name: str):
+    digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    return f"{digest}:{model_name}"
+
+def api_key_fingerprint(api_key=None) -> str:
+    # Identifies a key in rate limits and usage records without storing it
+    key_to_use = api_key or os.environ.get('GEMINI_API_KEY') or ""
+    return hashlib.sha256(key_to_use.encode("utf-8")).hexdigest()[:16]
+
+# One model on one API key's transport, built from the public
+# generativelanguage client and wrapped in genai's response types, so callers
+# use it like genai.GenerativeModel. A model dropped from the pool is retired:
+# its channel is closed once the calls and streams still using it finish.
+class GeminiModel:
+    def __init__(self, api_key: str, model_name: str):
+        self.model_name = model_name if "/" in model_name else f"models/{model_name}"
+        self.client = glm.GenerativeServiceAsyncClient(
+            client_options=client_options_lib.ClientOptions(api_key=api_key)
+        )
+        self._active = 0
+        self._retired = False
+        self._closing = None
+
+    def _request(self, prompt: str, generation_config=None):
+        # to_generation_config_dict turns a JSON-schema style response_schema
+        # into the field names and enum values the proto expects
+        if generation_config:
+            generation_config = glm.GenerationConfig(**generation_types.to_generation_config_dict(generation_config))
+        return glm.GenerateContentRequest(
+            model=self.model_name,
+            contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])],
+            generation_config=generation_config or None
+        )
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, generation_config=None,
+                                     request_options=None):
+        request = self._request(prompt, generation_config)
+        self._active += 1
+        try:
+            if stream:
+                iterator = await self.client.stream_generate_content(request, **(request_options or {}))
+                return await genai.types.AsyncGenerateContentResponse.from_aiterator(self._holding(iterator))
+            response = await self.client.generate_content(request, **(request_options or {}))
+            return genai.types.AsyncGenerateContentResponse.from_response(response)
+        finally:
+            self._release()
+
+    async def _holding(self, iterator):
+        # Keeps the channel open until the stream is consumed or abandoned
+        self._active += 1
+        try:
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            self._release()
+
+    def _release(self):
+        self._active -= 1
+        if self._retired and self._active == 0:
+            self._close_soon()
+
+    def retire(self):
+        self._retired = True
+        if self._active == 0:
+            self._close_soon()
+
+    def _close_soon(self):
+        if self._closing is None:
+            self._closing = asyncio.ensure_future(self.close())
+
+    async def close(self):
+        try:
+            await self.client.transport.close()
+            _pool_stats["closed"] += 1
+        except Exception as e:
+            logger.warning(f"Could not close Gemini client: {str(e)}")
+
+def get_gemini_model(api_key=None, model_name: str = GEMINI_MODEL):
+    try:
+        # Use provided API key or fall back to environment variable
+        key_to_use = api_key or os.environ.get('GEMINI_API_KEY')
+        if not key_to_use:
+            raise ValueError("No API key provided or found in environment")
+
+        key = _pool_key(key_to_use, model_name)
+        now = time.monotonic()
+        entry = _model_pool.get(key)
+        if entry is not None and now - entry[0] < GEMINI_POOL_TTL:
+            _model_pool.move_to_end(key)
+            _pool_stats["hits"] += 1
+            return entry[1]
+
+        _pool_stats["misses"] += 1
+        if entry is not None:
+            entry[1].retire()
+        model = GeminiModel(key_to_use, model_name)
+        _model_pool[key] = (now, model)
+        _model_pool.move_to_end(key)
+        while len(_model_pool) > GEMINI_POOL_SIZE:
+            _, (_, evicted) = _model_pool.popitem(last=False)
+            evicted.retire()
+            _pool_stats["evictions"] += 1
+        return model
+    except Exception as e:
+        logger.error(f"Failed to initialize Gemini: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid API key or Gemini API error: {str(e)}")
+
+async def close_gemini_models():
+    # Shutdown: retire every pooled model and wait for the idle ones to close
+    while _model_pool:
+        _, (_, model) = _model_pool.popitem(last=False)
+        model.retire()
+        if model._closing is not None:
+            await model._closing
+
+def gemini_pool_stats():
+    return {"size": len(_model_pool), **_pool_stats}
+
+def generation_config_for(model_name: str, json_mode: bool, response_model=None):
+    if not (json_mode and model_name.startswith(GEMINI_JSON_MODE_MODELS)):
+        return None
+    config = {"response_mime_type": "application/json"}
+    if response_model is not None and model_name.startswith(GEMINI_RESPONSE_SCHEMA_MODELS):
+        config["response_schema"] = gemini_response_schema(response_model)
+    return config
+
+def log_prompt_size(model_name: str, prompt: str):
+    logger.info(f"Gemini call: model={model_name} prompt_chars={len(prompt)} est_tokens={estimate_tokens(prompt)}")
+
+async def cancel_on_disconnect(http_request: Request, coro):
+    # Run coro, cancelling it if the HTTP client disconnects before it finishes
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                logger.info("Client disconnected, cancelling pending Gemini call")
+                raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+
+async def _call_model_once(model, prompt: str, model_name: str, timeout: float, generation_config=None):
+    async with _gemini_slots:
+        started = time.perf_counter()
+        GEMINI_IN_FLIGHT.inc()
+        try:
+            response = await asyncio.wait_for(
+                model.generate_content_async(prompt, generation_config=generation_config,
+                                             request_options={"timeout": timeout}),
+                timeout=timeout
+            )
+            text = response.text
+        except BaseException as e:
+            GEMINI_ERRORS.labels(model_name, gemini_error_type(e)).inc()
+            observe_gemini_call(model_name, "call", "error", started, prompt)
+            raise
+        finally:
+            GEMINI_IN_FLIGHT.dec()
+    usage = getattr(response, "usage_metadata", None)
+    observe_gemini_call(model_name, "call", "ok", started, prompt, text, usage)
+    return text, usage
+
+async def _call_model(model, prompt: str, model_name: str, timeout: float, generation_config=None,
+                      usage_key: str = ""):
+    bucket = rate_limiters.get(usage_key, model_name)
+    deadline = time.monotonic() + GEMINI_QUEUE_TIMEOUT
+    attempt = 0
+    while True:
+        try:
+            await bucket.acquire(deadline)
+        except RateLimitExceeded:
+            usage_ledger.record(usage_key, model_name, locally_throttled=1)
+            raise
+        usage_ledger.record(usage_key, model_name, requests=1)
+        try:
+            text, usage = await _call_model_once(model, prompt, model_name, timeout, generation_config)
+        except RETRYABLE_ERRORS as e:
+            if isinstance(e, google_exceptions.TooManyRequests):
+                bucket.throttled()
+                usage_ledger.record(usage_key, model_name, upstream_throttled=1)
+            delay = backoff_delay(attempt, GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY)
+            if attempt >= GEMINI_MAX_RETRIES or time.monotonic() + delay > deadline:
+                usage_ledger.record(usage_key, model_name, errors=1)
+                raise
+            attempt += 1
+            usage_ledger.record(usage_key, model_name, retries=1)
+            logger.warning(f"Gemini {type(e).__name__}, retry {attempt}/{GEMINI_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        except Exception:
+            usage_ledger.record(usage_key, model_name, errors=1)
+            raise
+        bucket.succeeded()
+        prompt_tokens, response_tokens = token_counts(prompt, text, usage)
+        usage_ledger.record(usage_key, model_name, prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+        return text
+
+# Single-flight: concurrent identical (API key, prompt, model) calls share one
+# upstream request; callers with different keys never share a call, so one
+# key's quota or permissions are never used to answer another key's request.
+# Each caller awaits a shielded view of the shared task, so one caller going
+# away does not cancel the others; the upstream call is only cancelled once
+# every waiter has left.
+_in_flight = {}
+_coalescing_stats = {"upstream_calls": 0, "coalesced_calls": 0}
+
+def _flight_key(usage_key: str, prompt: str, model_name: str, generation_config=None) -> str:
+    # usage_key is the API key fingerprint, never the key itself
+    return hashlib.sha256(f"{usage_key}\0{model_name}\0{generation_config}\0{prompt}".encode("utf-8")).hexdigest()
+
+def _finish_flight(key: str, flight: dict):
+    if _in_flight.get(key) is flight:
+        del _in_flight[key]
+    # Mark the exception as retrieved in case every waiter already left
+    if not flight["task"].cancelled():
+        flight["task"].exception()
+
+async def _call_model_coalesced(model, prompt: str, model_name: str, timeout: float, generation_config=None,
+                                usage_key: str = ""):
+    key = _flight_key(usage_key, prompt, model_name, generation_config)
+    flight = _in_flight.get(key)
+    if flight is None:
+        task = asyncio.ensure_future(_call_model(model, prompt, model_name, timeout, generation_config, usage_key))
+        flight = {"task": task, "waiters": 0}
+        _in_flight[key] = flight
+        flight["task"].add_done_callback(lambda _: _finish_flight(key, flight))
+        _coalescing_stats["upstream_calls"] += 1
+    else:
+        _coalescing_stats["coalesced_calls"] += 1
+
+    flight["waiters"] += 1
+    try:
+        return await asyncio.shield(flight["task"])
+    finally:
+        flight["waiters"] -= 1
+        if flight["waiters"] == 0 and not flight["task"].done():
+            flight["task"].cancel()
+
+def gemini_coalescing_stats():
+    return {"in_flight": len(_in_flight), **_coalescing_stats}
+
+# Gemini itself refused the call (429/503 after retries). Local admission
+# failures are plain 429s: only upstream overload is worth trying another
+# model for.
+class UpstreamOverloaded(HTTPException):
+    pass
+
+def rate_limited(error: RateLimitExceeded) -> HTTPException:
+    logger.warning(f"Gemini rate limited: {str(error)}")
+    return HTTPException(status_code=429, detail=f"Gemini rate limit reached: {str(error)}",
+                         headers={"Retry-After": str(math.ceil(error.retry_after))})
+
+def upstream_overloaded(error: Exception) -> UpstreamOverloaded:
+    status_code = 429 if isinstance(error, google_exceptions.TooManyRequests) else 503
+    logger.warning(f"Gemini overloaded: {str(error)}")
+    return UpstreamOverloaded(status_code=status_code, detail=f"Gemini is overloaded: {str(error)}",
+                              headers={"Retry-After": str(math.ceil(GEMINI_RETRY_MAX_DELAY))})
+
+# Helper function to run Gemini model without blocking the event loop
+# json_mode asks for a JSON response on models that support it, constrained
+# to response_model's schema where the model accepts one
+async def generate_with_gemini(prompt: str, api_key: str = None, model_name: str = GEMINI_MODEL,
+                               http_request: Request = None, timeout: float = None, json_mode: bool = False,
+                               response_model=None):
+    model = get_gemini_model(api_key, model_name)
+    timeout = timeout or GEMINI_TIMEOUT
+    log_prompt_size(model_name, prompt)
+    try:
+        with span("gemini.generate", model=model_name, prompt_chars=len(prompt), json_mode=json_mode) as call_span:
+            call = _call_model_coalesced(model, prompt, model_name, timeout,
+                                         generation_config_for(model_name, json_mode, response_model),
+                                         usage_key=api_key_fingerprint(api_key))
+            if http_request is not None:
+                text = await cancel_on_disconnect(http_request, call)
+            else:
+                text = await call
+            call_span.set(response_chars=len(text))
+            return text
+    except HTTPException:
+        raise
+    except RateLimitExceeded as e:
+        raise rate_limited(e)
+    except (google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable) as e:
+        raise upstream_overloaded(e)
+    except asyncio.TimeoutError:
+        logger.error(f"Gemini API call timed out after {timeout}s")
+        raise HTTPException(status_code=504, detail=f"Gemini API timed out after {timeout}s")
+    except Exception as e:
+        logger.error(f"Gemini API error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Gemini API error: {str(e)}")
+
+# Streaming variant: yields text chunks as Gemini produces them. The timeout
+# bounds the whole stream; cancelling the consumer cancels the upstream call.
+async def stream_with_gemini(prompt: str, api_key: str = None, model_name: str = GEMINI_MODEL,
+                             timeout: float = None, json_mode: bool = False, response_model=None):
+    model = get_gemini_model(api_key, model_name)
+    timeout = timeout or GEMINI_TIMEOUT
+    log_prompt_size(model_name, prompt)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    started = time.perf_counter()
+    received = []
+    usage = None
+    usage_key = api_key_fingerprint(api_key)
+    bucket = rate_limiters.get(usage_key, model_name)
+    # Detached span: a context manager can't stay open across yields
+    stream_span = start_span("gemini.stream", model=model_name, prompt_chars=len(prompt), json_mode=json_mode)
+    try:
+        # Admitted like any other call, but not retried: a stream may already
+        # have reached the client when it fails
+        try:
+            await bucket.acquire(time.monotonic() + GEMINI_QUEUE_TIMEOUT)
+        except RateLimitExceeded:
+            usage_ledger.record(usage_key, model_name, locally_throttled=1)
+            stream_span.end()
+            raise
+        usage_ledger.record(usage_key, model_name, requests=1)
+        async with _gemini_slots:
+            GEMINI_IN_FLIGHT.inc()
+            try:
+                response = await asyncio.wait_for(
+                    model.generate_content_async(prompt, stream=True,
+                                                 generation_config=generation_config_for(model_name, json_mode, response_model),
+                                                 request_options={"timeout": timeout}),
+                    timeout=timeout
+                )
+                chunks = response.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(deadline - loop.time(), 0))
+                    except StopAsyncIteration:
+                        break
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    if chunk.text:
+                        received.append(chunk.text)
+                        yield chunk.text
+            except BaseException as e:
+                stream_span.end(e)
+                if isinstance(e, google_exceptions.TooManyRequests):
+                    bucket.throttled()
+                    usage_ledger.record(usage_key, model_name, upstream_throttled=1)
+                if not isinstance(e, GeneratorExit):
+                    usage_ledger.record(usage_key, model_name, errors=1)
+                error_type = "cancelled" if isinstance(e, GeneratorExit) else gemini_error_type(e)
+                GEMINI_ERRORS.labels(model_name, error_type).inc()
+                observe_gemini_call(model_name, "stream", "error", started, prompt, "".join(received))
+                raise
+            finally:
+                GEMINI_IN_FLIGHT.dec()
+        observe_gemini_call(model_name, "stream", "ok", started, prompt, "".join(received), usage)
+        bucket.succeeded()
+        prompt_tokens, response_tokens = token_counts(prompt, "".join(received), usage)
+        usage_ledger.record(usage_key, model_name, prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+        stream_span.set(response_chars=sum(len(part) for part in received))
+        stream_span.end()
+    except HTTPException:
+        raise
+    except RateLimitExceeded as e:
+        raise rate_limited(e)
+    except (google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable) as e:
+        raise upstream_overloaded(e)
+    except asyncio.TimeoutError:
+        logger.error(f"Gemini API stream timed out after {timeout}s")
+        raise HTTPException(status_code=504, detail=f"Gemini API timed out after {timeout}s")
+    except Exception as e:
+        logger.error(f"Gemini API error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Gemini API error: {str(e)}")
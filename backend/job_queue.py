@@ -0,0 +1,305 @@
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from datetime import datetime, timedelta
+import asyncio
+import logging
+import uuid
+
+from tracing import current_trace_id, new_trace_id, span, use_trace
+
+logger = logging.getLogger(__name__)
+
+# Error recorded on jobs whose secrets were lost with the process holding them
+SECRETS_LOST_ERROR = {"status": 400, "detail": "API key required, resubmit the job"}
+
+# Background job queue. Job records live in Mongo so status survives restarts
+# and is visible to every worker process. Each process runs a pool of asyncio
+# workers that claim queued jobs straight from Mongo, highest priority first
+# and then oldest, atomically (queued -> running). Running jobs hold a lease
+# that is renewed by a heartbeat; jobs whose lease expired (their process
+# died) are put back in the queue by a periodic recovery sweep.
+#
+# Secrets such as API keys are kept in memory only and never written to Mongo.
+# A job submitted with secrets can only be claimed by the process holding
+# them, which keeps its lease alive while it waits; if that process goes away
+# the job fails with SECRETS_LOST_ERROR instead of running without them.
+class JobQueue:
+    def __init__(self, collection, workers: int = 4, lease_seconds: float = 60, poll_interval: float = 1):
+        self.collection = collection
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        # Idle workers look for jobs submitted by other processes this often
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._wakeup = asyncio.Event()
+        self._maintenance_task = None
+        self._secrets = {}
+        self._running = {}
+        self._worker_tasks = []
+        self._stopping = False
+
+    def register(self, kind: str, handler):
+        # handler: async fn(payload: dict, report) -> dict, where
+        # report(stage=..., progress=...) records progress on the job
+        self._handlers[kind] = handler
+
+    async def start(self):
+        # Workers start first so a failed recovery (Mongo down at boot)
+        # leaves the queue usable once Mongo is back
+        self._stopping = False
+        self._worker_tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._maintenance_task = asyncio.ensure_future(self._maintain())
+        logger.info(f"Job queue started with {self.workers} workers")
+        await self._recover()
+
+    async def stop(self):
+        # Running jobs are handed back to the queue rather than marked
+        # cancelled; jobs that need the secrets held here can't be, so fail
+        self._stopping = True
+        tasks = self._worker_tasks + ([self._maintenance_task] if self._maintenance_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        running = list(self._running.values())
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        self._worker_tasks = []
+        self._maintenance_task = None
+        if self._secrets:
+            try:
+                await self._fail_secrets_lost({"id": {"$in": list(self._secrets)}, "status": "queued"})
+            except Exception as e:
+                logger.warning(f"Could not fail jobs holding secrets: {str(e)}")
+            self._secrets.clear()
+
+    async def submit(self, kind: str, payload: dict, priority: int = 0, secrets: dict = None) -> dict:
+        if kind not in self._handlers:
+            raise HTTPException(status_code=400, detail=f"Unknown job kind: {kind}")
+
+        now = datetime.utcnow()
+        job = {
+            "id": str(uuid.uuid4()),
+            "kind": kind,
+            "payload": payload,
+            "priority": priority,
+            "status": "queued",
+            "stage": None,
+            "progress": 0,
+            "result": None,
+            "error": None,
+            "attempts": 0,
+            "cancel_requested": False,
+            "needs_secrets": bool(secrets),
+            "created_at": now,
+            "updated_at": now,
+            "started_at": None,
+            "finished_at": None,
+            # Run ID of the submitting request, so the job's spans join its trace
+            "trace_id": current_trace_id()
+        }
+        record = dict(job)
+        if secrets:
+            # Held for this process; renewed by _maintain while queued
+            self._secrets[job["id"]] = secrets
+            record["lease_expires_at"] = now + timedelta(seconds=self.lease_seconds)
+        await self.collection.insert_one(record)
+        self._wakeup.set()
+        return self._public(job)
+
+    async def get(self, job_id: str, include_result: bool = False) -> dict:
+        projection = {"_id": 0, "payload": 0, "lease_expires_at": 0}
+        if not include_result:
+            projection["result"] = 0
+        job = await self.collection.find_one({"id": job_id}, projection)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job
+
+    async def result(self, job_id: str) -> dict:
+        job = await self.get(job_id, include_result=True)
+        if job["status"] == "completed":
+            return job["result"]
+        if job["status"] == "failed":
+            error = job.get("error") or {}
+            raise HTTPException(status_code=error.get("status", 500), detail=error.get("detail", "Job failed"))
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+
+    async def cancel(self, job_id: str) -> dict:
+        now = datetime.utcnow()
+        queued = await self.collection.find_one_and_update(
+            {"id": job_id, "status": "queued"},
+            {"$set": {"status": "cancelled", "cancel_requested": True, "finished_at": now, "updated_at": now}}
+        )
+        if queued is None:
+            # Running here: cancel directly. Running elsewhere: its heartbeat
+            # picks up the flag.
+            await self.collection.update_one(
+                {"id": job_id, "status": "running"},
+                {"$set": {"cancel_requested": True, "updated_at": now}}
+            )
+            task = self._running.get(job_id)
+            if task is not None:
+                task.cancel()
+                await asyncio.wait({task})
+        self._secrets.pop(job_id, None)
+        return await self.get(job_id)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "running": bool(self._worker_tasks),
+                "held_local": len(self._secrets), "running_local": len(self._running)}
+
+    def _public(self, job: dict) -> dict:
+        return {key: value for key, value in job.items() if key not in ("_id", "payload", "result")}
+
+    async def _recover(self):
+        now = datetime.utcnow()
+        expired = {"status": {"$in": ["queued", "running"]}, "lease_expires_at": {"$lt": now}}
+        failed = await self._fail_secrets_lost({**expired, "needs_secrets": True})
+        if failed:
+            logger.warning(f"Failed {failed} jobs whose API key was lost with their process")
+        requeued = await self.collection.update_many(
+            {**expired, "status": "running"},
+            {"$set": {"status": "queued", "updated_at": now}, "$unset": {"lease_expires_at": ""}}
+        )
+        if requeued.modified_count:
+            logger.info(f"Recovered {requeued.modified_count} interrupted jobs")
+
+    async def _fail_secrets_lost(self, query: dict) -> int:
+        now = datetime.utcnow()
+        result = await self.collection.update_many(
+            query,
+            {"$set": {"status": "failed", "error": SECRETS_LOST_ERROR, "finished_at": now, "updated_at": now},
+             "$unset": {"lease_expires_at": ""}}
+        )
+        return result.modified_count
+
+    async def _maintain(self):
+        # Keeps the leases of queued jobs whose secrets are held here, drops
+        # secrets of jobs that ended elsewhere (cancelled) and recovers jobs
+        # of processes that died
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                held = list(self._secrets)
+                if held:
+                    active = self.collection.find({"id": {"$in": held}, "status": {"$in": ["queued", "running"]}},
+                                                  {"id": 1})
+                    active_ids = {job["id"] async for job in active}
+                    for job_id in held:
+                        if job_id not in active_ids:
+                            self._secrets.pop(job_id, None)
+                    await self.collection.update_many(
+                        {"id": {"$in": list(active_ids)}, "status": "queued"},
+                        {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+                    )
+                await self._recover()
+            except Exception as e:
+                logger.warning(f"Job queue maintenance failed: {str(e)}")
+
+    async def _claim(self):
+        # Jobs that need secrets are only claimable where they are held
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"status": "queued",
+             "$or": [{"needs_secrets": {"$ne": True}}, {"id": {"$in": list(self._secrets)}}]},
+            {
+                "$set": {
+                    "status": "running",
+                    "started_at": now,
+                    "updated_at": now,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds)
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("priority", -1), ("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _wait_for_work(self):
+        # Woken early by a local submit; otherwise polls for other processes'
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Failed to claim a job: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            if job is None:
+                await self._wait_for_work()
+                continue
+
+            task = asyncio.ensure_future(self._execute(job))
+            self._running[job["id"]] = task
+            await asyncio.wait({task})
+
+    async def _execute(self, job: dict):
+        job_id = job["id"]
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id))
+
+        async def report(stage: str = None, progress: int = None):
+            update = {"updated_at": datetime.utcnow()}
+            if stage is not None:
+                update["stage"] = stage
+            if progress is not None:
+                update["progress"] = progress
+            await self.collection.update_one({"id": job_id}, {"$set": update})
+
+        try:
+            payload = {**job["payload"], **self._secrets.get(job_id, {})}
+            with use_trace(job.get("trace_id") or new_trace_id()), span(f"job.{job['kind']}", job_id=job_id):
+                result = await self._handlers[job["kind"]](payload, report)
+            await self._finish(job_id, {"status": "completed", "result": result, "progress": 100, "stage": None})
+        except asyncio.CancelledError:
+            if self._stopping and job.get("needs_secrets"):
+                await self._finish(job_id, {"status": "failed", "error": SECRETS_LOST_ERROR})
+            elif self._stopping:
+                await self.collection.update_one(
+                    {"id": job_id},
+                    {"$set": {"status": "queued", "updated_at": datetime.utcnow()}, "$unset": {"lease_expires_at": ""}}
+                )
+            else:
+                await self._finish(job_id, {"status": "cancelled"})
+            raise
+        except HTTPException as e:
+            await self._finish(job_id, {"status": "failed", "error": {"status": e.status_code, "detail": e.detail}})
+        except Exception as e:
+            logger.error(f"Job {job_id} ({job['kind']}) failed: {str(e)}")
+            await self._finish(job_id, {"status": "failed", "error": {"status": 500, "detail": str(e)}})
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+            if not self._stopping:
+                self._secrets.pop(job_id, None)
+
+    async def _finish(self, job_id: str, update: dict):
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"id": job_id},
+            {"$set": {**update, "finished_at": now, "updated_at": now}, "$unset": {"lease_expires_at": ""}}
+        )
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                job = await self.collection.find_one_and_update(
+                    {"id": job_id, "status": "running"},
+                    {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}},
+                    projection={"cancel_requested": 1}
+                )
+            except Exception as e:
+                logger.warning(f"Heartbeat for job {job_id} failed: {str(e)}")
+                continue
+            if job is not None and job.get("cancel_requested"):
+                task = self._running.get(job_id)
+                if task is not None:
+                    task.cancel()
+                return
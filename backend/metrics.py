@@ -0,0 +1,158 @@
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST,
+                               REGISTRY, generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+import asyncio
+import os
+import time
+
+# With several worker processes, PROMETHEUS_MULTIPROC_DIR must point at a
+# directory shared by all of them (set by entrypoint.sh) so /api/metrics
+# aggregates every worker instead of whichever one answered the scrape
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(8))  # 256 chars .. 4M chars
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled", multiprocess_mode="livesum")
+
+GEMINI_CALL_SECONDS = Histogram(
+    "gemini_call_duration_seconds", "Upstream Gemini call latency",
+    ["model", "mode", "outcome"], buckets=LATENCY_BUCKETS
+)
+GEMINI_PROMPT_CHARS = Histogram("gemini_prompt_chars", "Prompt size sent to Gemini", ["model"], buckets=SIZE_BUCKETS)
+GEMINI_RESPONSE_CHARS = Histogram("gemini_response_chars", "Response size from Gemini", ["model"], buckets=SIZE_BUCKETS)
+GEMINI_TOKENS = Counter("gemini_tokens", "Tokens reported by Gemini (estimated when not reported)", ["model", "kind"])
+GEMINI_ERRORS = Counter("gemini_errors", "Failed Gemini calls by error type", ["model", "type"])
+GEMINI_STAGE_SECONDS = Histogram(
+    "gemini_stage_duration_seconds", "Model time per pipeline stage, fallbacks included",
+    ["stage", "model", "outcome"], buckets=LATENCY_BUCKETS
+)
+GEMINI_STAGE_COST = Counter("gemini_stage_cost_usd", "Estimated model cost per pipeline stage", ["stage", "model"])
+GEMINI_FALLBACKS = Counter("gemini_fallbacks", "Calls moved to the fallback model", ["stage", "from_model", "to_model"])
+GEMINI_IN_FLIGHT = Gauge("gemini_calls_in_flight", "Upstream Gemini calls in progress", multiprocess_mode="livesum")
+
+MONGO_OPERATION_SECONDS = Histogram(
+    "mongo_operation_duration_seconds", "MongoDB command latency",
+    ["command", "outcome"], buckets=LATENCY_BUCKETS
+)
+
+# ASGI middleware rather than BaseHTTPMiddleware: no extra task per request
+# and streaming responses pass through untouched. Routes are labelled by
+# template (/api/jobs/{job_id}) to keep label cardinality bounded.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], route.path if route is not None else "unmatched", str(status[0])
+            ).observe(time.perf_counter() - started)
+
+def observe_gemini_call(model_name: str, mode: str, outcome: str, started: float, prompt: str,
+                        response_text: str = None, usage=None):
+    GEMINI_CALL_SECONDS.labels(model_name, mode, outcome).observe(time.perf_counter() - started)
+    GEMINI_PROMPT_CHARS.labels(model_name).observe(len(prompt))
+    if response_text is not None:
+        GEMINI_RESPONSE_CHARS.labels(model_name).observe(len(response_text))
+    prompt_tokens, response_tokens = token_counts(prompt, response_text, usage)
+    GEMINI_TOKENS.labels(model_name, "prompt").inc(prompt_tokens)
+    if response_tokens:
+        GEMINI_TOKENS.labels(model_name, "response").inc(response_tokens)
+
+def token_counts(prompt: str, response_text: str = None, usage=None):
+    # Gemini's usage_metadata when present, otherwise ~4 characters per token
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    response_tokens = getattr(usage, "candidates_token_count", None)
+    if prompt_tokens is None:
+        prompt_tokens = (len(prompt) + 3) // 4
+    if response_tokens is None:
+        response_tokens = (len(response_text) + 3) // 4 if response_text is not None else 0
+    return prompt_tokens, response_tokens
+
+def gemini_error_type(error: BaseException) -> str:
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(error, asyncio.CancelledError):
+        return "cancelled"
+    return type(error).__name__
+
+# pymongo reports each command's duration itself; record it per command name
+class MongoCommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_OPERATION_SECONDS.labels(event.command_name, "ok").observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_OPERATION_SECONDS.labels(event.command_name, "error").observe(event.duration_micros / 1e6)
+
+# Exposes the stats() dicts the components already keep (cache hit counts,
+# queue depths, pool sizes) as gauges, read only when scraped
+class StatsCollector:
+    def __init__(self):
+        self._sources = {}
+
+    def add(self, name: str, stats):
+        self._sources[name] = stats
+
+    def collect(self):
+        pid = str(os.getpid())
+        for name, stats in self._sources.items():
+            for key, value in _flatten(stats()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                gauge = GaugeMetricFamily(f"{name}_{key}", f"{name} {key.replace('_', ' ')}", labels=["pid"])
+                gauge.add_metric([pid], value)
+                yield gauge
+
+def _flatten(stats: dict, prefix: str = ""):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}_")
+        else:
+            yield f"{prefix}{key}", value
+
+stats_collector = StatsCollector()
+
+def _registry():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(stats_collector)
+        return registry
+    REGISTRY.register(stats_collector)
+    return REGISTRY
+
+_metrics_registry = _registry()
+
+def render_metrics():
+    return generate_latest(_metrics_registry), CONTENT_TYPE_LATEST
+
+def mark_process_dead():
+    # Drops this worker's live gauges from the shared directory on shutdown
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
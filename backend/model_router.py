@@ -0,0 +1,170 @@
+from fastapi import HTTPException
+from collections import defaultdict
+import logging
+import os
+import time
+
+from gemini_client import generate_with_gemini, stream_with_gemini, UpstreamOverloaded, GEMINI_MODEL
+from metrics import GEMINI_FALLBACKS, GEMINI_STAGE_COST, GEMINI_STAGE_SECONDS, token_counts
+
+logger = logging.getLogger(__name__)
+
+# Model tiers. Simple stages run on the fast tier, planning and code
+# generation on the strong one.
+GEMINI_FAST_MODEL = os.environ.get('GEMINI_FAST_MODEL', 'gemini-1.5-flash')
+GEMINI_STRONG_MODEL = os.environ.get('GEMINI_STRONG_MODEL', GEMINI_MODEL)
+
+DEFAULT_STAGE_TIERS = {
+    "analyze-idea": "fast",
+    "plan-website": "strong",
+    "generate-code": "strong",
+    "test-website": "fast",
+    "prepare-deployment": "fast",
+    "execute-command": "fast",
+}
+
+# When Gemini reports a stage's model overloaded (429/503 after retries) the
+# call is retried once on the other tier. Our own rate limiter refusing a call
+# is not a reason to spend another model's quota.
+FALLBACK_TIERS = {"fast": "strong", "strong": "fast"}
+
+# USD per million (prompt, response) tokens, used for cost estimates.
+# Override or extend with GEMINI_MODEL_PRICES="model=in/out,..."
+DEFAULT_MODEL_PRICES = {
+    "gemini-pro": (0.50, 1.50),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gemini-2.0-flash": (0.10, 0.40),
+}
+
+def _parse_pairs(value: str) -> dict:
+    pairs = {}
+    for item in value.split(","):
+        name, _, setting = item.partition("=")
+        if name.strip() and setting.strip():
+            pairs[name.strip()] = setting.strip()
+    return pairs
+
+def _parse_prices(value: str) -> dict:
+    prices = {}
+    for model_name, setting in _parse_pairs(value).items():
+        prompt_price, _, response_price = setting.partition("/")
+        prices[model_name] = (float(prompt_price), float(response_price or prompt_price))
+    return prices
+
+class ModelRouter:
+    def __init__(self, tiers: dict, stage_routes: dict, prices: dict):
+        # stage_routes values are tier names or literal model names
+        self.tiers = tiers
+        self.stage_routes = stage_routes
+        self.prices = prices
+        self._stats = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+
+    def tier_for(self, stage: str):
+        route = self.stage_routes.get(stage, "strong")
+        return route if route in self.tiers else None
+
+    def model_for(self, stage: str) -> str:
+        route = self.stage_routes.get(stage, "strong")
+        return self.tiers.get(route, route)
+
+    def fallback_for(self, stage: str):
+        tier = self.tier_for(stage)
+        fallback = self.tiers.get(FALLBACK_TIERS.get(tier)) if tier else None
+        return fallback if fallback and fallback != self.model_for(stage) else None
+
+    def cost(self, model_name: str, prompt_tokens: int, response_tokens: int) -> float:
+        prompt_price, response_price = self.prices.get(model_name, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + response_tokens * response_price) / 1_000_000
+
+    async def generate(self, stage: str, prompt: str, api_key: str, **kwargs) -> str:
+        model_name = self.model_for(stage)
+        started = time.perf_counter()
+        try:
+            text = await generate_with_gemini(prompt, api_key, model_name=model_name, **kwargs)
+        except HTTPException as e:
+            fallback = self.fallback_for(stage)
+            if not isinstance(e, UpstreamOverloaded) or fallback is None:
+                self._record(stage, model_name, started, prompt, error=True)
+                raise
+            self._fell_back(stage, model_name, fallback, e)
+            model_name = fallback
+            try:
+                text = await generate_with_gemini(prompt, api_key, model_name=model_name, **kwargs)
+            except HTTPException:
+                self._record(stage, model_name, started, prompt, error=True)
+                raise
+        self._record(stage, model_name, started, prompt, text)
+        return text
+
+    async def stream(self, stage: str, prompt: str, api_key: str, **kwargs):
+        # Falls back only if the first model fails before sending anything
+        model_name = self.model_for(stage)
+        started = time.perf_counter()
+        parts = []
+        try:
+            try:
+                async for chunk in stream_with_gemini(prompt, api_key, model_name=model_name, **kwargs):
+                    parts.append(chunk)
+                    yield chunk
+            except HTTPException as e:
+                fallback = self.fallback_for(stage)
+                if parts or not isinstance(e, UpstreamOverloaded) or fallback is None:
+                    raise
+                self._fell_back(stage, model_name, fallback, e)
+                model_name = fallback
+                async for chunk in stream_with_gemini(prompt, api_key, model_name=model_name, **kwargs):
+                    parts.append(chunk)
+                    yield chunk
+        except HTTPException:
+            self._record(stage, model_name, started, prompt, error=True)
+            raise
+        self._record(stage, model_name, started, prompt, "".join(parts))
+
+    def _fell_back(self, stage: str, model_name: str, fallback: str, error: HTTPException):
+        logger.warning(f"{stage}: {model_name} overloaded ({error.status_code}), falling back to {fallback}")
+        GEMINI_FALLBACKS.labels(stage, model_name, fallback).inc()
+        self._stats[stage][model_name]["fallbacks"] += 1
+
+    def _record(self, stage: str, model_name: str, started: float, prompt: str,
+                response_text: str = None, error: bool = False):
+        # Token counts are estimated from text length here; exact counts
+        # per key are in the usage ledger
+        elapsed = time.perf_counter() - started
+        prompt_tokens, response_tokens = token_counts(prompt, response_text)
+        cost = self.cost(model_name, prompt_tokens, response_tokens)
+        stats = self._stats[stage][model_name]
+        stats["calls"] += 1
+        stats["errors"] += error
+        stats["latency_seconds"] += elapsed
+        stats["prompt_tokens"] += prompt_tokens
+        stats["response_tokens"] += response_tokens
+        stats["cost_usd"] += cost
+        GEMINI_STAGE_SECONDS.labels(stage, model_name, "error" if error else "ok").observe(elapsed)
+        GEMINI_STAGE_COST.labels(stage, model_name).inc(cost)
+
+    def stats(self) -> dict:
+        report = {}
+        for stage in sorted(set(self.stage_routes) | set(self._stats)):
+            models = {}
+            for model_name, stats in self._stats.get(stage, {}).items():
+                calls = stats["calls"]
+                models[model_name] = {
+                    "calls": int(calls),
+                    "errors": int(stats["errors"]),
+                    "fallbacks": int(stats["fallbacks"]),
+                    "avg_latency_ms": round(stats["latency_seconds"] / calls * 1000, 1) if calls else 0.0,
+                    "prompt_tokens": int(stats["prompt_tokens"]),
+                    "response_tokens": int(stats["response_tokens"]),
+                    "cost_usd": round(stats["cost_usd"], 6)
+                }
+            report[stage] = {"model": self.model_for(stage), "fallback": self.fallback_for(stage), "models": models}
+        return report
+
+# GEMINI_STAGE_MODELS overrides routes per stage, e.g.
+# "execute-command=fast,test-website=gemini-1.5-pro"
+model_router = ModelRouter(
+    tiers={"fast": GEMINI_FAST_MODEL, "strong": GEMINI_STRONG_MODEL},
+    stage_routes={**DEFAULT_STAGE_TIERS, **_parse_pairs(os.environ.get('GEMINI_STAGE_MODELS', ''))},
+    prices={**DEFAULT_MODEL_PRICES, **_parse_prices(os.environ.get('GEMINI_MODEL_PRICES', ''))}
+)
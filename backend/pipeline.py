@@ -0,0 +1,292 @@
+from fastapi import HTTPException
+from datetime import datetime, timedelta
+import asyncio
+import logging
+import time
+import uuid
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# A pipeline job chains the analyze -> plan -> generate -> test -> deploy stages
+# server-side. Intermediate artifacts stay in memory on the job; clients poll
+# snapshot() or subscribe to events() for progress. The registry also writes
+# the job state and its events to Mongo, so any worker can answer for a job
+# another worker is running.
+class PipelineJob:
+    def __init__(self, idea: str, stage_names):
+        self.id = str(uuid.uuid4())
+        self.idea = idea
+        self.stage_names = list(stage_names)
+        self.status = "queued"
+        self.stage = None
+        self.completed_stages = []
+        self.artifacts = {}
+        self.error = None
+        self.created_at = datetime.utcnow()
+        self.updated_at = self.created_at
+        self.finished_at = None
+        self.sequence = 0
+        self._listeners = []
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    @property
+    def progress(self) -> int:
+        return int(100 * len(self.completed_stages) / len(self.stage_names)) if self.stage_names else 100
+
+    def snapshot(self) -> dict:
+        return {
+            "job_id": self.id,
+            "idea": self.idea,
+            "status": self.status,
+            "stage": self.stage,
+            "completed_stages": self.completed_stages,
+            "progress": self.progress,
+            "artifacts": self.artifacts,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    def publish(self, event: str, data: dict):
+        self.updated_at = datetime.utcnow()
+        self.sequence += 1
+        for queue in self._listeners:
+            queue.put_nowait((event, data))
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._listeners.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._listeners.remove(queue)
+
+    async def events(self):
+        # Replay the current state first so late subscribers can catch up
+        queue = self.subscribe()
+        try:
+            yield "snapshot", self.snapshot()
+            if self.finished:
+                return
+            while True:
+                event, data = await queue.get()
+                yield event, data
+                if event in ("done", "error"):
+                    return
+        finally:
+            self.unsubscribe(queue)
+
+async def run_pipeline(job: PipelineJob, stages):
+    # stages: list of (name, async fn(artifacts, publish) -> dict of new artifacts)
+    job.status = "running"
+    try:
+        for name, run_stage in stages:
+            job.stage = name
+            job.publish("stage_start", {"stage": name, "progress": job.progress})
+            with span(f"pipeline.{name}", pipeline_id=job.id):
+                output = await run_stage(dict(job.artifacts), job.publish)
+            job.artifacts.update(output)
+            job.completed_stages.append(name)
+            job.publish("stage_complete", {"stage": name, "progress": job.progress, "output": output})
+        job.status = "completed"
+        job.stage = None
+        job.publish("done", job.snapshot())
+    except asyncio.CancelledError:
+        job.status = "cancelled"
+        job.publish("error", {"stage": job.stage, "status": 499, "detail": "Pipeline cancelled"})
+        raise
+    except HTTPException as e:
+        job.status = "failed"
+        job.error = {"stage": job.stage, "status": e.status_code, "detail": e.detail}
+        job.publish("error", job.error)
+    except Exception as e:
+        logger.error(f"Pipeline {job.id} failed in stage {job.stage}: {str(e)}")
+        job.status = "failed"
+        job.error = {"stage": job.stage, "status": 500, "detail": str(e)}
+        job.publish("error", job.error)
+    finally:
+        job.finished_at = time.monotonic()
+
+def _persisted_state(job: PipelineJob) -> dict:
+    # Snapshot as of the last published event; artifacts is copied because the
+    # job keeps adding to it while the write is pending
+    return {**job.snapshot(), "artifacts": dict(job.artifacts), "sequence": job.sequence}
+
+# Registry of pipeline jobs. Jobs run on the worker that started them and are
+# kept in memory there until `ttl` seconds after finishing. Each job's state
+# and events are also written to `collection` and `events_collection`, in
+# publish order, so the other workers can serve snapshots and replay events
+# by polling. Documents expire through TTL indexes on expires_at.
+#
+# With an `artifact_store`, generated files are persisted as its
+# {name, file_type, sha256, size} refs rather than full bodies, and the other
+# workers fetch the bodies by hash when they replay. Stored artifacts outlive
+# the job documents: each put renews them for the store's GC grace period.
+class PipelineRegistry:
+    def __init__(self, ttl: float = 3600, collection=None, events_collection=None,
+                 poll_interval: float = 0.5, stale_after: float = 600, artifact_store=None):
+        self.ttl = ttl
+        self.collection = collection
+        self.events_collection = events_collection
+        self.artifact_store = artifact_store
+        self.poll_interval = poll_interval
+        # A remote job that publishes nothing for this long is assumed lost
+        # with its worker
+        self.stale_after = stale_after
+        self._jobs = {}
+        self._tasks = {}
+        self._writers = {}
+
+    async def start(self, job: PipelineJob, stages) -> PipelineJob:
+        self._evict_expired()
+        if self.collection is not None:
+            # Written before the job ID is returned, so the next request can
+            # land on any worker
+            await self.collection.insert_one({"_id": job.id, **_persisted_state(job), "expires_at": self._expires_at()})
+            writer = asyncio.ensure_future(self._write_events(job, job.subscribe()))
+            self._writers[job.id] = writer
+            writer.add_done_callback(lambda _: self._writers.pop(job.id, None))
+        self._jobs[job.id] = job
+        task = asyncio.ensure_future(run_pipeline(job, stages))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+        return job
+
+    async def snapshot(self, job_id: str) -> dict:
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.snapshot()
+        state = await self._load(job_id)
+        return self._public({**state, "artifacts": await self._load_files(state["artifacts"])})
+
+    async def events(self, job_id: str):
+        # -> async iterator of (event, data); raises 404 up front, before a
+        # response has started streaming
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.events()
+        return self._poll_events(await self._load(job_id))
+
+    async def _poll_events(self, state: dict):
+        # Same events as PipelineJob.events(), replayed from Mongo for a job
+        # running on another worker
+        yield "snapshot", self._public({**state, "artifacts": await self._load_files(state["artifacts"])})
+        if state["status"] in ("completed", "failed", "cancelled"):
+            return
+        sequence = state["sequence"]
+        last_event_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            cursor = self.events_collection.find({"job_id": state["_id"], "sequence": {"$gt": sequence}},
+                                                 {"_id": 0, "sequence": 1, "event": 1, "data": 1}).sort("sequence", 1)
+            async for record in cursor:
+                sequence = record["sequence"]
+                last_event_at = time.monotonic()
+                yield record["event"], await self._load_event(record["event"], record["data"])
+                if record["event"] in ("done", "error"):
+                    return
+            if time.monotonic() - last_event_at > self.stale_after:
+                yield "error", {"stage": None, "status": 504, "detail": "Pipeline stopped reporting progress"}
+                return
+
+    async def _load(self, job_id: str) -> dict:
+        state = None
+        if self.collection is not None:
+            state = await self.collection.find_one({"_id": job_id})
+        if state is None:
+            raise HTTPException(status_code=404, detail="Pipeline job not found")
+        return state
+
+    async def _store_files(self, artifacts: dict, stored: dict) -> dict:
+        # Swaps a "files" list for refs; stored memoizes the last list by
+        # identity, since every state write carries the same one
+        files = artifacts.get("files")
+        if self.artifact_store is None or files is None:
+            return artifacts
+        if stored.get("files") is not files:
+            stored["files"] = files
+            stored["refs"] = await self.artifact_store.put_files(files)
+        return {**artifacts, "files": stored["refs"]}
+
+    async def _store_event(self, event: str, data: dict, stored: dict) -> dict:
+        if self.artifact_store is None:
+            return data
+        if event == "file":
+            return (await self.artifact_store.put_files([data]))[0]
+        if event == "stage_complete":
+            return {**data, "output": await self._store_files(data["output"], stored)}
+        if event == "done":
+            return {**data, "artifacts": await self._store_files(data["artifacts"], stored)}
+        return data
+
+    async def _load_files(self, artifacts: dict) -> dict:
+        refs = artifacts.get("files")
+        if self.artifact_store is None or not refs or "sha256" not in refs[0]:
+            return artifacts
+        return {**artifacts, "files": await self.artifact_store.get_files(refs)}
+
+    async def _load_event(self, event: str, data: dict) -> dict:
+        if self.artifact_store is None:
+            return data
+        if event == "file" and "sha256" in data:
+            return (await self.artifact_store.get_files([data]))[0]
+        if event == "stage_complete":
+            return {**data, "output": await self._load_files(data["output"])}
+        if event == "done":
+            return {**data, "artifacts": await self._load_files(data["artifacts"])}
+        return data
+
+    def _public(self, state: dict) -> dict:
+        return {key: value for key, value in state.items() if key not in ("_id", "sequence", "expires_at")}
+
+    def _expires_at(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.ttl)
+
+    async def _write_events(self, job: PipelineJob, queue: asyncio.Queue):
+        # Drains the job's events in batches: one insert for the events and
+        # one update for the state they leave the job in
+        sequence = job.sequence
+        finished = False
+        stored = {}
+        while not finished:
+            batch = [await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            state = _persisted_state(job)
+            expires_at = self._expires_at()
+            first = sequence + 1
+            sequence += len(batch)
+            finished = any(event in ("done", "error") for event, _ in batch)
+            try:
+                state["artifacts"] = await self._store_files(state["artifacts"], stored)
+                records = [{"job_id": job.id, "sequence": first + offset, "event": event,
+                            "data": await self._store_event(event, data, stored), "expires_at": expires_at}
+                           for offset, (event, data) in enumerate(batch)]
+                await self.events_collection.insert_many(records)
+                await self.collection.update_one({"_id": job.id},
+                                                 {"$set": {**state, "sequence": sequence, "expires_at": expires_at}})
+            except Exception as e:
+                logger.warning(f"Could not store events for pipeline {job.id}: {str(e)}")
+        job.unsubscribe(queue)
+
+    async def stop(self, timeout: float = 5):
+        # Cancels running jobs, which publishes their "error" event, and lets
+        # the pending event writes land so other workers see the jobs end
+        running = list(self._tasks.values())
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        if self._writers:
+            await asyncio.wait(list(self._writers.values()), timeout=timeout)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,177 @@
+import json
+import os
+
+# Rough token budgets for embedded file contents in the test and deployment
+# prompts. Tokens are estimated at ~4 characters each.
+PROMPT_FILE_TOKEN_BUDGET = int(os.environ.get('PROMPT_FILE_TOKEN_BUDGET', '12000'))
+PROMPT_DEPLOY_FILE_TOKEN_BUDGET = int(os.environ.get('PROMPT_DEPLOY_FILE_TOKEN_BUDGET', '3000'))
+CHARS_PER_TOKEN = 4
+
+# Upper bound on how much of a malformed response is echoed back in a re-ask
+PROMPT_REPAIR_MAX_CHARS = int(os.environ.get('PROMPT_REPAIR_MAX_CHARS', '16000'))
+
+# Plan sections that only matter to script files
+SCRIPT_PLAN_SECTIONS = ("data_models", "api_endpoints", "third_party_integrations")
+
+def compact_json(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def truncate_middle(text: str, max_chars: int) -> str:
+    # Keep the head and tail of oversized content; both usually carry the
+    # structure (doctype/imports at the top, closing tags/exports at the end)
+    if len(text) <= max_chars:
+        return text
+    marker = f"\n/* ... {len(text) - max_chars} characters omitted ... */\n"
+    keep = max(max_chars - len(marker), 0)
+    head = keep * 2 // 3
+    return text[:head] + marker + text[len(text) - (keep - head):]
+
+def fit_files_to_budget(files: list, token_budget: int) -> list:
+    # Share the character budget across files: small files are kept whole and
+    # whatever they leave over is split between the larger ones
+    budget = token_budget * CHARS_PER_TOKEN
+    order = sorted(range(len(files)), key=lambda i: len(files[i].get("content", "")))
+    fitted = [None] * len(files)
+    remaining_budget = budget
+    for position, index in enumerate(order):
+        file = files[index]
+        share = remaining_budget // (len(files) - position)
+        content = truncate_middle(file.get("content", ""), share)
+        remaining_budget -= len(content)
+        fitted[index] = {"name": file.get("name"), "file_type": file.get("file_type"), "content": content}
+    return fitted
+
+def plan_context_for_file(plan: dict, file_name: str, file_type: str) -> dict:
+    # Only the parts of the plan a single file needs: the file list (so it can
+    # reference its siblings), its own description and the build steps.
+    # Data models, endpoints and integrations are only sent for scripts.
+    file_structure = plan.get("file_structure", {})
+    files = file_structure.get("files", [])
+    context = {
+        "files": [file.get("name", "") for file in files],
+        "this_file": next((file for file in files if file.get("name") == file_name), {"name": file_name}),
+        "implementation_steps": plan.get("implementation_steps", []),
+    }
+    if file_structure.get("directories"):
+        context["directories"] = file_structure["directories"]
+    if file_type in ("javascript", "python"):
+        for section in SCRIPT_PLAN_SECTIONS:
+            if plan.get(section):
+                context[section] = plan[section]
+    return context
+
+def build_analysis_prompt(idea: str) -> str:
+    return f"""You are an expert website analyzer. Analyze the following website idea and provide a detailed analysis.
+Website idea: {idea}
+
+Provide a JSON response with the following structure:
+{{
+"website_type": "Type of website (e-commerce, blog, portfolio, etc.)",
+"target_audience": "Description of target audience",
+"key_features": ["Feature 1", "Feature 2", "Feature 3"],
+"pages": ["Page 1", "Page 2", "Page 3"],
+"technologies": {{"frontend": ["Technology 1", "Technology 2"], "backend": ["Technology 1", "Technology 2"], "database": ["Technology 1"]}},
+"design_suggestions": {{"color_scheme": ["Color 1", "Color 2"], "layout": "Description of layout", "typography": "Font suggestions"}}
+}}
+
+Return ONLY the JSON with no additional text."""
+
+def build_plan_prompt(idea: str, analysis: dict) -> str:
+    return f"""You are an expert website planner. Create a detailed plan for building a website based on the following idea and analysis.
+
+Website idea: {idea}
+
+Analysis: {compact_json(analysis)}
+
+Provide a JSON response with the following structure:
+{{
+"file_structure": {{
+  "directories": ["directory1", "directory2"],
+  "files": [{{"name": "file1.html", "description": "Description of file1"}}, {{"name": "file2.css", "description": "Description of file2"}}]
+}},
+"implementation_steps": ["Step 1: Description", "Step 2: Description"],
+"data_models": [{{"name": "Model name", "fields": ["field1", "field2"]}}],
+"api_endpoints": [{{"path": "/api/endpoint", "method": "GET/POST", "description": "Description"}}],
+"third_party_integrations": [{{"name": "Integration name", "purpose": "Purpose description"}}]
+}}
+
+Return ONLY the JSON with no additional text."""
+
+def build_file_prompt(file_name: str, file_type: str, idea: str, plan: dict) -> str:
+    return f"""You are an expert website developer. Generate code for the following file based on the website idea and plan.
+
+Website idea: {idea}
+
+Plan: {compact_json(plan_context_for_file(plan, file_name, file_type))}
+
+File to generate: {file_name}
+
+Generate complete, working code for this file. Make sure the code is properly formatted and follows best practices.
+Return ONLY the code with no additional text, explanations, or markdown formatting."""
+
+def build_test_prompt(files: list, static_findings: list) -> str:
+    # Markup, references, asset sizes and the scores come from the local
+    # static analyzer; the model only reviews what it can't check
+    return f"""You are an expert website tester. A static analyzer has already checked markup validity, accessibility attributes, file references and asset sizes, and computed the scores. Review the following script files only for problems static checks can't find: logic errors, runtime exceptions, security issues and broken interactions. Don't repeat the known findings.
+Very large files may be shortened; omitted sections are marked.
+
+Known findings:
+{compact_json(static_findings)}
+
+Files:
+{compact_json(fit_files_to_budget(files, PROMPT_FILE_TOKEN_BUDGET))}
+
+Provide a JSON response with the following structure:
+{{
+"test_summary": "Summary of the script review",
+"tests": [{{"file": "filename.ext", "issues": ["Issue 1", "Issue 2"], "recommendations": ["Recommendation 1", "Recommendation 2"]}}]
+}}
+
+Return ONLY the JSON with no additional text."""
+
+def build_deployment_prompt(files: list, test_results: dict) -> str:
+    # Deployment advice depends on what the site is made of, not every line
+    # of it, so it gets a smaller budget than testing
+    fitted = fit_files_to_budget(files, PROMPT_DEPLOY_FILE_TOKEN_BUDGET)
+    return f"""You are an expert website deployer. Prepare the following website for deployment and provide deployment instructions.
+Very large files may be shortened; omitted sections are marked.
+
+Files:
+{compact_json(fitted)}
+
+Test Results:
+{compact_json({key: value for key, value in test_results.items() if key not in ("static_analysis", "browser_audit")})}
+
+Provide a JSON response with the following structure:
+{{
+"deployment_summary": "Summary of deployment readiness",
+"deployment_platforms": ["Platform 1", "Platform 2"],
+"deployment_steps": ["Step 1: Description", "Step 2: Description"],
+"required_environment_variables": ["VAR1", "VAR2"],
+"estimated_deployment_time": "X minutes",
+"post_deployment_tasks": ["Task 1", "Task 2"]
+}}
+
+Return ONLY the JSON with no additional text."""
+
+def build_command_prompt(command: str) -> str:
+    return f"""You are a terminal assistant in an AI website builder application.
+The user has entered the following command: {command}
+
+Provide a simulated terminal output for this command.
+Make it realistic and appropriate for a web development context.
+Keep the output concise (max 10 lines)."""
+
+def build_repair_prompt(output: str, schema_json: str, error: str) -> str:
+    return f"""Your previous response could not be used: {error}
+
+Previous response:
+{truncate_middle(output, PROMPT_REPAIR_MAX_CHARS)}
+
+Return the same content as a single valid JSON value matching this JSON schema:
+{schema_json}
+
+Return ONLY the JSON with no additional text or markdown formatting."""
@@ -0,0 +1,177 @@
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from pymongo import UpdateOne
+import asyncio
+import logging
+import math
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+# Token bucket whose refill rate adapts to the upstream quota (AIMD): an
+# upstream 429 halves the rate and empties the bucket, every success adds back
+# a twentieth of the configured rate. Waiters are admitted in arrival order.
+class AdaptiveTokenBucket:
+    def __init__(self, rate: float, burst: int, min_rate: float):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._turn = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, deadline: float):
+        # deadline is a time.monotonic() value; raises RateLimitExceeded when
+        # no token can be had before it
+        try:
+            await asyncio.wait_for(self._turn.acquire(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            raise RateLimitExceeded(max(1 / self.rate, 1.0))
+        try:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+                if now + wait > deadline:
+                    raise RateLimitExceeded(wait)
+                await asyncio.sleep(wait)
+        finally:
+            self._turn.release()
+
+    def throttled(self):
+        self._refill(time.monotonic())
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def stats(self) -> dict:
+        self._refill(time.monotonic())
+        return {"rate_per_second": round(self.rate, 4), "max_rate_per_second": self.max_rate,
+                "tokens": round(self.tokens, 2), "waiting": int(self._turn.locked())}
+
+# One bucket per (API key fingerprint, model), least recently used dropped first.
+# Buckets live in process memory, so with `workers` processes each one gets an
+# even share of the limit and together they admit requests_per_minute. This
+# holds as long as the load balancer spreads calls evenly; a share nobody uses
+# on one worker can't be borrowed by another.
+class RateLimiterRegistry:
+    def __init__(self, requests_per_minute: float, burst: int, max_buckets: int = 1024, workers: int = 1):
+        workers = max(1, workers)
+        self.rate = requests_per_minute / 60 / workers
+        self.burst = max(1, math.ceil(burst / workers))
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+
+    def get(self, key: str, model_name: str) -> AdaptiveTokenBucket:
+        bucket_key = (key, model_name)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = AdaptiveTokenBucket(self.rate, self.burst, min_rate=self.rate / 16)
+            self._buckets[bucket_key] = bucket
+        self._buckets.move_to_end(bucket_key)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    def stats(self) -> dict:
+        return {f"{key}:{model}": bucket.stats() for (key, model), bucket in self._buckets.items()}
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+USAGE_FIELDS = ("requests", "prompt_tokens", "response_tokens", "retries", "upstream_throttled",
+                "locally_throttled", "errors")
+
+# Per key/model/day usage counters. Kept in memory and added to the
+# api_usage collection with $inc upserts every `flush_interval` seconds, so
+# accounting never adds a write to the request path. Per-key numbers only
+# live in api_usage; in memory the pending counters are capped at `max_keys`
+# entries, least recently used dropped first (counts kept across a failed
+# flush could otherwise grow while Mongo is down), and stats() reports
+# totals per model.
+class UsageLedger:
+    def __init__(self, collection=None, flush_interval: float = 10, max_keys: int = 1024):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self._pending = OrderedDict()
+        self._totals = defaultdict(lambda: defaultdict(int))
+        self._dropped = 0
+        self._task = None
+
+    def record(self, key: str, model_name: str, **counts):
+        day = datetime.utcnow().strftime("%Y-%m-%d")
+        self._add((key, model_name, day), counts)
+        totals = self._totals[model_name]
+        for field, value in counts.items():
+            totals[field] += value
+
+    def _add(self, usage_key, counts: dict):
+        pending = self._pending.get(usage_key)
+        if pending is None:
+            pending = self._pending[usage_key] = defaultdict(int)
+        self._pending.move_to_end(usage_key)
+        for field, value in counts.items():
+            pending[field] += value
+        while len(self._pending) > self.max_keys:
+            self._pending.popitem(last=False)
+            self._dropped += 1
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if self.collection is None or not self._pending:
+            return
+        pending, self._pending = self._pending, OrderedDict()
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {"_id": f"{key}:{model_name}:{day}"},
+                {"$inc": dict(counts), "$set": {"key": key, "model": model_name, "day": day, "updated_at": now}},
+                upsert=True
+            )
+            for (key, model_name, day), counts in pending.items()
+        ]
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            # Keep the counts for the next flush
+            logger.warning(f"Could not write API usage: {str(e)}")
+            recorded, self._pending = self._pending, pending
+            for usage_key, counts in recorded.items():
+                self._add(usage_key, counts)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {"models": {model: {field: counts.get(field, 0) for field in USAGE_FIELDS}
+                           for model, counts in self._totals.items()},
+                "pending_keys": len(self._pending), "dropped_keys": self._dropped}
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import copy
+import hashlib
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+def make_cache_key(stage: str, payload: dict, prompt_version: int, model_name: str) -> str:
+    # Canonical JSON so key order and surrounding whitespace don't split entries
+    canonical = json.dumps(
+        {"stage": stage, "payload": payload, "prompt_version": prompt_version, "model": model_name},
+        sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# Two-tier cache for deterministic pipeline stages: an in-process LRU in front
+# of an optional Mongo collection shared between workers. Both tiers expire
+# entries after `ttl` seconds; Mongo relies on the TTL index on `expires_at`
+# declared in db_schema.
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 86400, collection=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.collection = collection
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "mongo_hits": 0, "misses": 0, "evictions": 0, "errors": 0}
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.monotonic() < entry[0]:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return copy.deepcopy(entry[1])
+            del self._entries[key]
+
+        if self.collection is not None:
+            try:
+                doc = await self.collection.find_one(
+                    {"_id": key, "expires_at": {"$gt": datetime.utcnow()}},
+                    {"value": 1, "expires_at": 1}
+                )
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning(f"Response cache lookup failed: {str(e)}")
+                doc = None
+            if doc is not None:
+                self._stats["mongo_hits"] += 1
+                remaining = (doc["expires_at"] - datetime.utcnow()).total_seconds()
+                self._remember(key, doc["value"], remaining)
+                return copy.deepcopy(doc["value"])
+
+        self._stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value):
+        self._remember(key, copy.deepcopy(value), self.ttl)
+        if self.collection is not None:
+            try:
+                await self.collection.replace_one(
+                    {"_id": key},
+                    {"_id": key, "value": value, "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl)},
+                    upsert=True
+                )
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning(f"Response cache write failed: {str(e)}")
+
+    def _remember(self, key: str, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        lookups = self._stats["hits"] + self._stats["mongo_hits"] + self._stats["misses"]
+        hit_rate = (self._stats["hits"] + self._stats["mongo_hits"]) / lookups if lookups else 0.0
+        return {"size": len(self._entries), "hit_rate": round(hit_rate, 4), **self._stats}
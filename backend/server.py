@@ -1,22 +1,43 @@
-
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Body
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Body, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Union
 import os
 import logging
 import uuid
 from datetime import datetime
 import json
-import google.generativeai as genai
+import asyncio
+import base64
+import hashlib
 from pathlib import Path
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+from gemini_client import (gemini_pool_stats, gemini_coalescing_stats, rate_limiters, usage_ledger,
+                           close_gemini_models, CLIENT_CLOSED_REQUEST)
+from model_router import model_router
+from response_cache import ResponseCache, make_cache_key
+from pipeline import PipelineJob, PipelineRegistry
+from database import Database
+from metrics import MetricsMiddleware, stats_collector, render_metrics, mark_process_dead
+from tracing import TracingMiddleware, exporter as span_exporter, span
+from job_queue import JobQueue
+from artifact_store import ArtifactStore
+from write_behind import WriteBehindBuffer
+from db_schema import apply_schema, index_usage
+from static_analyzer import static_analyzer
+from browser_audit import browser_auditor
+from site_bundler import SiteBundler, safe_path, content_type_for
+from structured_output import parse_structured_output, structured_output_stats, StructuredOutputError
+from prompts import (build_analysis_prompt, build_plan_prompt, build_file_prompt, build_test_prompt,
+                     build_deployment_prompt, build_command_prompt, plan_context_for_file)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,15 +45,102 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-try:
-    client = AsyncIOMotorClient(mongo_url)
-    db = client[os.environ.get('DB_NAME', 'website_builder')]
-    logger.info("Connected to MongoDB")
-except Exception as e:
-    logger.error(f"Failed to connect to MongoDB: {str(e)}")
-    raise
+# MongoDB connection; the client is created on startup (see connect_db)
+database = Database(os.environ['MONGO_URL'], os.environ.get('DB_NAME', 'website_builder'))
+db = None
+
+# Code generation fan-out: max files per plan, concurrent model calls per request
+# and per-file timeout in seconds
+MAX_GENERATED_FILES = int(os.environ.get('MAX_GENERATED_FILES', '5'))
+CODE_GEN_CONCURRENCY = int(os.environ.get('CODE_GEN_CONCURRENCY', '5'))
+CODE_GEN_FILE_TIMEOUT = float(os.environ.get('CODE_GEN_FILE_TIMEOUT', '120'))
+
+# Incremental regeneration: files whose plan entry is unchanged since the last
+# run for the same idea are reused instead of regenerated. Bump the prompt
+# version whenever the file prompt template changes so old files stop matching.
+INCREMENTAL_GENERATION = os.environ.get('INCREMENTAL_GENERATION', 'true').lower() == 'true'
+CODE_GEN_PROMPT_VERSION = 1
+
+# /api/test-website: the static analyzer covers markup and assets; scripts
+# also get a model review unless TEST_MODEL_REVIEW=false
+TEST_MODEL_REVIEW = os.environ.get('TEST_MODEL_REVIEW', 'true').lower() == 'true'
+MODEL_REVIEW_FILE_TYPES = ("javascript", "python")
+
+# /api/download-website archives and /api/preview assets. Built (minified,
+# precompressed) assets are cached in process by content hash.
+site_bundler = SiteBundler(max_cached_assets=int(os.environ.get('BUNDLE_CACHE_ASSETS', '512')))
+ARCHIVE_FORMATS = {
+    "zip": ("application/zip", site_bundler.stream_zip),
+    "tar.gz": ("application/gzip", site_bundler.stream_tar_gz),
+}
+
+# /api/status page sizes
+STATUS_PAGE_SIZE = int(os.environ.get('STATUS_PAGE_SIZE', '100'))
+STATUS_MAX_PAGE_SIZE = 1000
+
+# Seconds /api/readyz waits for a Mongo ping
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', '2'))
+
+# Response cache for deterministic stages; RESPONSE_CACHE_MONGO=true adds a
+# Mongo tier shared by all workers
+RESPONSE_CACHE_MONGO = os.environ.get('RESPONSE_CACHE_MONGO', 'false').lower() == 'true'
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('RESPONSE_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', '86400'))
+)
+
+# Pipeline jobs are kept in memory for PIPELINE_JOB_TTL seconds after finishing
+# and in Mongo for as long; workers that don't run a job poll Mongo for its
+# events every PIPELINE_POLL_INTERVAL seconds
+pipeline_jobs = PipelineRegistry(
+    ttl=float(os.environ.get('PIPELINE_JOB_TTL', '3600')),
+    poll_interval=float(os.environ.get('PIPELINE_POLL_INTERVAL', '0.5'))
+)
+
+# Background jobs: JOB_WORKERS concurrent jobs per process; a running job's
+# lease must be renewed within JOB_LEASE_SECONDS or another process recovers
+# it. Idle workers check Mongo for new jobs every JOB_POLL_INTERVAL seconds.
+job_queue = JobQueue(
+    None,
+    workers=int(os.environ.get('JOB_WORKERS', '4')),
+    lease_seconds=float(os.environ.get('JOB_LEASE_SECONDS', '60')),
+    poll_interval=float(os.environ.get('JOB_POLL_INTERVAL', '1'))
+)
+
+# Generated file bodies are stored once by content hash; bodies larger than
+# ARTIFACT_INLINE_MAX_BYTES after compression go to GridFS. Every
+# ARTIFACT_GC_INTERVAL seconds, artifacts no record refers to any more (their
+# records expired through MONGO_TTL_*) and unused for ARTIFACT_GC_GRACE
+# seconds are deleted.
+artifact_store = ArtifactStore(
+    None,
+    inline_max_bytes=int(os.environ.get('ARTIFACT_INLINE_MAX_BYTES', str(1024 * 1024))),
+    compress_min_bytes=int(os.environ.get('ARTIFACT_COMPRESS_MIN_BYTES', '1024')),
+    gc_interval=float(os.environ.get('ARTIFACT_GC_INTERVAL', '3600')),
+    gc_grace=float(os.environ.get('ARTIFACT_GC_GRACE', '86400'))
+)
+
+# Audit records (analyses, plans, generated code, test and deployment results,
+# GitHub pushes) are written behind the response in insert_many batches of up
+# to AUDIT_BATCH_SIZE, at least every AUDIT_FLUSH_INTERVAL seconds. Requests
+# block once AUDIT_MAX_QUEUED records are waiting.
+audit_writer = WriteBehindBuffer(
+    None,
+    batch_size=int(os.environ.get('AUDIT_BATCH_SIZE', '100')),
+    flush_interval=float(os.environ.get('AUDIT_FLUSH_INTERVAL', '0.5')),
+    max_queued=int(os.environ.get('AUDIT_MAX_QUEUED', '10000')),
+    max_retries=int(os.environ.get('AUDIT_MAX_RETRIES', '3'))
+)
+
+for name, stats in (("response_cache", response_cache.stats), ("artifacts", artifact_store.stats),
+                    ("audit_writer", audit_writer.stats), ("job_queue", job_queue.stats),
+                    ("mongo_pool", database.stats), ("gemini_pool", gemini_pool_stats),
+                    ("gemini_coalescing", gemini_coalescing_stats), ("structured_output", structured_output_stats),
+                    ("tracing", span_exporter.stats), ("static_analysis", static_analyzer.stats),
+                    ("browser_audit", browser_auditor.stats),
+                    ("site_bundler", site_bundler.stats),
+                    ("incremental_generation", lambda: dict(incremental_stats))):
+    stats_collector.add(name, stats)
 
 # Create the main app
 app = FastAPI(title="AI Website Builder API")
@@ -62,6 +170,7 @@ class WebsitePlan(BaseModel):
     idea: str
     plan: dict
     api_key: str
+    regenerate: bool = False
 
 class WebsiteFile(BaseModel):
     name: str
@@ -72,331 +181,896 @@ class WebsiteTestRequest(BaseModel):
     files: List[WebsiteFile]
     api_key: str
 
+class AuditRequest(BaseModel):
+    files: List[WebsiteFile]
+
+class DownloadRequest(BaseModel):
+    files: List[WebsiteFile]
+    format: str = "zip"
+    minify: bool = False
+    precompressed: bool = False
+
 class DeploymentRequest(BaseModel):
     files: List[WebsiteFile]
     test_results: dict
     api_key: str
 
-# Gemini API integration
-def get_gemini_client(api_key=None):
-    try:
-        # Use provided API key or fall back to environment variable
-        key_to_use = api_key or os.environ.get('GEMINI_API_KEY')
-        if not key_to_use:
-            raise ValueError("No API key provided or found in environment")
-        
-        genai.configure(api_key=key_to_use)
-        return genai
-    except Exception as e:
-        logger.error(f"Failed to initialize Gemini: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Invalid API key or Gemini API error: {str(e)}")
+# Structured outputs expected from Gemini for each JSON stage. Only the fields
+# later stages rely on are typed; anything extra the model adds is kept.
+# Loose fields carry the prompt's shape in their schema, which is sent as the
+# response schema on models that support one, without tightening validation.
+STRING_LIST_SCHEMA = {"type": "array", "items": {"type": "string"}}
+
+def shaped(default, **schema):
+    return Field(default, json_schema_extra=schema)
 
-# Helper function to run Gemini model
-async def generate_with_gemini(prompt: str, api_key: str = None, model_name: str = "gemini-pro"):
-    gemini = get_gemini_client(api_key)
+class StageResult(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+class AnalysisResult(StageResult):
+    website_type: str = ""
+    target_audience: str = ""
+    key_features: List[Any] = []
+    pages: List[Any] = []
+    technologies: Dict[str, Any] = shaped({}, properties={
+        "frontend": STRING_LIST_SCHEMA, "backend": STRING_LIST_SCHEMA, "database": STRING_LIST_SCHEMA})
+    design_suggestions: Dict[str, Any] = shaped({}, properties={
+        "color_scheme": STRING_LIST_SCHEMA, "layout": {"type": "string"}, "typography": {"type": "string"}})
+
+class PlannedFile(StageResult):
+    name: str
+    description: Optional[str] = ""
+
+class FileStructure(StageResult):
+    directories: List[Any] = []
+    files: List[PlannedFile]
+
+class PlanResult(StageResult):
+    file_structure: FileStructure
+    implementation_steps: List[Any] = []
+    data_models: List[Any] = shaped([], items={"type": "object", "properties": {
+        "name": {"type": "string"}, "fields": STRING_LIST_SCHEMA}})
+    api_endpoints: List[Any] = shaped([], items={"type": "object", "properties": {
+        "path": {"type": "string"}, "method": {"type": "string"}, "description": {"type": "string"}}})
+    third_party_integrations: List[Any] = shaped([], items={"type": "object", "properties": {
+        "name": {"type": "string"}, "purpose": {"type": "string"}}})
+
+class FileTestResult(StageResult):
+    file: str
+    issues: List[Any] = []
+    recommendations: List[Any] = []
+
+class TestReport(StageResult):
+    test_summary: str = ""
+    tests: List[FileTestResult] = []
+    performance_score: Optional[Union[int, float]] = None
+    accessibility_score: Optional[Union[int, float]] = None
+    best_practices_score: Optional[Union[int, float]] = None
+
+class DeploymentInfo(StageResult):
+    deployment_summary: str = ""
+    deployment_platforms: List[Any] = []
+    deployment_steps: List[Any] = []
+    required_environment_variables: List[Any] = []
+    estimated_deployment_time: str = ""
+    post_deployment_tasks: List[Any] = []
+
+class JobSubmission(BaseModel):
+    kind: str
+    payload: dict
+    priority: int = 0
+
+# Deterministic stages are cached on their normalized input; bump a stage's
+# version whenever its prompt template changes so stale entries stop matching
+PROMPT_VERSIONS = {
+    "analyze-idea": 2,
+    "plan-website": 2,
+    "test-website": 3,
+    "prepare-deployment": 2,
+}
+
+STAGE_RESULT_MODELS = {
+    "analyze-idea": AnalysisResult,
+    "plan-website": PlanResult,
+    "test-website": TestReport,
+    "prepare-deployment": DeploymentInfo,
+}
+
+def stage_cache_key(stage: str, payload: dict) -> str:
+    return make_cache_key(stage, payload, PROMPT_VERSIONS[stage], model_router.model_for(stage))
+
+async def generate_json_cached(stage: str, payload: dict, build_prompt, api_key: str,
+                               http_request: Request = None) -> dict:
+    cache_key = stage_cache_key(stage, payload)
+    with span("cache.get", stage=stage) as cache_span:
+        cached = await response_cache.get(cache_key)
+        cache_span.set(hit=cached is not None)
+    if cached is not None:
+        return cached
+    
+    async def ask(prompt: str) -> str:
+        return await model_router.generate(stage, prompt, api_key, http_request=http_request, json_mode=True,
+                                           response_model=STAGE_RESULT_MODELS[stage])
+    
+    with span("prompt.build", stage=stage) as prompt_span:
+        prompt = build_prompt()
+        prompt_span.set(prompt_chars=len(prompt))
+    response_text = await ask(prompt)
     try:
-        model = gemini.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        logger.error(f"Gemini API error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Gemini API error: {str(e)}")
+        with span("json.parse", stage=stage):
+            result = await parse_structured_output(response_text, STAGE_RESULT_MODELS[stage], reask=ask)
+    except StructuredOutputError:
+        raise HTTPException(status_code=500, detail="Failed to parse Gemini response")
+    
+    await response_cache.set(cache_key, result)
+    return result
 
 # Routes
 @api_router.get("/")
 async def root():
     return {"message": "AI Website Builder API"}
 
+# Liveness: the process is up and serving. Does not touch Mongo, so a
+# database outage doesn't get every worker restarted.
+@api_router.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+def config_problems() -> List[str]:
+    problems = []
+    if not database.url:
+        problems.append("MONGO_URL is empty")
+    for name, value in (("CODE_GEN_CONCURRENCY", CODE_GEN_CONCURRENCY), ("MAX_GENERATED_FILES", MAX_GENERATED_FILES),
+                        ("JOB_WORKERS", job_queue.workers)):
+        if value < 1:
+            problems.append(f"{name} must be at least 1")
+    return problems
+
+# Readiness: Mongo answers a ping within READINESS_TIMEOUT seconds, startup
+# finished and the configuration is usable
+@api_router.get("/readyz")
+async def readyz():
+    try:
+        mongo_ok = await asyncio.wait_for(database.ping(), READINESS_TIMEOUT)
+    except asyncio.TimeoutError:
+        mongo_ok = False
+    checks = {
+        "mongo": mongo_ok,
+        "audit_writer": audit_writer.stats()["running"],
+        "job_queue": job_queue.stats()["running"],
+        "config": config_problems() or True
+    }
+    ready = all(value is True for value in checks.values())
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={"status": "ready" if ready else "not ready", "checks": checks})
+
+# Prometheus text format; component stats are read at scrape time
+@api_router.get("/metrics")
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@api_router.get("/cache/stats")
+async def cache_stats():
+    return response_cache.stats()
+
+@api_router.get("/artifacts/stats")
+async def artifact_stats():
+    return artifact_store.stats()
+
+@api_router.get("/gemini/stats")
+async def gemini_stats():
+    return {
+        "client_pool": gemini_pool_stats(),
+        "coalescing": gemini_coalescing_stats(),
+        "structured_output": structured_output_stats(),
+        "routing": model_router.stats(),
+        "rate_limits": rate_limiters.stats(),
+        "usage": usage_ledger.stats()
+    }
+
+@api_router.get("/db/pool")
+async def db_pool():
+    await database.ping()
+    return database.stats()
+
+@api_router.get("/db/writes")
+async def db_writes():
+    return audit_writer.stats()
+
+@api_router.get("/db/indexes")
+async def db_indexes():
+    return await index_usage(db)
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    with span("db.insert", collection="status_checks"):
+        _ = await db.status_checks.insert_one(status_obj.dict())
     return status_obj
 
-@api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+def encode_status_cursor(status_check: dict) -> str:
+    raw = json.dumps([status_check["timestamp"].isoformat(), status_check["id"]])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
 
-@api_router.post("/analyze-idea")
-async def analyze_idea(request: WebsiteIdea):
-    prompt = f"""
-    You are an expert website analyzer. Analyze the following website idea and provide a detailed analysis.
-    Website idea: {request.idea}
-    
-    Provide a JSON response with the following structure:
-    {{
-        "website_type": "Type of website (e-commerce, blog, portfolio, etc.)",
-        "target_audience": "Description of target audience",
-        "key_features": ["Feature 1", "Feature 2", "Feature 3"],
-        "pages": ["Page 1", "Page 2", "Page 3"],
-        "technologies": {{
-            "frontend": ["Technology 1", "Technology 2"],
-            "backend": ["Technology 1", "Technology 2"],
-            "database": ["Technology 1"]
-        }},
-        "design_suggestions": {{
-            "color_scheme": ["Color 1", "Color 2"],
-            "layout": "Description of layout",
-            "typography": "Font suggestions"
-        }}
-    }}
-    
-    Return ONLY the JSON with no additional text.
-    """
-    
+def decode_status_cursor(cursor: str):
     try:
-        response_text = await generate_with_gemini(prompt, request.api_key)
-        analysis = json.loads(response_text)
-        
-        # Save to database
-        await db.website_analyses.insert_one({
-            "id": str(uuid.uuid4()),
-            "idea": request.idea,
-            "analysis": analysis,
-            "timestamp": datetime.utcnow()
-        })
-        
-        return {"analysis": analysis}
-    except json.JSONDecodeError:
-        logger.error(f"Invalid JSON response from Gemini: {response_text}")
-        raise HTTPException(status_code=500, detail="Failed to parse Gemini response")
+        timestamp, status_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(timestamp), status_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-@api_router.post("/plan-website")
-async def plan_website(request: WebsiteAnalysis):
-    analysis_json = json.dumps(request.analysis, indent=2)
-    
-    prompt = f"""
-    You are an expert website planner. Create a detailed plan for building a website based on the following idea and analysis.
-    
-    Website idea: {request.idea}
-    
-    Analysis: {analysis_json}
-    
-    Provide a JSON response with the following structure:
-    {{
-        "file_structure": {{
-            "directories": ["directory1", "directory2"],
-            "files": [
-                {{
-                    "name": "file1.html",
-                    "description": "Description of file1"
-                }},
-                {{
-                    "name": "file2.css",
-                    "description": "Description of file2"
-                }}
-            ]
-        }},
-        "implementation_steps": [
-            "Step 1: Description",
-            "Step 2: Description"
-        ],
-        "data_models": [
-            {{
-                "name": "Model name",
-                "fields": ["field1", "field2"]
-            }}
-        ],
-        "api_endpoints": [
-            {{
-                "path": "/api/endpoint",
-                "method": "GET/POST",
-                "description": "Description"
-            }}
-        ],
-        "third_party_integrations": [
-            {{
-                "name": "Integration name",
-                "purpose": "Purpose description"
-            }}
+# Newest first, paged by (timestamp, id) so each page is an index range scan
+# rather than a skip. The cursor for the next page is returned in the
+# X-Next-Cursor header so the body stays a plain list.
+@api_router.get("/status", response_model=List[StatusCheck])
+async def get_status_checks(
+    limit: int = Query(STATUS_PAGE_SIZE, ge=1, le=STATUS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    client_name: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    query = {}
+    if client_name:
+        query["client_name"] = client_name
+    if since or until:
+        query["timestamp"] = {}
+        if since:
+            query["timestamp"]["$gte"] = since
+        if until:
+            query["timestamp"]["$lt"] = until
+    if cursor:
+        timestamp, status_id = decode_status_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "id": {"$lt": status_id}}
         ]
-    }}
     
-    Return ONLY the JSON with no additional text.
-    """
+    status_checks = await db.status_checks.find(
+        query, {"_id": 0, "id": 1, "client_name": 1, "timestamp": 1}
+    ).sort([("timestamp", -1), ("id", -1)]).limit(limit).to_list(limit)
     
-    try:
-        response_text = await generate_with_gemini(prompt, request.api_key)
-        plan = json.loads(response_text)
-        
-        # Save to database
-        await db.website_plans.insert_one({
-            "id": str(uuid.uuid4()),
-            "idea": request.idea,
-            "analysis": request.analysis,
-            "plan": plan,
-            "timestamp": datetime.utcnow()
-        })
-        
-        return {"plan": plan}
-    except json.JSONDecodeError:
-        logger.error(f"Invalid JSON response from Gemini: {response_text}")
-        raise HTTPException(status_code=500, detail="Failed to parse Gemini response")
+    headers = {}
+    if len(status_checks) == limit:
+        headers["X-Next-Cursor"] = encode_status_cursor(status_checks[-1])
+    
+    # Documents already have exactly the StatusCheck fields; skip re-validation
+    for status_check in status_checks:
+        status_check["timestamp"] = status_check["timestamp"].isoformat()
+    return JSONResponse(content=status_checks, headers=headers)
 
-@api_router.post("/generate-code")
-async def generate_code(request: WebsitePlan):
-    plan_json = json.dumps(request.plan, indent=2)
+def idea_hash(idea: str) -> str:
+    # Case- and whitespace-insensitive, so retries of the same idea match
+    return hashlib.sha256(" ".join(idea.lower().split()).encode("utf-8")).hexdigest()
+
+def with_file_refs(record: dict, files: List[WebsiteFile]):
+    # Built at flush time so artifact writes stay off the request path
+    file_dicts = [file.dict() for file in files]
+    async def build() -> dict:
+        return {**record, "files": await artifact_store.put_files(file_dicts)}
+    return build
+
+async def save_analysis(idea: str, analysis: dict):
+    await audit_writer.enqueue("website_analyses", {
+        "id": str(uuid.uuid4()),
+        "idea": idea,
+        "idea_hash": idea_hash(idea),
+        "analysis": analysis,
+        "timestamp": datetime.utcnow()
+    })
+
+async def run_analyze_stage(idea: str, api_key: str, http_request: Request = None) -> dict:
+    analysis = await generate_json_cached(
+        "analyze-idea",
+        {"idea": idea.strip()},
+        lambda: build_analysis_prompt(idea),
+        api_key,
+        http_request=http_request
+    )
     
+    # Save to database
+    await save_analysis(idea, analysis)
+    return analysis
+
+@api_router.post("/analyze-idea")
+async def analyze_idea(request: WebsiteIdea, http_request: Request):
+    analysis = await run_analyze_stage(request.idea, request.api_key, http_request=http_request)
+    return {"analysis": analysis}
+
+async def save_plan(idea: str, analysis: dict, plan: dict):
+    await audit_writer.enqueue("website_plans", {
+        "id": str(uuid.uuid4()),
+        "idea": idea,
+        "idea_hash": idea_hash(idea),
+        "analysis": analysis,
+        "plan": plan,
+        "timestamp": datetime.utcnow()
+    })
+
+async def run_plan_stage(idea: str, analysis: dict, api_key: str, http_request: Request = None) -> dict:
+    plan = await generate_json_cached(
+        "plan-website",
+        {"idea": idea.strip(), "analysis": analysis},
+        lambda: build_plan_prompt(idea, analysis),
+        api_key,
+        http_request=http_request
+    )
+    
+    # Save to database
+    await save_plan(idea, analysis, plan)
+    return plan
+
+@api_router.post("/plan-website")
+async def plan_website(request: WebsiteAnalysis, http_request: Request):
+    plan = await run_plan_stage(request.idea, request.analysis, request.api_key, http_request=http_request)
+    return {"plan": plan}
+
+def get_file_type(file_name: str) -> str:
+    file_extension = file_name.split('.')[-1].lower()
+    return "html" if file_extension == "html" else \
+           "css" if file_extension == "css" else \
+           "javascript" if file_extension in ["js", "jsx"] else \
+           "python" if file_extension in ["py"] else \
+           "other"
+
+def strip_code_fences(content: str) -> str:
+    # Remove markdown code blocks if they exist
+    if content.startswith("```") and content.endswith("```"):
+        content = content[content.find('\n')+1:content.rfind('```')]
+    return content
+
+def list_plan_files(plan: dict) -> List[str]:
     # Generate a list of files to create based on the plan
     files_to_generate = []
-    for file_info in request.plan.get("file_structure", {}).get("files", []):
+    for file_info in plan.get("file_structure", {}).get("files", []):
         file_name = file_info.get("name", "")
         if file_name:
             files_to_generate.append(file_name)
+    return files_to_generate[:MAX_GENERATED_FILES]
+
+def plan_entry_fingerprint(plan: dict, file_name: str) -> str:
+    # Covers what the file's prompt sees beyond the shared file list and build
+    # steps: its own plan entry, directories and the script-only sections. A
+    # sibling being added or reworded doesn't invalidate it.
+    context = plan_context_for_file(plan, file_name, get_file_type(file_name))
+    entry = {key: value for key, value in context.items() if key not in ("files", "implementation_steps")}
+    return make_cache_key("generate-code", entry, CODE_GEN_PROMPT_VERSION, model_router.model_for("generate-code"))
+
+incremental_stats = {"runs": 0, "files_reused": 0, "files_generated": 0, "lookup_errors": 0}
+
+async def reusable_files(idea: str, plan: dict) -> Dict[str, WebsiteFile]:
+    # Files from the latest generated_code run for this idea whose plan entry
+    # fingerprint still matches; failed files were never saved, so they are
+    # always regenerated
+    with span("generate.reuse_lookup") as lookup:
+        try:
+            previous = await db.generated_code.find_one(
+                {"idea_hash": idea_hash(idea), "fingerprints": {"$exists": True}},
+                {"_id": 0, "files": 1, "fingerprints": 1},
+                sort=[("timestamp", -1)]
+            )
+            if previous is None:
+                return {}
+            fingerprints = {entry["name"]: entry["fingerprint"] for entry in previous["fingerprints"]}
+            planned = set(list_plan_files(plan))
+            refs = [
+                ref for ref in previous.get("files", [])
+                if ref["name"] in planned and fingerprints.get(ref["name"]) == plan_entry_fingerprint(plan, ref["name"])
+            ]
+            files = await artifact_store.get_files(refs)
+        except Exception as e:
+            incremental_stats["lookup_errors"] += 1
+            logger.warning(f"Could not load previous files, regenerating all: {str(e)}")
+            return {}
+        lookup.set(reused=len(files))
+        return {file["name"]: WebsiteFile(**file) for file in files}
+
+async def save_generated_code(idea: str, plan: dict, files: List[WebsiteFile]):
+    record = {
+        "id": str(uuid.uuid4()),
+        "idea": idea,
+        "idea_hash": idea_hash(idea),
+        "plan": plan,
+        # A list rather than a name-keyed dict: file names contain dots
+        "fingerprints": [{"name": file.name, "fingerprint": plan_entry_fingerprint(plan, file.name)}
+                         for file in files],
+        "timestamp": datetime.utcnow()
+    }
+    await audit_writer.enqueue("generated_code", with_file_refs(record, files))
+
+async def generate_file(file_name: str, idea: str, plan: dict, api_key: str,
+                        slots: asyncio.Semaphore, http_request: Request = None) -> Optional[WebsiteFile]:
+    with span("generate.file", file=file_name):
+        with span("prompt.build", file=file_name):
+            prompt = build_file_prompt(file_name, get_file_type(file_name), idea, plan)
     
-    # Generate code for each file
-    generated_files = []
-    
-    for file_name in files_to_generate[:5]:  # Limit to 5 files for demo
-        file_extension = file_name.split('.')[-1].lower()
-        file_type = "html" if file_extension == "html" else \
-                    "css" if file_extension == "css" else \
-                    "javascript" if file_extension in ["js", "jsx"] else \
-                    "python" if file_extension in ["py"] else \
-                    "other"
-        
-        prompt = f"""
-        You are an expert website developer. Generate code for the following file based on the website idea and plan.
-        
-        Website idea: {request.idea}
-        
-        Plan: {plan_json}
-        
-        File to generate: {file_name}
-        
-        Generate complete, working code for this file. Make sure the code is properly formatted and follows best practices.
-        Return ONLY the code with no additional text, explanations, or markdown formatting.
-        """
-        
         try:
-            content = await generate_with_gemini(prompt, request.api_key)
-            
-            # Remove markdown code blocks if they exist
-            if content.startswith("```") and content.endswith("```"):
-                content = content[content.find('\n')+1:content.rfind('```')]
-            
-            generated_files.append(WebsiteFile(
+            async with slots:
+                content = await model_router.generate("generate-code", prompt, api_key,
+                                                      http_request=http_request, timeout=CODE_GEN_FILE_TIMEOUT)
+            return WebsiteFile(
                 name=file_name,
-                content=content,
-                file_type=file_type
-            ))
-            
+                content=strip_code_fences(content),
+                file_type=get_file_type(file_name)
+            )
+        except HTTPException as e:
+            if e.status_code == CLIENT_CLOSED_REQUEST:
+                raise
+            logger.error(f"Error generating code for {file_name}: {str(e)}")
         except Exception as e:
             logger.error(f"Error generating code for {file_name}: {str(e)}")
+        return None
+
+async def run_generate_stage(idea: str, plan: dict, api_key: str, http_request: Request = None,
+                             on_file=None, regenerate: bool = False) -> List[WebsiteFile]:
+    reused = {} if regenerate or not INCREMENTAL_GENERATION else await reusable_files(idea, plan)
+    
+    async def generate_and_report(file_name: str, slots: asyncio.Semaphore) -> Optional[WebsiteFile]:
+        file = reused.get(file_name)
+        if file is None:
+            file = await generate_file(file_name, idea, plan, api_key, slots, http_request=http_request)
+        if file is not None and on_file is not None:
+            on_file(file)
+        return file
+    
+    # Generate code for each changed file concurrently; failed files are
+    # logged and skipped
+    file_names = list_plan_files(plan)
+    count_incremental_run(len(reused), len(file_names))
+    slots = asyncio.Semaphore(CODE_GEN_CONCURRENCY)
+    tasks = [
+        asyncio.ensure_future(generate_and_report(file_name, slots))
+        for file_name in file_names
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    generated_files = [file for file in results if file is not None]
     
     # Save to database
-    await db.generated_code.insert_one({
+    await save_generated_code(idea, plan, generated_files)
+    return generated_files
+
+def count_incremental_run(reused_count: int, planned_count: int):
+    incremental_stats["runs"] += 1
+    incremental_stats["files_reused"] += reused_count
+    incremental_stats["files_generated"] += planned_count - reused_count
+    if reused_count:
+        logger.info(f"Reusing {reused_count} of {planned_count} files from the previous run")
+
+@api_router.post("/generate-code")
+async def generate_code(request: WebsitePlan, http_request: Request):
+    generated_files = await run_generate_stage(request.idea, request.plan, request.api_key,
+                                               http_request=http_request, regenerate=request.regenerate)
+    return {"files": generated_files}
+
+# Streaming variants (server-sent events). Each pushes Gemini output to the
+# client as it arrives and finishes with a "result"/"done" or "error" event.
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def stream_json_stage(stage: str, payload: dict, prompt: str, api_key: str, result_key: str, save):
+    cache_key = stage_cache_key(stage, payload)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        await save(cached)
+        yield sse_event("result", {result_key: cached})
+        return
+    
+    parts = []
+    try:
+        response_model = STAGE_RESULT_MODELS[stage]
+        async for chunk in model_router.stream(stage, prompt, api_key, json_mode=True,
+                                               response_model=response_model):
+            parts.append(chunk)
+            yield sse_event("token", {"text": chunk})
+        with span("json.parse", stage=stage):
+            result = await parse_structured_output(
+                "".join(parts), response_model,
+                reask=lambda repair_prompt: model_router.generate(stage, repair_prompt, api_key, json_mode=True,
+                                                                  response_model=response_model)
+            )
+    except HTTPException as e:
+        yield sse_event("error", {"status": e.status_code, "detail": e.detail})
+        return
+    except StructuredOutputError:
+        yield sse_event("error", {"status": 500, "detail": "Failed to parse Gemini response"})
+        return
+    
+    await response_cache.set(cache_key, result)
+    await save(result)
+    yield sse_event("result", {result_key: result})
+
+@api_router.post("/analyze-idea/stream")
+async def analyze_idea_stream(request: WebsiteIdea):
+    async def save(analysis):
+        await save_analysis(request.idea, analysis)
+    
+    prompt = build_analysis_prompt(request.idea)
+    payload = {"idea": request.idea.strip()}
+    return StreamingResponse(stream_json_stage("analyze-idea", payload, prompt, request.api_key, "analysis", save),
+                             media_type="text/event-stream", headers=SSE_HEADERS)
+
+@api_router.post("/plan-website/stream")
+async def plan_website_stream(request: WebsiteAnalysis):
+    async def save(plan):
+        await save_plan(request.idea, request.analysis, plan)
+    
+    prompt = build_plan_prompt(request.idea, request.analysis)
+    payload = {"idea": request.idea.strip(), "analysis": request.analysis}
+    return StreamingResponse(stream_json_stage("plan-website", payload, prompt, request.api_key, "plan", save),
+                             media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def stream_generated_files(request: WebsitePlan):
+    slots = asyncio.Semaphore(CODE_GEN_CONCURRENCY)
+    events = asyncio.Queue()
+    reused = {}
+    if not request.regenerate and INCREMENTAL_GENERATION:
+        reused = await reusable_files(request.idea, request.plan)
+    
+    async def stream_file(file_name: str) -> Optional[WebsiteFile]:
+        if file_name in reused:
+            await events.put(sse_event("file", {**reused[file_name].dict(), "reused": True}))
+            return reused[file_name]
+        prompt = build_file_prompt(file_name, get_file_type(file_name), request.idea, request.plan)
+        parts = []
+        try:
+            async with slots:
+                await events.put(sse_event("file_start", {"name": file_name}))
+                async for chunk in model_router.stream("generate-code", prompt, request.api_key,
+                                                       timeout=CODE_GEN_FILE_TIMEOUT):
+                    parts.append(chunk)
+                    await events.put(sse_event("token", {"name": file_name, "text": chunk}))
+            file = WebsiteFile(
+                name=file_name,
+                content=strip_code_fences("".join(parts)),
+                file_type=get_file_type(file_name)
+            )
+            await events.put(sse_event("file", file.dict()))
+            return file
+        except Exception as e:
+            logger.error(f"Error generating code for {file_name}: {str(e)}")
+            await events.put(sse_event("file_error", {"name": file_name, "detail": str(e)}))
+            return None
+    
+    file_names = list_plan_files(request.plan)
+    count_incremental_run(len(reused), len(file_names))
+    tasks = [asyncio.ensure_future(stream_file(file_name)) for file_name in file_names]
+    all_done = asyncio.ensure_future(asyncio.gather(*tasks))
+    all_done.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield event
+        
+        generated_files = [file for file in all_done.result() if file is not None]
+        await save_generated_code(request.idea, request.plan, generated_files)
+        yield sse_event("done", {"files": [file.dict() for file in generated_files]})
+    finally:
+        # Client went away or the stream finished: stop any outstanding model calls
+        all_done.cancel()
+
+@api_router.post("/generate-code/stream")
+async def generate_code_stream(request: WebsitePlan):
+    return StreamingResponse(stream_generated_files(request),
+                             media_type="text/event-stream", headers=SSE_HEADERS)
+
+async def save_test_results(files: List[WebsiteFile], test_results: dict):
+    record = {
         "id": str(uuid.uuid4()),
-        "idea": request.idea,
-        "plan": request.plan,
-        "files": [file.dict() for file in generated_files],
+        "test_results": test_results,
         "timestamp": datetime.utcnow()
-    })
+    }
+    await audit_writer.enqueue("test_results", with_file_refs(record, files))
+
+def merge_model_review(test_results: dict, review: dict):
+    tests = {test["file"]: test for test in test_results["tests"]}
+    for reviewed in review.get("tests", []):
+        if not isinstance(reviewed, dict):
+            continue
+        test = tests.get(reviewed.get("file"))
+        if test is None:
+            test = {"file": reviewed.get("file", ""), "issues": [], "recommendations": []}
+            test_results["tests"].append(test)
+            tests[test["file"]] = test
+        for field in ("issues", "recommendations"):
+            test[field] = list(dict.fromkeys(test[field] + list(reviewed.get(field) or [])))
+    if review.get("test_summary"):
+        test_results["test_summary"] = f"{test_results['test_summary']} {review['test_summary']}"
+
+def merge_browser_audit(test_results: dict, audit: dict):
+    # Measured performance replaces the static estimate; runtime errors cost
+    # best-practices points and are listed against their page
+    test_results["browser_audit"] = audit
+    if "performance_score" not in audit:
+        return
+    test_results["performance_score"] = audit["performance_score"]
+    test_results["best_practices_score"] = max(0, test_results["best_practices_score"] - audit["best_practices_penalty"])
+    tests = {test["file"]: test for test in test_results["tests"]}
+    for page in audit["pages"]:
+        test = tests.get(page["page"])
+        if test is not None:
+            test["issues"] += [f"Console error: {text}" for text in page.get("console_errors", [])]
+
+async def run_model_review(file_dicts: list, test_results: dict, api_key: str, http_request: Request = None):
+    # Only script files go to the model, along with what the analyzer already found
+    scripts = [file for file in file_dicts if file["file_type"] in MODEL_REVIEW_FILE_TYPES]
+    if not (TEST_MODEL_REVIEW and scripts):
+        return None
+    script_names = {file["name"] for file in scripts}
+    known_findings = [f"{test['file']}: {issue}" for test in test_results["tests"]
+                      if test["file"] in script_names for issue in test["issues"]]
+    return await generate_json_cached(
+        "test-website",
+        {"files": scripts, "known_findings": known_findings},
+        lambda: build_test_prompt(scripts, known_findings),
+        api_key,
+        http_request=http_request
+    )
+
+async def run_browser_audit(file_dicts: list) -> dict:
+    with span("test.browser_audit", files=len(file_dicts)) as audit_span:
+        audit = await browser_auditor.audit(file_dicts)
+        audit_span.set(available=audit["available"])
+    return audit
+
+async def run_test_stage(files: List[WebsiteFile], api_key: str, http_request: Request = None) -> dict:
+    # Deterministic checks and scores are computed locally, performance is
+    # measured in a browser, and the model reviews scripts in parallel
+    file_dicts = [file.dict() for file in files]
+    with span("test.static_analysis", files=len(file_dicts)) as analysis_span:
+        # CPU-bound: compiling or parsing large files would block the loop
+        test_results = await asyncio.to_thread(static_analyzer.analyze, file_dicts)
+        analysis_span.set(findings=len(test_results["static_analysis"]["findings"]))
     
-    return {"files": generated_files}
+    review, audit = await asyncio.gather(
+        run_model_review(file_dicts, test_results, api_key, http_request=http_request),
+        run_browser_audit(file_dicts)
+    )
+    if review is not None:
+        merge_model_review(test_results, review)
+    merge_browser_audit(test_results, audit)
+    
+    # Save to database
+    await save_test_results(files, test_results)
+    return test_results
+
+@api_router.post("/audit-website")
+async def audit_website(request: AuditRequest):
+    return {"audit": await run_browser_audit([file.dict() for file in request.files])}
 
 @api_router.post("/test-website")
-async def test_website(request: WebsiteTestRequest):
-    files_json = json.dumps([file.dict() for file in request.files], indent=2)
-    
-    prompt = f"""
-    You are an expert website tester. Test the following website files and provide a detailed test report.
-    
-    Files:
-    {files_json}
-    
-    Provide a JSON response with the following structure:
-    {{
-        "test_summary": "Overall test summary",
-        "tests": [
-            {{
-                "file": "filename.ext",
-                "issues": ["Issue 1", "Issue 2"],
-                "recommendations": ["Recommendation 1", "Recommendation 2"]
-            }}
-        ],
-        "performance_score": 85,
-        "accessibility_score": 90,
-        "best_practices_score": 88
-    }}
-    
-    Return ONLY the JSON with no additional text.
-    """
+async def test_website(request: WebsiteTestRequest, http_request: Request):
+    test_results = await run_test_stage(request.files, request.api_key, http_request=http_request)
+    return {"test_results": test_results}
+
+async def save_deployment_info(files: List[WebsiteFile], test_results: dict, deployment_info: dict) -> str:
+    record = {
+        "id": str(uuid.uuid4()),
+        "test_results": test_results,
+        "deployment_info": deployment_info,
+        "timestamp": datetime.utcnow()
+    }
+    # Written through rather than queued: the returned id backs the download
+    # and preview links, which must resolve as soon as the client has them
+    document = await with_file_refs(record, files)()
+    with span("db.insert", collection="deployment_info"):
+        await db.deployment_info.insert_one(document)
+    return record["id"]
+
+def deployment_links(deployment_id: str, files: List[WebsiteFile]) -> dict:
+    pages = [file.name for file in files if file.file_type == "html"]
+    entry = "index.html" if "index.html" in pages else (pages[0] if pages else None)
+    return {
+        "download_url": f"/api/download-website?id={deployment_id}",
+        "preview_url": f"/api/preview/{deployment_id}/{entry}" if entry else None
+    }
+
+async def run_deploy_stage(files: List[WebsiteFile], test_results: dict, api_key: str,
+                           http_request: Request = None) -> dict:
+    deployment_info = await generate_json_cached(
+        "prepare-deployment",
+        {"files": [file.dict() for file in files], "test_results": test_results},
+        lambda: build_deployment_prompt([file.dict() for file in files], test_results),
+        api_key,
+        http_request=http_request
+    )
     
-    try:
-        response_text = await generate_with_gemini(prompt, request.api_key)
-        test_results = json.loads(response_text)
-        
-        # Save to database
-        await db.test_results.insert_one({
-            "id": str(uuid.uuid4()),
-            "files": [file.dict() for file in request.files],
-            "test_results": test_results,
-            "timestamp": datetime.utcnow()
-        })
-        
-        return {"test_results": test_results}
-    except json.JSONDecodeError:
-        logger.error(f"Invalid JSON response from Gemini: {response_text}")
-        raise HTTPException(status_code=500, detail="Failed to parse Gemini response")
+    # Save to database; the record id addresses the download and preview
+    deployment_id = await save_deployment_info(files, test_results, deployment_info)
+    return {"deployment_info": deployment_info, **deployment_links(deployment_id, files)}
 
 @api_router.post("/prepare-deployment")
-async def prepare_deployment(request: DeploymentRequest):
-    files_json = json.dumps([file.dict() for file in request.files], indent=2)
-    test_results_json = json.dumps(request.test_results, indent=2)
-    
-    prompt = f"""
-    You are an expert website deployer. Prepare the following website for deployment and provide deployment instructions.
-    
-    Files:
-    {files_json}
-    
-    Test Results:
-    {test_results_json}
-    
-    Provide a JSON response with the following structure:
-    {{
-        "deployment_summary": "Summary of deployment readiness",
-        "deployment_platforms": ["Platform 1", "Platform 2"],
-        "deployment_steps": [
-            "Step 1: Description",
-            "Step 2: Description"
-        ],
-        "required_environment_variables": ["VAR1", "VAR2"],
-        "estimated_deployment_time": "X minutes",
-        "post_deployment_tasks": ["Task 1", "Task 2"]
-    }}
-    
-    Return ONLY the JSON with no additional text.
-    """
+async def prepare_deployment(request: DeploymentRequest, http_request: Request):
+    return await run_deploy_stage(request.files, request.test_results, request.api_key,
+                                  http_request=http_request)
+
+async def load_record_refs(record_id: str) -> list:
+    # File refs of a deployment or generated_code record
+    for collection_name in ("deployment_info", "generated_code"):
+        record = await db[collection_name].find_one({"id": record_id}, {"_id": 0, "files": 1})
+        if record is not None:
+            return record.get("files", [])
+    raise HTTPException(status_code=404, detail="Unknown deployment or generation id")
+
+async def load_ref_files(refs: list) -> list:
+    # Records written before the artifact store hold their files inline
+    stored = [ref for ref in refs if "sha256" in ref]
+    return [ref for ref in refs if "content" in ref] + await artifact_store.get_files(stored)
+
+async def archive_response(files: list, archive_format: str, minify: bool, precompressed: bool):
+    if archive_format not in ARCHIVE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(ARCHIVE_FORMATS)}")
+    if not any(safe_path(file["name"]) for file in files):
+        raise HTTPException(status_code=400, detail="No files to bundle")
+    media_type, stream = ARCHIVE_FORMATS[archive_format]
+    # The archive is built and produced member by member as the client reads
+    # it; Starlette iterates the synchronous generator in a worker thread
+    return StreamingResponse(
+        stream(files, minify=minify, precompressed=precompressed),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="website.{archive_format}"'}
+    )
+
+@api_router.get("/download-website")
+async def download_website(record_id: str = Query(..., alias="id"), format: str = "zip",
+                           minify: bool = False, precompressed: bool = False):
+    files = await load_ref_files(await load_record_refs(record_id))
+    return await archive_response(files, format, minify, precompressed)
+
+@api_router.post("/download-website")
+async def download_website_files(request: DownloadRequest):
+    return await archive_response([file.dict() for file in request.files], request.format,
+                                  request.minify, request.precompressed)
+
+PREVIEW_CSP = "sandbox allow-scripts"
+
+@api_router.get("/preview/{record_id}/{path:path}")
+async def preview_website(record_id: str, path: str, http_request: Request, minify: bool = True):
+    # Serves one file of a stored site, minified and in the best precompressed
+    # encoding the client accepts. Records never change, so assets are cached
+    # for good and revalidated by ETag.
+    wanted = safe_path(path or "index.html")
+    ref = next((ref for ref in await load_record_refs(record_id) if safe_path(ref["name"]) == wanted), None)
+    if ref is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    file = (await load_ref_files([ref]))[0]
+    asset = await asyncio.to_thread(site_bundler.build, file["name"], file["content"], minify, True)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="File not found")
     
+    # Generated code runs in an opaque origin: no access to this origin's
+    # storage (the user's API key) or cookies, and no same-origin API calls
+    headers = {"ETag": f'"{asset.etag}"', "Vary": "Accept-Encoding",
+               "Cache-Control": "public, max-age=31536000, immutable",
+               "Content-Security-Policy": PREVIEW_CSP}
+    if http_request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    body, encoding = asset.variant(http_request.headers.get("accept-encoding"))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=content_type_for(asset.path), headers=headers)
+
+# End-to-end pipeline: runs every stage server-side so the client makes one
+# request instead of five and never re-uploads intermediate artifacts
+def build_pipeline_stages(idea: str, api_key: str):
+    async def analyze(artifacts, publish):
+        return {"analysis": await run_analyze_stage(idea, api_key)}
+    
+    async def plan(artifacts, publish):
+        return {"plan": await run_plan_stage(idea, artifacts["analysis"], api_key)}
+    
+    async def generate(artifacts, publish):
+        files = await run_generate_stage(idea, artifacts["plan"], api_key,
+                                         on_file=lambda file: publish("file", file.dict()))
+        return {"files": [file.dict() for file in files]}
+    
+    async def test(artifacts, publish):
+        files = [WebsiteFile(**file) for file in artifacts["files"]]
+        return {"test_results": await run_test_stage(files, api_key)}
+    
+    async def deploy(artifacts, publish):
+        files = [WebsiteFile(**file) for file in artifacts["files"]]
+        return await run_deploy_stage(files, artifacts["test_results"], api_key)
+    
+    return [("analyze", analyze), ("plan", plan), ("generate", generate), ("test", test), ("deploy", deploy)]
+
+@api_router.post("/pipeline")
+async def start_pipeline(request: WebsiteIdea):
+    if not request.idea.strip():
+        raise HTTPException(status_code=400, detail="Idea is required")
+    
+    stages = build_pipeline_stages(request.idea, request.api_key)
+    job = await pipeline_jobs.start(PipelineJob(request.idea, [name for name, _ in stages]), stages)
+    return {"job_id": job.id, "status": job.status}
+
+@api_router.get("/pipeline/{job_id}")
+async def get_pipeline(job_id: str):
+    return await pipeline_jobs.snapshot(job_id)
+
+@api_router.get("/pipeline/{job_id}/events")
+async def stream_pipeline(job_id: str):
+    job_events = await pipeline_jobs.events(job_id)
+    
+    async def events():
+        async for event, data in job_events:
+            yield sse_event(event, data)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# Background jobs: every pipeline stage (and the full pipeline) can run on the
+# job queue instead of inline in the request
+async def run_pipeline_job(request: WebsiteIdea, report) -> dict:
+    stages = build_pipeline_stages(request.idea, request.api_key)
+    artifacts = {}
+    for index, (name, run_stage) in enumerate(stages):
+        await report(stage=name, progress=int(100 * index / len(stages)))
+        artifacts.update(await run_stage(dict(artifacts), lambda event, data: None))
+    return artifacts
+
+async def run_generate_job(request: WebsitePlan, report) -> dict:
+    files = await run_generate_stage(request.idea, request.plan, request.api_key,
+                                     regenerate=request.regenerate)
+    return {"files": [file.dict() for file in files]}
+
+JOB_KINDS = {
+    "pipeline": (WebsiteIdea, run_pipeline_job),
+    "analyze-idea": (WebsiteIdea, lambda request, report: run_analyze_stage(request.idea, request.api_key)),
+    "plan-website": (WebsiteAnalysis, lambda request, report: run_plan_stage(request.idea, request.analysis, request.api_key)),
+    "generate-code": (WebsitePlan, run_generate_job),
+    "test-website": (WebsiteTestRequest, lambda request, report: run_test_stage(request.files, request.api_key)),
+    "prepare-deployment": (DeploymentRequest, lambda request, report: run_deploy_stage(request.files, request.test_results, request.api_key)),
+}
+
+def register_job_kinds():
+    for kind, (model, handler) in JOB_KINDS.items():
+        async def run(payload, report, model=model, handler=handler):
+            # Jobs submitted without an API key use GEMINI_API_KEY; jobs with
+            # one only run where it is held (see JobQueue)
+            request = model(**{"api_key": "", **payload})
+            return await handler(request, report)
+        job_queue.register(kind, run)
+
+register_job_kinds()
+
+@api_router.post("/jobs")
+async def submit_job(submission: JobSubmission):
+    if submission.kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind: {submission.kind}")
+    model, _ = JOB_KINDS[submission.kind]
     try:
-        response_text = await generate_with_gemini(prompt, request.api_key)
-        deployment_info = json.loads(response_text)
-        
-        # Save to database
-        await db.deployment_info.insert_one({
-            "id": str(uuid.uuid4()),
-            "files": [file.dict() for file in request.files],
-            "test_results": request.test_results,
-            "deployment_info": deployment_info,
-            "timestamp": datetime.utcnow()
-        })
-        
-        # Normally, we would handle actual deployment here, but for this demo, we'll just return the info
-        return {
-            "deployment_info": deployment_info,
-            "download_url": "/api/download-website",  # This would be a real URL in production
-            "preview_url": None  # This would be a real preview URL in production
-        }
-    except json.JSONDecodeError:
-        logger.error(f"Invalid JSON response from Gemini: {response_text}")
-        raise HTTPException(status_code=500, detail="Failed to parse Gemini response")
+        request = model(**submission.payload)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    
+    payload = request.dict()
+    api_key = payload.pop("api_key")
+    secrets = {"api_key": api_key} if api_key else None
+    return await job_queue.submit(submission.kind, payload, priority=submission.priority, secrets=secrets)
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return await job_queue.get(job_id)
+
+@api_router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    return {"job_id": job_id, "result": await job_queue.result(job_id)}
+
+@api_router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    return await job_queue.cancel(job_id)
 
 @api_router.post("/execute-command")
-async def execute_command(request: dict = Body(...)):
+async def execute_command(http_request: Request, request: dict = Body(...)):
     command = request.get("command", "")
     api_key = request.get("api_key", None)
     
@@ -408,16 +1082,9 @@ async def execute_command(request: dict = Body(...)):
         # In a real application, you'd need proper sandboxing
         
         # Simulate commands with AI
-        prompt = f"""
-        You are a terminal assistant in an AI website builder application.
-        The user has entered the following command: {command}
+        prompt = build_command_prompt(command)
         
-        Provide a simulated terminal output for this command.
-        Make it realistic and appropriate for a web development context.
-        Keep the output concise (max 10 lines).
-        """
-        
-        output = await generate_with_gemini(prompt, api_key)
+        output = await model_router.generate("execute-command", prompt, api_key, http_request=http_request)
         
         # Clean up output
         output = output.strip()
@@ -448,7 +1115,7 @@ async def push_to_github(request: dict = Body(...)):
         repo_url = f"https://github.com/{username}/{repo}"
         
         # Save to database for reference
-        await db.github_pushes.insert_one({
+        await audit_writer.enqueue("github_pushes", {
             "id": str(uuid.uuid4()),
             "username": username,
             "repo": repo,
@@ -470,17 +1137,68 @@ async def push_to_github(request: dict = Body(...)):
 app.include_router(api_router)
 
 # Configure CORS
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Response headers the frontend reads cross-origin
+    expose_headers=["X-Next-Cursor", "X-Run-Id"],
 )
 
+def bind_database(database_handle):
+    # Components are created at import without a database and get their
+    # collections here, once the client exists
+    global db
+    db = database_handle
+    response_cache.collection = db.response_cache if RESPONSE_CACHE_MONGO else None
+    job_queue.collection = db.jobs
+    pipeline_jobs.collection = db.pipeline_jobs
+    pipeline_jobs.events_collection = db.pipeline_events
+    pipeline_jobs.artifact_store = artifact_store
+    artifact_store.collection = db.artifacts
+    artifact_store.bucket = AsyncIOMotorGridFSBucket(db, bucket_name="artifacts")
+    artifact_store.referencing = [db.generated_code, db.test_results, db.deployment_info]
+    audit_writer.db = db
+    usage_ledger.collection = db.api_usage
+
+# Startup event
+@app.on_event("startup")
+async def connect_db():
+    bind_database(await database.connect())
+    try:
+        await apply_schema(db)
+    except Exception as e:
+        logger.warning(f"Could not apply database indexes: {str(e)}")
+
+@app.on_event("startup")
+async def start_background_writers():
+    await audit_writer.start()
+    await span_exporter.start()
+    await usage_ledger.start()
+    await artifact_store.start()
+
+@app.on_event("startup")
+async def start_job_queue():
+    try:
+        await job_queue.start()
+    except Exception as e:
+        logger.error(f"Could not start job queue: {str(e)}")
+
 # Shutdown event
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
-    logger.info("MongoDB connection closed")
+    await job_queue.stop()
+    await pipeline_jobs.stop()
+    await audit_writer.stop(timeout=float(os.environ.get('AUDIT_DRAIN_TIMEOUT', '10')))
+    await usage_ledger.stop()
+    await close_gemini_models()
+    await artifact_store.stop()
+    await browser_auditor.pool.close()
+    database.close()
+    await span_exporter.stop()
+    mark_process_dead()
       
\ No newline at end of file
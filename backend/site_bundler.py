@@ -0,0 +1,225 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import io
+import logging
+import posixpath
+import re
+import tarfile
+import time
+import zipfile
+
+import brotli
+
+logger = logging.getLogger(__name__)
+
+# Builds downloadable archives and preview assets from generated files.
+# Assets are optionally minified and precompressed (gzip and brotli); built
+# assets are cached by content hash, so a site is only minified and
+# compressed once however often it is previewed or downloaded.
+COMPRESSIBLE_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".htm": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".js": "application/javascript; charset=utf-8",
+    ".jsx": "application/javascript; charset=utf-8",
+    ".mjs": "application/javascript; charset=utf-8",
+    ".json": "application/json; charset=utf-8",
+    ".svg": "image/svg+xml",
+    ".txt": "text/plain; charset=utf-8",
+    ".md": "text/markdown; charset=utf-8",
+    ".xml": "application/xml; charset=utf-8",
+    ".py": "text/x-python; charset=utf-8",
+}
+# Below this, compressed variants are barely smaller than the original
+PRECOMPRESS_MIN_BYTES = 256
+ARCHIVE_CHUNK_BYTES = 64 * 1024
+ARCHIVE_ROOT = "website"
+
+_HTML_COMMENT_RE = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+_HTML_RAW_BLOCK_RE = re.compile(r"(<(pre|textarea|script|style)\b.*?</\2\s*>)", re.DOTALL | re.IGNORECASE)
+_HTML_GAP_RE = re.compile(r">\s+<")
+_WHITESPACE_RE = re.compile(r"\s+")
+# Strings first, so comment markers and whitespace inside them are kept
+_CSS_STRING_OR_COMMENT_RE = re.compile(r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')|/\*.*?\*/", re.DOTALL)
+# Not ":" — "a :hover" and "a:hover" are different selectors
+_CSS_PUNCTUATION_RE = re.compile(r"\s*([{};,>])\s*")
+
+def minify_html(content: str) -> str:
+    # Drops comments and collapses whitespace between tags; <pre>, <textarea>,
+    # <script> and <style> bodies are left alone
+    parts = _HTML_RAW_BLOCK_RE.split(_HTML_COMMENT_RE.sub("", content))
+    minified = []
+    # split() yields text, block, tag name, text, block, tag name, ...
+    for index, part in enumerate(parts):
+        if index % 3 == 0:
+            minified.append(_WHITESPACE_RE.sub(" ", _HTML_GAP_RE.sub("> <", part)))
+        elif index % 3 == 1:
+            minified.append(part)
+    return "".join(minified).strip()
+
+def _minify_css_code(css: str) -> str:
+    return _CSS_PUNCTUATION_RE.sub(r"\1", _WHITESPACE_RE.sub(" ", css)).replace(";}", "}")
+
+def minify_css(content: str) -> str:
+    # Drops comments and collapses whitespace outside strings
+    minified = []
+    position = 0
+    for match in _CSS_STRING_OR_COMMENT_RE.finditer(content):
+        minified.append(_minify_css_code(content[position:match.start()]))
+        minified.append(match.group(1) or "")
+        position = match.end()
+    minified.append(_minify_css_code(content[position:]))
+    return "".join(minified).strip()
+
+# JavaScript is never minified: without a real tokenizer, stripping comments
+# or whitespace breaks strings, template literals and regex literals. Scripts
+# are still precompressed, which recovers most of the size.
+MINIFIERS = {".html": minify_html, ".htm": minify_html, ".css": minify_css}
+
+def safe_path(name: str):
+    # Archive member path for a generated file name, normalized under the
+    # archive root so ".." can't climb out of it; None for empty names
+    path = posixpath.normpath("/" + name.replace("\\", "/")).lstrip("/")
+    return path or None
+
+def content_type_for(path: str) -> str:
+    return COMPRESSIBLE_TYPES.get(posixpath.splitext(path)[1].lower(), "application/octet-stream")
+
+class BuiltAsset:
+    __slots__ = ("path", "body", "gzip", "br", "etag")
+
+    def __init__(self, path: str, body: bytes, gzip_body: bytes = None, br_body: bytes = None):
+        self.path = path
+        self.body = body
+        self.gzip = gzip_body
+        self.br = br_body
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+
+    def variant(self, accept_encoding: str):
+        # (body, content-encoding) for the best encoding the client accepts
+        accepted = {token.split(";")[0].strip() for token in (accept_encoding or "").lower().split(",")}
+        if self.br is not None and "br" in accepted:
+            return self.br, "br"
+        if self.gzip is not None and "gzip" in accepted:
+            return self.gzip, "gzip"
+        return self.body, None
+
+class _ChunkWriter(io.RawIOBase):
+    # Unseekable sink for zipfile/tarfile; archives are written in streaming
+    # mode and drained chunk by chunk
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+class SiteBundler:
+    def __init__(self, max_cached_assets: int = 512, gzip_level: int = 9, brotli_quality: int = 11):
+        self.max_cached_assets = max_cached_assets
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._assets = OrderedDict()
+        self._stats = {"builds": 0, "cache_hits": 0, "bytes_in": 0, "bytes_minified": 0,
+                       "bytes_gzip": 0, "bytes_br": 0, "archives": 0, "build_ms": 0.0}
+
+    def build(self, name: str, content: str, minify: bool = False, precompress: bool = True):
+        # -> BuiltAsset, or None if the name is not a safe relative path
+        path = safe_path(name)
+        if path is None:
+            return None
+        key = (hashlib.sha256(content.encode("utf-8")).hexdigest(), path, minify, precompress)
+        asset = self._assets.get(key)
+        if asset is not None:
+            self._assets.move_to_end(key)
+            self._stats["cache_hits"] += 1
+            return asset
+
+        started = time.perf_counter()
+        extension = posixpath.splitext(path)[1].lower()
+        text = content
+        if minify and extension in MINIFIERS:
+            try:
+                text = MINIFIERS[extension](content)
+            except Exception as e:
+                logger.warning(f"Could not minify {path}, keeping it as is: {str(e)}")
+        body = text.encode("utf-8")
+        gzip_body = br_body = None
+        if precompress and extension in COMPRESSIBLE_TYPES and len(body) >= PRECOMPRESS_MIN_BYTES:
+            gzip_body = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+            br_body = brotli.compress(body, quality=self.brotli_quality)
+            self._stats["bytes_gzip"] += len(gzip_body)
+            self._stats["bytes_br"] += len(br_body)
+        asset = BuiltAsset(path, body, gzip_body, br_body)
+
+        self._stats["builds"] += 1
+        self._stats["bytes_in"] += len(content.encode("utf-8"))
+        self._stats["bytes_minified"] += len(body)
+        self._stats["build_ms"] += (time.perf_counter() - started) * 1000
+        self._assets[key] = asset
+        while len(self._assets) > self.max_cached_assets:
+            self._assets.popitem(last=False)
+        return asset
+
+    def build_site(self, files: list, minify: bool = False, precompress: bool = True):
+        # files: [{name, content, ...}] -> BuiltAssets, each built only when
+        # the caller reaches it; unsafe names are skipped
+        for file in files:
+            asset = self.build(file["name"], file["content"], minify, precompress)
+            if asset is None:
+                logger.warning(f"Skipping unsafe file name in bundle: {file['name']!r}")
+                continue
+            yield asset
+
+    def _members(self, assets, include_precompressed: bool):
+        # (archive path, bytes) including .gz/.br siblings, as served by
+        # nginx gzip_static/brotli_static
+        for asset in assets:
+            yield f"{ARCHIVE_ROOT}/{asset.path}", asset.body
+            if include_precompressed and asset.gzip is not None:
+                yield f"{ARCHIVE_ROOT}/{asset.path}.gz", asset.gzip
+                yield f"{ARCHIVE_ROOT}/{asset.path}.br", asset.br
+
+    def stream_zip(self, files: list, minify: bool = False, precompressed: bool = False):
+        # Synchronous generator of archive chunks. Each file is built (and
+        # minified and precompressed) when the archive reaches it, so only the
+        # current member is held in memory and the first bytes go out before
+        # the rest of the site is built. Already-compressed members are
+        # stored, not deflated again.
+        self._stats["archives"] += 1
+        sink = _ChunkWriter()
+        with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for path, data in self._members(self.build_site(files, minify, precompressed), precompressed):
+                info = zipfile.ZipInfo(path, date_time=(1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_STORED if path.endswith((".gz", ".br")) else zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                archive.writestr(info, data)
+                yield from self._chunks(sink.drain())
+        yield from self._chunks(sink.drain())
+
+    def stream_tar_gz(self, files: list, minify: bool = False, precompressed: bool = False):
+        self._stats["archives"] += 1
+        sink = _ChunkWriter()
+        with tarfile.open(fileobj=sink, mode="w|gz") as archive:
+            for path, data in self._members(self.build_site(files, minify, precompressed), precompressed):
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                info.mode = 0o644
+                archive.addfile(info, io.BytesIO(data))
+                yield from self._chunks(sink.drain())
+        yield from self._chunks(sink.drain())
+
+    def _chunks(self, data: bytes):
+        for start in range(0, len(data), ARCHIVE_CHUNK_BYTES):
+            yield data[start:start + ARCHIVE_CHUNK_BYTES]
+
+    def stats(self) -> dict:
+        return {**self._stats, "build_ms": round(self._stats["build_ms"], 2), "cached_assets": len(self._assets)}
@@ -0,0 +1,376 @@
+from collections import Counter
+from html.parser import HTMLParser
+import os
+import posixpath
+import re
+import threading
+import time
+
+# Deterministic checks for generated sites, run locally before (and mostly
+# instead of) the model review in /api/test-website. Each finding belongs to
+# one score category and costs its weight for each occurrence, up to
+# MAX_COUNTED_OCCURRENCES per check and file; scores start at 100.
+INLINE_ASSET_MAX_BYTES = int(os.environ.get('STATIC_INLINE_ASSET_MAX_BYTES', '4096'))
+MINIFY_MIN_BYTES = int(os.environ.get('STATIC_MINIFY_MIN_BYTES', '2048'))
+CSS_MAX_SELECTORS = int(os.environ.get('STATIC_CSS_MAX_SELECTORS', '400'))
+CSS_MAX_IMPORTANT = 10
+# Python files are compiled to find syntax errors; larger ones are skipped
+PYTHON_MAX_BYTES = int(os.environ.get('STATIC_PYTHON_MAX_BYTES', str(256 * 1024)))
+MAX_COUNTED_OCCURRENCES = 3
+
+CATEGORIES = ("performance", "accessibility", "best_practices")
+SEVERITY_WEIGHTS = {"error": 10, "warning": 5, "info": 2}
+
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta",
+                 "param", "source", "track", "wbr"}
+# Closed implicitly by the parser in real browsers; not worth reporting
+OPTIONAL_END_TAGS = {"p", "li", "dt", "dd", "option", "optgroup", "tr", "td", "th", "thead",
+                     "tbody", "tfoot", "colgroup", "rt", "rp", "html", "head", "body"}
+# Only references to files the generator produces are checked; images and
+# fonts are never generated, so their absence says nothing about the code
+CHECKED_REFERENCE_EXTENSIONS = (".html", ".htm", ".css", ".js", ".jsx", ".mjs", ".py")
+EXTERNAL_PREFIXES = ("http:", "https:", "//", "data:", "mailto:", "tel:", "javascript:", "#", "blob:")
+
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+_JS_COMMENT_RE = re.compile(r"(?<![:\\\"'])//[^\n]*|/\*.*?\*/", re.DOTALL)
+_CSS_RULE_RE = re.compile(r"([^{};]+)\{")
+_CSS_URL_RE = re.compile(r"url\(\s*['\"]?([^'\")]+)['\"]?\s*\)")
+_CSS_IMPORT_RE = re.compile(r"@import\s+(?:url\()?\s*['\"]?([^'\")\s;]+)")
+
+class Finding:
+    __slots__ = ("check", "category", "severity", "message", "recommendation", "count")
+
+    def __init__(self, check: str, category: str, severity: str, message: str, recommendation: str):
+        self.check = check
+        self.category = category
+        self.severity = severity
+        self.message = message
+        self.recommendation = recommendation
+        self.count = 1
+
+    def issue(self) -> str:
+        return self.message if self.count == 1 else f"{self.message} ({self.count} occurrences)"
+
+class FileFindings:
+    def __init__(self):
+        self._findings = {}
+
+    def add(self, check: str, category: str, severity: str, message: str, recommendation: str):
+        # Repeats of the same check collapse into one finding with a count
+        finding = self._findings.get((check, message))
+        if finding is None:
+            self._findings[(check, message)] = Finding(check, category, severity, message, recommendation)
+        else:
+            finding.count += 1
+
+    def __iter__(self):
+        return iter(self._findings.values())
+
+def is_local_reference(url: str) -> bool:
+    url = url.strip()
+    return bool(url) and not url.lower().startswith(EXTERNAL_PREFIXES) and "{" not in url
+
+def resolve_reference(from_file: str, url: str) -> str:
+    path = url.split("#", 1)[0].split("?", 1)[0]
+    if path.startswith("/"):
+        return posixpath.normpath(path.lstrip("/"))
+    return posixpath.normpath(posixpath.join(posixpath.dirname(from_file), path))
+
+def looks_unminified(content: str) -> bool:
+    # Minified assets have long lines and almost no indentation
+    if len(content.encode("utf-8")) < MINIFY_MIN_BYTES:
+        return False
+    lines = content.splitlines() or [""]
+    indented = sum(1 for line in lines if line[:1] in (" ", "\t"))
+    return len(content) / len(lines) < 200 or indented / len(lines) > 0.2
+
+class _HTMLChecker(HTMLParser):
+    def __init__(self, file_name: str, findings: FileFindings, references: set):
+        super().__init__(convert_charrefs=True)
+        self.file_name = file_name
+        self.findings = findings
+        self.references = references
+        self.stack = []
+        self.ids = Counter()
+        self.labelled_ids = set()
+        self.inputs = []
+        self.headings = []
+        self.seen = set()
+        self.link_text = None
+        self.inline_text = None
+        self.has_doctype = False
+        self.has_viewport = False
+
+    def handle_decl(self, decl: str):
+        if decl.lower().startswith("doctype"):
+            self.has_doctype = True
+
+    def handle_starttag(self, tag: str, attrs: list):
+        attributes = {name: (value or "") for name, value in attrs}
+        self.seen.add(tag)
+        if attributes.get("id"):
+            self.ids[attributes["id"]] += 1
+        if any(name.startswith("on") for name in attributes):
+            self.findings.add("inline-handler", "best_practices", "info",
+                              "Inline event handler attributes",
+                              "Attach event listeners from a script instead of on* attributes")
+        self._check_tag(tag, attributes)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs: list):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS and self.stack and self.stack[-1] == tag:
+            self.stack.pop()
+
+    def _check_tag(self, tag: str, attributes: dict):
+        if tag == "html" and not attributes.get("lang"):
+            self.findings.add("html-lang", "accessibility", "warning",
+                              "<html> has no lang attribute", "Declare the page language, e.g. <html lang=\"en\">")
+        elif tag == "meta" and attributes.get("name", "").lower() == "viewport":
+            self.has_viewport = True
+        elif tag == "img":
+            if "alt" not in attributes:
+                self.findings.add("img-alt", "accessibility", "error", "Image without alt text",
+                                  "Give every <img> an alt attribute (empty for decorative images)")
+            if not (attributes.get("width") and attributes.get("height")):
+                self.findings.add("img-dimensions", "performance", "info", "Image without width/height",
+                                  "Set width and height on images to avoid layout shift")
+        elif tag in ("input", "select", "textarea") and attributes.get("type") not in ("hidden", "submit", "button"):
+            if "label" not in self.stack and not (attributes.get("aria-label") or attributes.get("aria-labelledby") or attributes.get("title")):
+                self.inputs.append(attributes.get("id"))
+        elif tag == "label" and attributes.get("for"):
+            self.labelled_ids.add(attributes["for"])
+        elif tag == "a":
+            if attributes.get("target") == "_blank" and "noopener" not in attributes.get("rel", ""):
+                self.findings.add("blank-noopener", "best_practices", "warning",
+                                  "target=\"_blank\" link without rel=\"noopener\"",
+                                  "Add rel=\"noopener noreferrer\" to links that open a new tab")
+            self.link_text = "" if not (attributes.get("aria-label") or attributes.get("title")) else None
+        elif tag == "button" and not (attributes.get("aria-label") or attributes.get("title")):
+            self.link_text = ""
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            self.headings.append(int(tag[1]))
+        elif tag == "script":
+            if attributes.get("src"):
+                self._reference(attributes["src"])
+                if "head" in self.stack and not ({"defer", "async"} & set(attributes)) \
+                        and attributes.get("type") != "module":
+                    self.findings.add("render-blocking-script", "performance", "warning",
+                                      "Render-blocking script in <head>",
+                                      "Load scripts with defer or async, or move them to the end of <body>")
+            else:
+                self.inline_text = ""
+        elif tag == "style":
+            self.inline_text = ""
+        elif tag == "link" and attributes.get("href"):
+            self._reference(attributes["href"])
+        elif tag in ("iframe", "source", "audio", "video", "embed") and attributes.get("src"):
+            self._reference(attributes["src"])
+        if tag == "img":
+            if attributes.get("src"):
+                self._reference(attributes["src"])
+            if self.link_text is not None:
+                # An image's alt text names the link or button around it
+                self.link_text += attributes.get("alt", "")
+        if tag == "a" and attributes.get("href"):
+            self._reference(attributes["href"])
+
+    def _reference(self, url: str):
+        if is_local_reference(url):
+            self.references.add(resolve_reference(self.file_name, url))
+
+    def handle_endtag(self, tag: str):
+        if tag in ("a", "button") and self.link_text is not None:
+            if not self.link_text.strip():
+                self.findings.add("empty-control", "accessibility", "error", f"<{tag}> without accessible text",
+                                  "Give links and buttons visible text or an aria-label")
+            self.link_text = None
+        if tag in ("script", "style") and self.inline_text is not None:
+            if len(self.inline_text.encode("utf-8")) > INLINE_ASSET_MAX_BYTES:
+                self.findings.add("inline-asset", "performance", "warning",
+                                  f"Inline <{tag}> larger than {INLINE_ASSET_MAX_BYTES} bytes",
+                                  "Move large inline code to an external, cacheable file")
+            self.inline_text = None
+        if tag in VOID_ELEMENTS:
+            return
+        if tag not in self.stack:
+            self.findings.add("stray-end-tag", "best_practices", "warning", f"Stray </{tag}> end tag",
+                              "Remove end tags that have no matching start tag")
+            return
+        while self.stack:
+            open_tag = self.stack.pop()
+            if open_tag == tag:
+                break
+            if open_tag not in OPTIONAL_END_TAGS:
+                self.findings.add("unclosed-tag", "best_practices", "warning", f"Unclosed <{open_tag}> element",
+                                  "Close every non-void element explicitly")
+
+    def handle_data(self, data: str):
+        if self.link_text is not None:
+            self.link_text += data
+        if self.inline_text is not None:
+            self.inline_text += data
+
+    def finish(self):
+        self.close()
+        for open_tag in self.stack:
+            if open_tag not in OPTIONAL_END_TAGS:
+                self.findings.add("unclosed-tag", "best_practices", "warning", f"Unclosed <{open_tag}> element",
+                                  "Close every non-void element explicitly")
+        if not self.has_doctype:
+            self.findings.add("doctype", "best_practices", "warning", "Missing <!DOCTYPE html>",
+                              "Start the document with <!DOCTYPE html> to avoid quirks mode")
+        if "title" not in self.seen:
+            self.findings.add("title", "accessibility", "warning", "Missing <title>",
+                              "Give every page a descriptive <title>")
+        if not self.has_viewport:
+            self.findings.add("viewport", "best_practices", "warning", "Missing viewport meta tag",
+                              "Add <meta name=\"viewport\" content=\"width=device-width, initial-scale=1\">")
+        for element_id, count in self.ids.items():
+            if count > 1:
+                self.findings.add("duplicate-id", "best_practices", "warning", f"Duplicate id \"{element_id}\"",
+                                  "Element ids must be unique within a page")
+        for input_id in self.inputs:
+            if input_id is None or input_id not in self.labelled_ids:
+                self.findings.add("input-label", "accessibility", "error", "Form control without a label",
+                                  "Associate a <label for> or aria-label with every form control")
+        if self.headings and 1 not in self.headings:
+            self.findings.add("h1", "accessibility", "info", "No <h1> heading",
+                              "Give each page one top-level <h1>")
+        for previous, level in zip(self.headings, self.headings[1:]):
+            if level > previous + 1:
+                self.findings.add("heading-order", "accessibility", "info",
+                                  f"Heading level skips from h{previous} to h{level}",
+                                  "Don't skip heading levels")
+
+class StaticAnalyzer:
+    # analyze() is CPU-bound and runs in worker threads, so stats are locked
+    def __init__(self):
+        self._stats = {"runs": 0, "files": 0, "findings": 0, "total_ms": 0.0}
+        self._stats_lock = threading.Lock()
+        # file_type comes from the client, so only these are dispatched;
+        # other types get the reference check only
+        self._checks = {"html": self._check_html, "css": self._check_css,
+                        "javascript": self._check_javascript, "python": self._check_python}
+
+    def analyze(self, files: list) -> dict:
+        # files: [{name, content, file_type}] -> report shaped like the test
+        # stage's model output, plus the raw findings per file
+        started = time.perf_counter()
+        names = {posixpath.normpath(file["name"].lstrip("/")) for file in files}
+        per_file = {}
+        for file in files:
+            findings = FileFindings()
+            references = set()
+            check = self._checks.get(file["file_type"])
+            if check is not None:
+                check(file["name"], file["content"], findings, references)
+            for reference in sorted(references - names):
+                if posixpath.splitext(reference)[1].lower() in CHECKED_REFERENCE_EXTENSIONS:
+                    findings.add("broken-reference", "best_practices", "error",
+                                 f"Reference to missing file {reference}",
+                                 "Create the referenced file or fix the path")
+            per_file[file["name"]] = list(findings)
+
+        penalties = dict.fromkeys(CATEGORIES, 0)
+        for findings in per_file.values():
+            occurrences = Counter()
+            for finding in findings:
+                occurrences[(finding.check, finding.category, finding.severity)] += finding.count
+            for (check, category, severity), count in occurrences.items():
+                penalties[category] += SEVERITY_WEIGHTS[severity] * min(count, MAX_COUNTED_OCCURRENCES)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        finding_count = sum(len(findings) for findings in per_file.values())
+        with self._stats_lock:
+            self._stats["runs"] += 1
+            self._stats["files"] += len(files)
+            self._stats["findings"] += finding_count
+            self._stats["total_ms"] += elapsed_ms
+        return {
+            "test_summary": f"Static analysis found {finding_count} issue(s) across {len(files)} file(s).",
+            "tests": [
+                {"file": name,
+                 "issues": [finding.issue() for finding in findings],
+                 "recommendations": list(dict.fromkeys(finding.recommendation for finding in findings))}
+                for name, findings in per_file.items()
+            ],
+            "performance_score": max(0, 100 - penalties["performance"]),
+            "accessibility_score": max(0, 100 - penalties["accessibility"]),
+            "best_practices_score": max(0, 100 - penalties["best_practices"]),
+            "static_analysis": {
+                "duration_ms": round(elapsed_ms, 2),
+                "findings": [
+                    {"file": name, "check": finding.check, "category": finding.category,
+                     "severity": finding.severity, "count": finding.count}
+                    for name, findings in per_file.items() for finding in findings
+                ]
+            }
+        }
+
+    def _check_html(self, name: str, content: str, findings: FileFindings, references: set):
+        checker = _HTMLChecker(name, findings, references)
+        checker.feed(content)
+        checker.finish()
+
+    def _check_css(self, name: str, content: str, findings: FileFindings, references: set):
+        css = _CSS_COMMENT_RE.sub("", content)
+        selectors = sum(len(rule.split(",")) for rule in _CSS_RULE_RE.findall(css)
+                        if not rule.strip().startswith("@") and rule.strip())
+        if selectors > CSS_MAX_SELECTORS:
+            findings.add("css-selectors", "performance", "warning",
+                         f"{selectors} CSS selectors (more than {CSS_MAX_SELECTORS})",
+                         "Remove unused rules or split the stylesheet per page")
+        if css.count("!important") > CSS_MAX_IMPORTANT:
+            findings.add("css-important", "best_practices", "info",
+                         f"{css.count('!important')} !important declarations",
+                         "Rely on selector specificity instead of !important")
+        for url in _CSS_IMPORT_RE.findall(css):
+            findings.add("css-import", "performance", "warning", "@import in stylesheet",
+                         "Link stylesheets from the HTML instead of chaining @import")
+        for url in _CSS_URL_RE.findall(css) + _CSS_IMPORT_RE.findall(css):
+            if is_local_reference(url):
+                references.add(resolve_reference(name, url))
+        self._check_minified(content, findings)
+
+    def _check_javascript(self, name: str, content: str, findings: FileFindings, references: set):
+        code = _JS_COMMENT_RE.sub("", content)
+        if re.search(r"\beval\s*\(", code):
+            findings.add("js-eval", "best_practices", "error", "Use of eval()",
+                         "Avoid eval(); parse data with JSON.parse or restructure the code")
+        if re.search(r"\bdocument\.write\s*\(", code):
+            findings.add("js-document-write", "performance", "warning", "Use of document.write()",
+                         "Build DOM nodes instead of calling document.write()")
+        if re.search(r"\bconsole\.log\s*\(", code):
+            findings.add("js-console", "best_practices", "info", "console.log left in code",
+                         "Remove debug logging from production code")
+        self._check_minified(content, findings)
+
+    def _check_python(self, name: str, content: str, findings: FileFindings, references: set):
+        if len(content.encode("utf-8")) > PYTHON_MAX_BYTES:
+            findings.add("python-unchecked", "best_practices", "info",
+                         f"Not syntax-checked: larger than {PYTHON_MAX_BYTES} bytes",
+                         "Split large modules into smaller files")
+            return
+        try:
+            compile(content, name, "exec")
+        except SyntaxError as e:
+            findings.add("python-syntax", "best_practices", "error", f"Syntax error on line {e.lineno}: {e.msg}",
+                         "Fix the syntax error; the module cannot be imported")
+        except (ValueError, RecursionError, MemoryError) as e:
+            # Null bytes, or nesting too deep for the compiler
+            findings.add("python-syntax", "best_practices", "error",
+                         f"Module cannot be compiled: {type(e).__name__}",
+                         "Remove null bytes and deeply nested expressions")
+
+    def _check_minified(self, content: str, findings: FileFindings):
+        if looks_unminified(content):
+            findings.add("unminified", "performance", "info", "Asset is not minified",
+                         "Serve a minified build of this file")
+
+    def stats(self) -> dict:
+        runs = self._stats["runs"]
+        return {**self._stats, "total_ms": round(self._stats["total_ms"], 2),
+                "avg_ms": round(self._stats["total_ms"] / runs, 2) if runs else 0.0}
+
+static_analyzer = StaticAnalyzer()
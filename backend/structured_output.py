@@ -0,0 +1,162 @@
+from pydantic import ValidationError
+from functools import lru_cache
+import json
+import logging
+import re
+
+from prompts import build_repair_prompt, compact_json
+
+logger = logging.getLogger(__name__)
+
+class StructuredOutputError(Exception):
+    pass
+
+# A fence around the whole response is matched greedily, so ``` inside a
+# string value doesn't end it; otherwise the first fenced block in the prose
+_OUTER_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*\n?(.*)```", re.DOTALL)
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)```", re.DOTALL)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_SMART_QUOTES = {"“": '"', "”": '"', "‘": "'", "’": "'"}
+
+_stats = {"clean": 0, "repaired": 0, "reasked": 0, "failed": 0}
+
+def extract_json_text(text: str) -> str:
+    # Drop markdown fences and any prose around the outermost JSON value
+    text = text.strip()
+    fenced = _OUTER_FENCE_RE.fullmatch(text) or _FENCE_RE.search(text)
+    if fenced:
+        text = fenced.group(1).strip()
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return text
+    start = min(starts)
+    end = max(text.rfind("}"), text.rfind("]"))
+    return text[start:end + 1] if end > start else text[start:]
+
+def _close_brackets(text: str) -> str:
+    # Close strings and brackets left open by a truncated response
+    stack = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    return text + "".join(reversed(stack))
+
+def repair_json(text: str) -> str:
+    for smart, plain in _SMART_QUOTES.items():
+        text = text.replace(smart, plain)
+    text = _close_brackets(text)
+    return _TRAILING_COMMA_RE.sub(r"\1", text)
+
+def loads_tolerant(text: str):
+    # Returns (value, repaired); raises ValueError if nothing parses. Valid
+    # JSON is taken as is: extraction would cut it at a ``` or brace that is
+    # part of a string value.
+    try:
+        return json.loads(text, strict=False), False
+    except json.JSONDecodeError:
+        pass
+    candidate = extract_json_text(text)
+    try:
+        return json.loads(candidate, strict=False), candidate != text.strip()
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair_json(candidate), strict=False), True
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {str(e)}")
+
+def _parse(text: str, response_model) -> dict:
+    data, repaired = loads_tolerant(text)
+    result = response_model.model_validate(data).model_dump()
+    _stats["repaired" if repaired else "clean"] += 1
+    return result
+
+async def parse_structured_output(text: str, response_model, reask=None) -> dict:
+    # reask: optional async fn(prompt) -> str used for a single targeted retry
+    try:
+        return _parse(text, response_model)
+    except (ValueError, ValidationError) as e:
+        error = e
+
+    if reask is None:
+        _stats["failed"] += 1
+        logger.error(f"Invalid JSON response from Gemini: {text}")
+        raise StructuredOutputError(str(error))
+
+    logger.warning(f"Structured output invalid, re-asking once: {str(error)[:200]}")
+    _stats["reasked"] += 1
+    schema = compact_json(response_model.model_json_schema())
+    retry_text = await reask(build_repair_prompt(text, schema, str(error)))
+    try:
+        return _parse(retry_text, response_model)
+    except (ValueError, ValidationError) as e:
+        _stats["failed"] += 1
+        logger.error(f"Invalid JSON response from Gemini after re-ask: {retry_text}")
+        raise StructuredOutputError(str(e))
+
+# Keys of Gemini's OpenAPI subset; the rest of a pydantic JSON schema (titles,
+# defaults, additionalProperties) is rejected by the API
+_GEMINI_SCHEMA_KEYS = ("type", "format", "description", "nullable", "enum", "properties", "required", "items")
+
+def _gemini_schema_node(node: dict, defs: dict):
+    if "$ref" in node:
+        node = defs[node["$ref"].rsplit("/", 1)[-1]]
+    if "anyOf" in node:
+        options = [option for option in node["anyOf"] if option.get("type") != "null"]
+        types = {option.get("type") for option in options}
+        if types <= {"integer", "number"}:
+            converted = {"type": "number"}
+        else:
+            converted = _gemini_schema_node(options[0], defs) if options else None
+        if converted is not None and len(options) < len(node["anyOf"]):
+            converted["nullable"] = True
+        return converted
+    # No "any" type in the subset: untyped values are asked for as strings
+    converted = {key: node[key] for key in _GEMINI_SCHEMA_KEYS if key in node}
+    converted.setdefault("type", "string")
+    if converted["type"] == "object":
+        properties = {}
+        for name, value in node.get("properties", {}).items():
+            value = _gemini_schema_node(value, defs)
+            if value is not None:
+                properties[name] = value
+        # Free-form objects can't be described and would constrain the
+        # response to {}; leave them out and let the prompt shape them
+        if not properties:
+            return None
+        converted["properties"] = properties
+        required = [name for name in node.get("required", []) if name in properties]
+        if required:
+            converted["required"] = required
+        else:
+            converted.pop("required", None)
+    elif converted["type"] == "array":
+        items = _gemini_schema_node(node.get("items", {}), defs)
+        if items is None:
+            return None
+        converted["items"] = items
+    return converted
+
+@lru_cache(maxsize=None)
+def gemini_response_schema(response_model) -> dict:
+    # A pydantic model's JSON schema in the form Gemini accepts as response_schema
+    schema = response_model.model_json_schema()
+    return _gemini_schema_node(schema, schema.get("$defs", {}))
+
+def structured_output_stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,258 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import parse_qs
+import asyncio
+import json
+import logging
+import os
+import re
+import secrets
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Spans are exported when TRACE_FILE (JSON lines) and/or TRACE_OTLP_ENDPOINT
+# (OTLP/HTTP JSON, e.g. http://collector:4318/v1/traces) is set. Run IDs are
+# propagated either way.
+TRACE_FILE = os.environ.get('TRACE_FILE')
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT')
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'website-builder-backend')
+TRACE_EXPORT_INTERVAL = float(os.environ.get('TRACE_EXPORT_INTERVAL', '2'))
+TRACE_MAX_BUFFER = int(os.environ.get('TRACE_MAX_BUFFER', '10000'))
+TRACING_ENABLED = bool(TRACE_FILE or TRACE_OTLP_ENDPOINT)
+
+# The frontend sends one run ID per build; it becomes the trace ID of every
+# request in that build. A W3C traceparent header is honoured too.
+RUN_ID_HEADER = "x-run-id"
+_HEX32_RE = re.compile(r"^[0-9a-f]{32}$")
+_TRACEPARENT_RE = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+_trace_id = ContextVar("trace_id", default=None)
+_parent_span_id = ContextVar("parent_span_id", default=None)
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+def current_trace_id():
+    return _trace_id.get()
+
+def normalize_run_id(value):
+    # Accepts 32 hex digits or a UUID; anything else is ignored
+    if not value:
+        return None
+    value = value.strip().lower().replace("-", "")
+    return value if _HEX32_RE.match(value) else None
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error: BaseException = None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        exporter.add(self)
+
+class _NoopSpan:
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error: BaseException = None):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+def start_span(name: str, **attributes):
+    # Detached span for code that can't hold a context manager open (async
+    # generators that yield to the client); the caller must end() it
+    if not TRACING_ENABLED:
+        return _NOOP_SPAN
+    trace_id = _trace_id.get() or new_trace_id()
+    return Span(name, trace_id, _parent_span_id.get(), attributes)
+
+@contextmanager
+def span(name: str, **attributes):
+    if not TRACING_ENABLED:
+        yield _NOOP_SPAN
+        return
+    trace_token = None
+    if _trace_id.get() is None:
+        trace_token = _trace_id.set(new_trace_id())
+    current = Span(name, _trace_id.get(), _parent_span_id.get(), attributes)
+    parent_token = _parent_span_id.set(current.span_id)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(e)
+        raise
+    finally:
+        _parent_span_id.reset(parent_token)
+        if trace_token is not None:
+            _trace_id.reset(trace_token)
+        current.end()
+
+@contextmanager
+def use_trace(trace_id: str, parent_span_id: str = None):
+    trace_token = _trace_id.set(trace_id)
+    parent_token = _parent_span_id.set(parent_span_id)
+    try:
+        yield
+    finally:
+        _parent_span_id.reset(parent_token)
+        _trace_id.reset(trace_token)
+
+def trace_context_from_scope(scope):
+    # (trace_id, parent_span_id) from X-Run-Id, traceparent or ?run_id=
+    # (EventSource can't send headers)
+    headers = dict(scope.get("headers") or [])
+    run_id = normalize_run_id(headers.get(RUN_ID_HEADER.encode(), b"").decode("latin-1"))
+    if run_id:
+        return run_id, None
+    traceparent = _TRACEPARENT_RE.match(headers.get(b"traceparent", b"").decode("latin-1").strip())
+    if traceparent:
+        return traceparent.group(1), traceparent.group(2)
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return normalize_run_id((query.get("run_id") or [None])[0]), None
+
+# Opens a root span per HTTP request under the caller's run ID and echoes
+# the ID back in X-Run-Id
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id, parent_span_id = trace_context_from_scope(scope)
+        trace_id = trace_id or new_trace_id()
+
+        with use_trace(trace_id, parent_span_id), span(f"{scope['method']} {scope['path']}") as root:
+            async def send_with_run_id(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (RUN_ID_HEADER.encode(), trace_id.encode())
+                    ]
+                    root.set(**{"http.status_code": message["status"]})
+                await send(message)
+
+            await self.app(scope, receive, send_with_run_id)
+            route = scope.get("route")
+            if route is not None and isinstance(root, Span):
+                root.name = f"{scope['method']} {route.path}"
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_payload(spans: list) -> dict:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "website-builder"},
+            "spans": [{
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "parentSpanId": s.parent_id or "",
+                "name": s.name,
+                "kind": 1,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in s.attributes.items()],
+                "status": {"code": 2, "message": s.error} if s.error else {"code": 1}
+            } for s in spans]
+        }]
+    }]}
+
+def _file_record(s: Span) -> dict:
+    return {
+        "trace_id": s.trace_id,
+        "span_id": s.span_id,
+        "parent_id": s.parent_id,
+        "name": s.name,
+        "start": s.start_ns / 1e9,
+        "duration_ms": round((s.end_ns - s.start_ns) / 1e6, 3),
+        "attributes": s.attributes,
+        "error": s.error
+    }
+
+# Finished spans are buffered and exported in batches every
+# TRACE_EXPORT_INTERVAL seconds from a worker thread, so request handlers
+# never wait on the exporter. A full buffer drops the oldest spans.
+class SpanExporter:
+    def __init__(self):
+        self._buffer = deque(maxlen=TRACE_MAX_BUFFER)
+        self._task = None
+        self._stats = {"exported": 0, "dropped": 0, "export_errors": 0}
+
+    def add(self, finished: Span):
+        if len(self._buffer) == self._buffer.maxlen:
+            self._stats["dropped"] += 1
+        self._buffer.append(finished)
+
+    async def start(self):
+        if TRACING_ENABLED:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        batch = []
+        while self._buffer:
+            batch.append(self._buffer.popleft())
+        if batch:
+            await asyncio.to_thread(self._export, batch)
+
+    def stats(self) -> dict:
+        return {"buffered": len(self._buffer), **self._stats}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await self.flush()
+
+    def _export(self, batch: list):
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, "a", encoding="utf-8") as trace_file:
+                    for finished in batch:
+                        trace_file.write(json.dumps(_file_record(finished), default=str) + "\n")
+            if TRACE_OTLP_ENDPOINT:
+                response = requests.post(TRACE_OTLP_ENDPOINT, json=_otlp_payload(batch), timeout=5)
+                response.raise_for_status()
+            self._stats["exported"] += len(batch)
+        except Exception as e:
+            self._stats["export_errors"] += 1
+            logger.warning(f"Could not export {len(batch)} spans: {str(e)}")
+
+exporter = SpanExporter()
@@ -0,0 +1,127 @@
+from pymongo.errors import BulkWriteError
+import asyncio
+import logging
+import time
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+# Write-behind buffer for audit records. Requests enqueue a record and return;
+# a background task batches records per collection and writes them with
+# insert_many once `batch_size` records are waiting or `flush_interval`
+# seconds have passed. When `max_queued` records are waiting, enqueue blocks
+# until the flusher catches up, so a stalled Mongo slows requests down instead
+# of growing memory without bound.
+#
+# A record may be an async callable returning the document; it is resolved at
+# flush time, so side writes it needs (artifact bodies) also stay off the
+# request path.
+class WriteBehindBuffer:
+    def __init__(self, db, batch_size: int = 100, flush_interval: float = 0.5,
+                 max_queued: int = 10000, max_retries: int = 3):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self._queue = asyncio.Queue(maxsize=max_queued)
+        self._task = None
+        self._stats = {"enqueued": 0, "written": 0, "batches": 0, "retries": 0,
+                       "dropped": 0, "backpressure_waits": 0, "last_flush_seconds": 0.0}
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, timeout: float = 10):
+        # Drain everything queued so far, then stop the flusher
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Audit writer did not drain within {timeout}s; "
+                         f"{self._queue.qsize()} records lost")
+        self._task = None
+
+    async def enqueue(self, collection_name: str, document):
+        if self._task is None:
+            # Not running (startup failed or already shut down): write through
+            await self._write(collection_name, [await self._resolve(document)])
+            return
+        with span("db.enqueue", collection=collection_name, queued=self._queue.qsize()):
+            if self._queue.full():
+                self._stats["backpressure_waits"] += 1
+            await self._queue.put((collection_name, document))
+        self._stats["enqueued"] += 1
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "max_queued": self.max_queued,
+                "running": self._task is not None, **self._stats}
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is None:
+                break
+            batch = [record]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        started = time.monotonic()
+        with span("db.flush", records=len(batch)):
+            by_collection = {}
+            for collection_name, document in batch:
+                try:
+                    document = await self._resolve(document)
+                except Exception as e:
+                    self._stats["dropped"] += 1
+                    logger.error(f"Could not build {collection_name} record: {str(e)}")
+                    continue
+                by_collection.setdefault(collection_name, []).append(document)
+            await asyncio.gather(*(self._write(name, documents) for name, documents in by_collection.items()))
+        self._stats["batches"] += 1
+        self._stats["last_flush_seconds"] = round(time.monotonic() - started, 4)
+
+    async def _resolve(self, document) -> dict:
+        return await document() if callable(document) else document
+
+    async def _write(self, collection_name: str, documents: list):
+        pending = documents
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._stats["retries"] += 1
+                await asyncio.sleep(min(2 ** attempt * 0.1, 5))
+            try:
+                await self.db[collection_name].insert_many(pending, ordered=False)
+                self._stats["written"] += len(pending)
+                return
+            except BulkWriteError as e:
+                # Duplicates were written by an earlier attempt; retry the rest
+                failed = {error["index"] for error in e.details.get("writeErrors", [])
+                          if error.get("code") != DUPLICATE_KEY}
+                self._stats["written"] += len(pending) - len(failed)
+                pending = [document for index, document in enumerate(pending) if index in failed]
+                if not pending:
+                    return
+                error = e
+            except Exception as e:
+                error = e
+        self._stats["dropped"] += len(pending)
+        logger.error(f"Dropped {len(pending)} {collection_name} records after "
+                     f"{self.max_retries} retries: {str(error)}")
@@ -3,6 +3,8 @@ import unittest
 import os
 import json
 import sys
+import io
+import zipfile
 from datetime import datetime
 
 class AIWebsiteBuilderAPITester(unittest.TestCase):
@@ -46,6 +48,17 @@ class AIWebsiteBuilderAPITester(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIsInstance(response.json(), list)
             print("✅ Status GET endpoint test passed")
+            
+            # Test GET /api/status pagination
+            print("\n🔍 Testing status GET pagination...")
+            response = requests.get(f"{self.api_url}/status", params={"limit": 1})
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json()), 1)
+            next_cursor = response.headers.get("X-Next-Cursor")
+            if next_cursor:
+                response = requests.get(f"{self.api_url}/status", params={"limit": 1, "cursor": next_cursor})
+                self.assertEqual(response.status_code, 200)
+            print("✅ Status GET pagination test passed")
         except Exception as e:
             print(f"❌ Status endpoint test failed: {str(e)}")
             raise
@@ -192,7 +205,9 @@ class AIWebsiteBuilderAPITester(unittest.TestCase):
             if response.status_code == 400:
                 print("✅ Test website endpoint correctly rejected invalid API key")
             elif response.status_code == 200:
+                # Markup-only sites are scored by the static analyzer alone
                 self.assertIn("test_results", response.json())
+                self.assertIn("accessibility_score", response.json()["test_results"])
                 print("✅ Test website endpoint test passed")
             else:
                 self.fail(f"Unexpected status code: {response.status_code}")
@@ -252,6 +267,144 @@ class AIWebsiteBuilderAPITester(unittest.TestCase):
             print(f"❌ Prepare deployment endpoint test failed: {str(e)}")
             raise
 
+    def test_08_pipeline_endpoint(self):
+        """Test the pipeline job endpoints"""
+        print("\n🔍 Testing pipeline endpoint...")
+        try:
+            data = {
+                "idea": self.website_idea,
+                "api_key": self.api_key
+            }
+            response = requests.post(f"{self.api_url}/pipeline", json=data)
+            self.assertEqual(response.status_code, 200)
+            job_id = response.json()["job_id"]
+            
+            # The job runs in the background; polling must always return its state
+            response = requests.get(f"{self.api_url}/pipeline/{job_id}")
+            self.assertEqual(response.status_code, 200)
+            job = response.json()
+            self.assertEqual(job["job_id"], job_id)
+            self.assertIn(job["status"], ["queued", "running", "completed", "failed"])
+            
+            response = requests.get(f"{self.api_url}/pipeline/unknown-job")
+            self.assertEqual(response.status_code, 404)
+            print("✅ Pipeline endpoint test passed")
+        except Exception as e:
+            print(f"❌ Pipeline endpoint test failed: {str(e)}")
+            raise
+
+    def test_09_jobs_endpoint(self):
+        """Test the background job endpoints"""
+        print("\n🔍 Testing jobs endpoint...")
+        try:
+            data = {
+                "kind": "analyze-idea",
+                "payload": {
+                    "idea": self.website_idea,
+                    "api_key": self.api_key
+                },
+                "priority": 1
+            }
+            response = requests.post(f"{self.api_url}/jobs", json=data)
+            self.assertEqual(response.status_code, 200)
+            job = response.json()
+            self.assertEqual(job["kind"], "analyze-idea")
+            self.assertNotIn("payload", job)
+            
+            response = requests.get(f"{self.api_url}/jobs/{job['id']}")
+            self.assertEqual(response.status_code, 200)
+            
+            response = requests.delete(f"{self.api_url}/jobs/{job['id']}")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(response.json()["status"], ["cancelled", "completed", "failed"])
+            
+            response = requests.post(f"{self.api_url}/jobs", json={"kind": "unknown", "payload": {}})
+            self.assertEqual(response.status_code, 400)
+            print("✅ Jobs endpoint test passed")
+        except Exception as e:
+            print(f"❌ Jobs endpoint test failed: {str(e)}")
+            raise
+
+    def test_10_health_endpoints(self):
+        """Test the liveness and readiness probes"""
+        print("\n🔍 Testing health endpoints...")
+        try:
+            response = requests.get(f"{self.api_url}/healthz")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["status"], "ok")
+
+            response = requests.get(f"{self.api_url}/readyz")
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertEqual(data["status"], "ready")
+            self.assertTrue(data["checks"]["mongo"])
+            print("✅ Health endpoints test passed")
+        except Exception as e:
+            print(f"❌ Health endpoints test failed: {str(e)}")
+            raise
+
+    def test_11_metrics_endpoint(self):
+        """Test the Prometheus metrics endpoint"""
+        print("\n🔍 Testing metrics endpoint...")
+        try:
+            requests.get(f"{self.api_url}/")
+            response = requests.get(f"{self.api_url}/metrics")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("text/plain", response.headers["Content-Type"])
+            self.assertIn("http_request_duration_seconds", response.text)
+            print("✅ Metrics endpoint test passed")
+        except Exception as e:
+            print(f"❌ Metrics endpoint test failed: {str(e)}")
+            raise
+
+    def test_12_audit_website_endpoint(self):
+        """Test the browser audit endpoint"""
+        print("\n🔍 Testing audit-website endpoint...")
+        try:
+            files = [
+                {
+                    "name": "index.html",
+                    "content": "<!DOCTYPE html><html lang=\"en\"><head><title>Test</title></head><body><h1>Test</h1></body></html>",
+                    "file_type": "html"
+                }
+            ]
+            response = requests.post(f"{self.api_url}/audit-website", json={"files": files})
+            self.assertEqual(response.status_code, 200)
+            audit = response.json()["audit"]
+            # Disabled by default, and without a browser the audit reports itself unavailable
+            if audit["available"]:
+                self.assertIn("performance_score", audit)
+                self.assertEqual(audit["pages"][0]["page"], "index.html")
+            else:
+                self.assertIn("reason", audit)
+            print("✅ Audit website endpoint test passed")
+        except Exception as e:
+            print(f"❌ Audit website endpoint test failed: {str(e)}")
+            raise
+
+    def test_13_download_website_endpoint(self):
+        """Test the streaming site download endpoint"""
+        print("\n🔍 Testing download-website endpoint...")
+        try:
+            files = [
+                {"name": "index.html", "content": "<html><body><h1>Test</h1></body></html>", "file_type": "html"},
+                {"name": "style.css", "content": "body { color: black; }", "file_type": "css"}
+            ]
+            response = requests.post(f"{self.api_url}/download-website",
+                                     json={"files": files, "minify": True, "precompressed": True})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Content-Type"], "application/zip")
+            with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+                self.assertIn("website/index.html", archive.namelist())
+                self.assertIn("website/style.css", archive.namelist())
+
+            response = requests.post(f"{self.api_url}/download-website", json={"files": files, "format": "rar"})
+            self.assertEqual(response.status_code, 400)
+            print("✅ Download website endpoint test passed")
+        except Exception as e:
+            print(f"❌ Download website endpoint test failed: {str(e)}")
+            raise
+
 def run_tests():
     """Run all tests"""
     test_suite = unittest.TestSuite()
@@ -262,6 +415,12 @@ def run_tests():
     test_suite.addTest(AIWebsiteBuilderAPITester('test_05_generate_code_endpoint'))
     test_suite.addTest(AIWebsiteBuilderAPITester('test_06_test_website_endpoint'))
     test_suite.addTest(AIWebsiteBuilderAPITester('test_07_prepare_deployment_endpoint'))
+    test_suite.addTest(AIWebsiteBuilderAPITester('test_08_pipeline_endpoint'))
+    test_suite.addTest(AIWebsiteBuilderAPITester('test_09_jobs_endpoint'))
+    test_suite.addTest(AIWebsiteBuilderAPITester('test_10_health_endpoints'))
+    test_suite.addTest(AIWebsiteBuilderAPITester('test_11_metrics_endpoint'))
+    test_suite.addTest(AIWebsiteBuilderAPITester('test_12_audit_website_endpoint'))
+    test_suite.addTest(AIWebsiteBuilderAPITester('test_13_download_website_endpoint'))
     
     runner = unittest.TextTestRunner(verbosity=2)
     runner.run(test_suite)
@@ -1,41 +1,87 @@
 #!/bin/sh
 set -e
 
+# BACKEND_WORKERS uvicorn processes (default: one per CPU) listen on
+# consecutive ports from BACKEND_BASE_PORT; nginx balances across them.
+# Any worker can answer for any pipeline job (its state is kept in Mongo), so
+# requests go to the least busy worker; event streams are long-lived, which
+# round robin would spread unevenly.
+# READY_TIMEOUT is how long to wait for every worker's /api/readyz.
+# Exported so workers can split per-deployment limits (GEMINI_RATE_LIMIT_*)
+export BACKEND_WORKERS=${BACKEND_WORKERS:-$(nproc 2>/dev/null || echo 1)}
+BACKEND_BASE_PORT=${BACKEND_BASE_PORT:-8001}
+READY_TIMEOUT=${READY_TIMEOUT:-120}
+
+# Workers write metrics to a shared directory so /api/metrics covers all of
+# them; it is cleared on every start
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 # Start the FastAPI backend
 cd /backend || { echo "Backend directory not found"; exit 1; }
 
-echo "Starting FastAPI backend"
-# Start Uvicorn with proper host binding
-uvicorn server:app --host 0.0.0.0 --port 8001 &
-BACKEND_PID=$!
+echo "Starting FastAPI backend with $BACKEND_WORKERS workers"
+BACKEND_PIDS=""
+UPSTREAM="upstream backend {\n    least_conn;\n"
+i=0
+while [ "$i" -lt "$BACKEND_WORKERS" ]; do
+    port=$((BACKEND_BASE_PORT + i))
+    # --loop/--http auto pick uvloop and httptools when they are installed
+    uvicorn server:app --host 0.0.0.0 --port "$port" --loop auto --http auto &
+    BACKEND_PIDS="$BACKEND_PIDS $!"
+    UPSTREAM="$UPSTREAM    server 127.0.0.1:$port;\n"
+    i=$((i + 1))
+done
+printf "$UPSTREAM}\n" > /etc/nginx/backend_upstream.conf
 
-echo "Waiting for backend to start..."
-sleep 30
+backend_alive() {
+    for pid in $BACKEND_PIDS; do
+        kill -0 "$pid" 2>/dev/null || return 1
+    done
+}
 
-if ! kill -0 $BACKEND_PID 2>/dev/null; then
-    echo "Backend failed to start at initialization, exiting"
-    exit 1
-fi
+echo "Waiting for backend to become ready..."
+i=0
+while [ "$i" -lt "$BACKEND_WORKERS" ]; do
+    port=$((BACKEND_BASE_PORT + i))
+    waited=0
+    until wget -q -O /dev/null "http://127.0.0.1:$port/api/readyz" 2>/dev/null; do
+        if ! backend_alive; then
+            echo "Backend failed to start at initialization, exiting"
+            exit 1
+        fi
+        if [ "$waited" -ge "$READY_TIMEOUT" ]; then
+            echo "Backend on port $port not ready after ${READY_TIMEOUT}s, exiting"
+            kill $BACKEND_PIDS 2>/dev/null
+            exit 1
+        fi
+        sleep 1
+        waited=$((waited + 1))
+    done
+    i=$((i + 1))
+done
+echo "Backend ready"
 
 # Start Nginx
 nginx -g 'daemon off;' &
 NGINX_PID=$!
 
 # Handle termination signals
-trap 'kill $BACKEND_PID $NGINX_PID; exit 0' SIGTERM SIGINT
+trap 'kill $BACKEND_PIDS $NGINX_PID; exit 0' SIGTERM SIGINT
 
 # Check if processes are still running
-while kill -0 $BACKEND_PID 2>/dev/null && kill -0 $NGINX_PID 2>/dev/null; do
+while backend_alive && kill -0 $NGINX_PID 2>/dev/null; do
     sleep 1
 done
 
 # If we get here, one of the processes died
-if kill -0 $BACKEND_PID 2>/dev/null; then
+if backend_alive; then
     echo "Nginx died, shutting down backend..."
-    kill $BACKEND_PID
+    kill $BACKEND_PIDS
 else
-    echo "Backend died, shutting down nginx..."
-    kill $NGINX_PID
+    echo "A backend worker died, shutting down..."
+    kill $BACKEND_PIDS $NGINX_PID 2>/dev/null
 fi
 
 exit 1
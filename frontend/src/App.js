@@ -120,6 +120,20 @@ i18n
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// One run ID per build; the backend uses it as the trace ID for every
+// request the build makes
+const newRunId = () =>
+  Array.from(crypto.getRandomValues(new Uint8Array(16)), (b) => b.toString(16).padStart(2, "0")).join("");
+
+// Which agent runs each server-side pipeline stage
+const stageAgents = {
+  analyze: "thinker",
+  plan: "planner",
+  generate: "coder",
+  test: "tester",
+  deploy: "deployer"
+};
+
 // Agent images from Unsplash
 const agentImages = {
   thinker: "https://images.unsplash.com/photo-1532178324009-6b6adeca1741",
@@ -506,18 +520,63 @@ const Home = () => {
     });
   };
 
-  // Simulate an agent working process
-  const simulateAgentWork = async (agent, duration) => {
-    return new Promise((resolve) => {
-      setActiveAgent(agent);
-      setAgentsStatus(prev => ({ ...prev, [agent]: agentStates.WORKING }));
-      
-      setTimeout(() => {
-        setAgentsStatus(prev => ({ ...prev, [agent]: agentStates.COMPLETED }));
-        setCompletedAgents(prev => [...prev, agent]);
-        setActiveAgent(null);
-        resolve();
-      }, duration);
+  // Mark an agent as working / completed as pipeline stages progress
+  const startAgent = (agent) => {
+    setActiveAgent(agent);
+    setAgentsStatus(prev => ({ ...prev, [agent]: agentStates.WORKING }));
+  };
+
+  const completeAgent = (agent) => {
+    setAgentsStatus(prev => ({ ...prev, [agent]: agentStates.COMPLETED }));
+    setCompletedAgents(prev => [...prev, agent]);
+    setActiveAgent(null);
+  };
+
+  // Follow a server-side pipeline job until it finishes
+  const followPipeline = (jobId, runId) => {
+    return new Promise((resolve, reject) => {
+      // EventSource can't set headers, so the run ID goes in the query string
+      const source = new EventSource(`${API}/pipeline/${jobId}/events?run_id=${runId}`);
+
+      // Always sent first; a job that already finished sends nothing else
+      source.addEventListener("snapshot", (e) => {
+        const job = JSON.parse(e.data);
+        setBuildProgress(job.progress);
+        if (job.status === "completed") {
+          source.close();
+          resolve(job);
+        } else if (job.status === "failed" || job.status === "cancelled") {
+          source.close();
+          reject(new Error(job.error?.detail || `Build pipeline ${job.status}`));
+        }
+      });
+
+      source.addEventListener("stage_start", (e) => {
+        const { stage } = JSON.parse(e.data);
+        startAgent(stageAgents[stage]);
+      });
+
+      source.addEventListener("stage_complete", (e) => {
+        const { stage, progress } = JSON.parse(e.data);
+        completeAgent(stageAgents[stage]);
+        setBuildProgress(progress);
+      });
+
+      source.addEventListener("file", (e) => {
+        const file = JSON.parse(e.data);
+        setGeneratedFiles(prev => [...prev, file]);
+      });
+
+      source.addEventListener("done", (e) => {
+        source.close();
+        resolve(JSON.parse(e.data));
+      });
+
+      source.addEventListener("error", (e) => {
+        source.close();
+        const detail = e.data ? JSON.parse(e.data).detail : null;
+        reject(new Error(detail || "Lost connection to the build pipeline"));
+      });
     });
   };
 
@@ -583,70 +642,26 @@ const Home = () => {
     setBuildProgress(0);
     
     try {
-      // Simulate Thinker agent
-      await simulateAgentWork('thinker', 3000);
-      setBuildProgress(20);
-      
-      // Make actual API call to analyze idea
-      const analyzeResponse = await axios.post(`${API}/analyze-idea`, { 
-        idea,
-        api_key: apiKey
-      });
-      
-      // Simulate Planner agent
-      await simulateAgentWork('planner', 3000);
-      setBuildProgress(40);
-      
-      // Make actual API call to plan website
-      const planResponse = await axios.post(`${API}/plan-website`, {
+      // Run every stage server-side in one job and follow its progress
+      const runId = newRunId();
+      const pipelineResponse = await axios.post(`${API}/pipeline`, {
         idea,
-        analysis: analyzeResponse.data.analysis,
         api_key: apiKey
-      });
+      }, { headers: { "X-Run-Id": runId } });
       
-      // Simulate Coder agent
-      await simulateAgentWork('coder', 5000);
-      setBuildProgress(60);
-      
-      // Make actual API call to generate code
-      const codeResponse = await axios.post(`${API}/generate-code`, {
-        idea,
-        plan: planResponse.data.plan,
-        api_key: apiKey
-      });
+      const job = await followPipeline(pipelineResponse.data.job_id, runId);
       
       // Update generated files
-      setGeneratedFiles(codeResponse.data.files);
-      
-      // Simulate Tester agent
-      await simulateAgentWork('tester', 3000);
-      setBuildProgress(80);
-      
-      // Make actual API call to test website
-      const testResponse = await axios.post(`${API}/test-website`, {
-        files: codeResponse.data.files,
-        api_key: apiKey
-      });
-      
-      // Simulate Deployer agent
-      await simulateAgentWork('deployer', 3000);
-      setBuildProgress(100);
-      
-      // Make actual API call to prepare deployment
-      const deployResponse = await axios.post(`${API}/prepare-deployment`, {
-        files: codeResponse.data.files,
-        test_results: testResponse.data.test_results,
-        api_key: apiKey
-      });
+      setGeneratedFiles(job.artifacts.files);
       
-      // Set website preview URL if available
-      if (deployResponse.data.preview_url) {
-        setWebsitePreview(deployResponse.data.preview_url);
+      // Set website preview URL if available; it is a backend-relative path
+      if (job.artifacts.preview_url) {
+        setWebsitePreview(`${BACKEND_URL}${job.artifacts.preview_url}`);
       }
       
     } catch (err) {
       console.error("Error in build process:", err);
-      setError(err.response?.data?.message || "An error occurred during the build process");
+      setError(err.response?.data?.message || err.message || "An error occurred during the build process");
     } finally {
       setIsBuilding(false);
     }
@@ -797,6 +812,7 @@ const Home = () => {
               <iframe 
                 src={websitePreview} 
                 title="Website Preview" 
+                sandbox="allow-scripts"
                 className="website-preview-iframe"
               />
             </div>
@@ -0,0 +1,38 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException
+
+import model_router
+from gemini_client import UpstreamOverloaded
+
+class ModelRouterFallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.router = model_router.ModelRouter({"fast": "fast-model", "strong": "strong-model"},
+                                               {"analyze-idea": "fast"}, {})
+
+    def generate(self, first_error):
+        calls = []
+
+        async def generate_with_gemini(prompt, api_key, model_name, **kwargs):
+            calls.append(model_name)
+            if len(calls) == 1:
+                raise first_error
+            return "ok"
+
+        with mock.patch.object(model_router, "generate_with_gemini", generate_with_gemini):
+            try:
+                return asyncio.run(self.router.generate("analyze-idea", "prompt", "key")), calls
+            except HTTPException as e:
+                return e, calls
+
+    def test_upstream_overload_falls_back_to_the_other_tier(self):
+        result, calls = self.generate(UpstreamOverloaded(status_code=503, detail="busy"))
+        self.assertEqual(result, "ok")
+        self.assertEqual(calls, ["fast-model", "strong-model"])
+
+    def test_local_rate_limit_does_not_fall_back(self):
+        result, calls = self.generate(HTTPException(status_code=429, detail="Gemini rate limit reached"))
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(calls, ["fast-model"])
@@ -0,0 +1,115 @@
+import asyncio
+import time
+import unittest
+
+from rate_limiter import AdaptiveTokenBucket, RateLimitExceeded, RateLimiterRegistry, UsageLedger, backoff_delay
+
+class FailingCollection:
+    def __init__(self):
+        self.calls = 0
+
+    async def bulk_write(self, operations, ordered=True):
+        self.calls += 1
+        raise RuntimeError("mongo is down")
+
+class RecordingCollection:
+    def __init__(self):
+        self.operations = []
+
+    async def bulk_write(self, operations, ordered=True):
+        self.operations.extend(operations)
+
+class AdaptiveTokenBucketTest(unittest.TestCase):
+    def test_burst_then_reject(self):
+        async def run():
+            bucket = AdaptiveTokenBucket(rate=1, burst=3, min_rate=0.1)
+            deadline = time.monotonic() + 0.05
+            for _ in range(3):
+                await bucket.acquire(deadline)
+            with self.assertRaises(RateLimitExceeded) as raised:
+                await bucket.acquire(deadline)
+            self.assertGreater(raised.exception.retry_after, 0)
+        asyncio.run(run())
+
+    def test_waits_for_refill_within_deadline(self):
+        async def run():
+            bucket = AdaptiveTokenBucket(rate=50, burst=1, min_rate=1)
+            await bucket.acquire(time.monotonic() + 1)
+            started = time.monotonic()
+            await bucket.acquire(time.monotonic() + 1)
+            self.assertGreaterEqual(time.monotonic() - started, 0.015)
+        asyncio.run(run())
+
+    def test_throttle_halves_rate_and_success_recovers(self):
+        bucket = AdaptiveTokenBucket(rate=10, burst=5, min_rate=1)
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 5)
+        self.assertLessEqual(bucket.tokens, 0)
+        for _ in range(5):
+            bucket.throttled()
+        self.assertEqual(bucket.rate, 1)
+        for _ in range(40):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 10)
+
+class RateLimiterRegistryTest(unittest.TestCase):
+    def test_one_bucket_per_key_and_model(self):
+        registry = RateLimiterRegistry(60, 10)
+        self.assertIs(registry.get("a", "m"), registry.get("a", "m"))
+        self.assertIsNot(registry.get("a", "m"), registry.get("b", "m"))
+        self.assertIsNot(registry.get("a", "m"), registry.get("a", "n"))
+
+    def test_limits_are_split_between_workers(self):
+        bucket = RateLimiterRegistry(120, 10, workers=4).get("a", "m")
+        self.assertAlmostEqual(bucket.max_rate, 0.5)
+        self.assertEqual(bucket.capacity, 3)
+        self.assertEqual(RateLimiterRegistry(60, 2, workers=8).get("a", "m").capacity, 1)
+        self.assertAlmostEqual(RateLimiterRegistry(60, 10, workers=0).get("a", "m").max_rate, 1)
+
+    def test_least_recently_used_buckets_are_dropped(self):
+        registry = RateLimiterRegistry(60, 10, max_buckets=2)
+        first = registry.get("a", "m")
+        registry.get("b", "m")
+        registry.get("a", "m")
+        registry.get("c", "m")
+        self.assertEqual(set(registry.stats()), {"a:m", "c:m"})
+        self.assertIs(registry.get("a", "m"), first)
+
+class BackoffDelayTest(unittest.TestCase):
+    def test_delay_is_capped(self):
+        for attempt in range(10):
+            self.assertLessEqual(backoff_delay(attempt, 1, 20), min(20, 2 ** attempt))
+
+class UsageLedgerTest(unittest.TestCase):
+    def test_flush_upserts_pending_counts(self):
+        collection = RecordingCollection()
+        ledger = UsageLedger(collection)
+        ledger.record("key", "model", requests=1, prompt_tokens=10)
+        ledger.record("key", "model", requests=1)
+        asyncio.run(ledger.flush())
+        self.assertEqual(len(collection.operations), 1)
+        self.assertEqual(collection.operations[0]._doc["$inc"], {"requests": 2, "prompt_tokens": 10})
+        self.assertEqual(ledger.stats()["models"]["model"]["requests"], 2)
+        self.assertEqual(set(ledger.stats()["models"]), {"model"})
+
+    def test_failed_flush_keeps_counts(self):
+        ledger = UsageLedger(FailingCollection())
+        ledger.record("key", "model", requests=3)
+        asyncio.run(ledger.flush())
+        collection = RecordingCollection()
+        ledger.collection = collection
+        asyncio.run(ledger.flush())
+        self.assertEqual(collection.operations[0]._doc["$inc"], {"requests": 3})
+
+    def test_pending_keys_are_bounded(self):
+        ledger = UsageLedger(FailingCollection(), max_keys=2)
+        ledger.record("a", "model", requests=1)
+        ledger.record("b", "model", requests=1)
+        asyncio.run(ledger.flush())
+        ledger.record("c", "model", requests=1)
+        collection = RecordingCollection()
+        ledger.collection = collection
+        asyncio.run(ledger.flush())
+        self.assertEqual([operation._filter["_id"].split(":")[0] for operation in collection.operations], ["b", "c"])
+        self.assertEqual(ledger.stats()["dropped_keys"], 1)
+        self.assertEqual(ledger.stats()["models"]["model"]["requests"], 3)
@@ -0,0 +1,91 @@
+import gzip
+import io
+import tarfile
+import unittest
+import zipfile
+
+import brotli
+
+from site_bundler import SiteBundler, minify_css, minify_html, safe_path
+
+JS_SOURCE = """/* header */ var x = 1;
+const greeting = `hello
+    world`;
+const url = "http://example.com"; // trailing comment
+function f() {
+  /* inline */ return x; /* still code after */ var y = 2;
+}
+"""
+
+class SiteBundlerTest(unittest.TestCase):
+    def test_javascript_is_never_minified(self):
+        asset = SiteBundler().build("app.js", JS_SOURCE, minify=True)
+        self.assertEqual(asset.body.decode("utf-8"), JS_SOURCE)
+
+    def test_comments_next_to_code_are_kept_in_scripts(self):
+        body = SiteBundler().build("app.js", JS_SOURCE, minify=True).body.decode("utf-8")
+        self.assertIn("var x = 1;", body)
+        self.assertIn("var y = 2;", body)
+
+    def test_template_literals_keep_their_whitespace(self):
+        body = SiteBundler().build("app.js", JS_SOURCE, minify=True).body.decode("utf-8")
+        self.assertIn("`hello\n    world`", body)
+
+    def test_inline_scripts_untouched_by_html_minifier(self):
+        html = "<html>\n  <body>\n    <script>\n  const s = `a\n  b`; // c\n    </script>\n  </body>\n</html>"
+        minified = minify_html(html)
+        self.assertIn("<script>\n  const s = `a\n  b`; // c\n    </script>", minified)
+        self.assertTrue(minified.startswith("<html> <body>"))
+
+    def test_html_minifier_keeps_pre_and_drops_comments(self):
+        minified = minify_html("<div>\n  <!-- note -->\n  <pre>  a\n   b</pre>\n</div>")
+        self.assertEqual(minified, "<div> <pre>  a\n   b</pre> </div>")
+
+    def test_css_minifier_keeps_strings(self):
+        css = '/* c */ a :hover { content: "/* keep  */" ; color : red ; }\nb,  c { font-family: \'A  B\' }'
+        self.assertEqual(minify_css(css), 'a :hover{content: "/* keep  */";color : red}b,c{font-family: \'A  B\'}')
+
+    def test_precompressed_variants_round_trip(self):
+        asset = SiteBundler().build("index.html", "<p>hello</p>" * 100)
+        self.assertEqual(gzip.decompress(asset.gzip), asset.body)
+        self.assertEqual(brotli.decompress(asset.br), asset.body)
+        self.assertEqual(asset.variant("gzip, deflate, br"), (asset.br, "br"))
+        self.assertEqual(asset.variant("gzip"), (asset.gzip, "gzip"))
+        self.assertEqual(asset.variant(""), (asset.body, None))
+
+    def test_small_files_are_not_precompressed(self):
+        asset = SiteBundler().build("index.html", "<p>hi</p>")
+        self.assertIsNone(asset.gzip)
+        self.assertIsNone(asset.br)
+
+    def test_safe_path_stays_inside_the_archive(self):
+        self.assertEqual(safe_path("../../etc/passwd"), "etc/passwd")
+        self.assertEqual(safe_path("/css/../style.css"), "style.css")
+        self.assertEqual(safe_path("a\\b.js"), "a/b.js")
+        self.assertIsNone(safe_path(""))
+
+    def test_zip_and_tar_archives(self):
+        bundler = SiteBundler()
+        files = [{"name": "index.html", "content": "<p>x</p>" * 100},
+                 {"name": "css/site.css", "content": "a { color: red }"},
+                 {"name": "", "content": "skipped"}]
+        with zipfile.ZipFile(io.BytesIO(b"".join(bundler.stream_zip(files, precompressed=True)))) as archive:
+            self.assertEqual(archive.namelist(), ["website/index.html", "website/index.html.gz",
+                                                  "website/index.html.br", "website/css/site.css"])
+            self.assertEqual(archive.read("website/index.html"), files[0]["content"].encode("utf-8"))
+        with tarfile.open(fileobj=io.BytesIO(b"".join(bundler.stream_tar_gz(files, minify=True)))) as archive:
+            self.assertEqual(archive.getnames(), ["website/index.html", "website/css/site.css"])
+            self.assertEqual(archive.extractfile("website/css/site.css").read(), b"a{color: red}")
+
+    def test_archive_members_are_built_lazily(self):
+        bundler = SiteBundler()
+        chunks = bundler.stream_zip([{"name": "a.html", "content": "<p>a</p>"},
+                                     {"name": "b.html", "content": "<p>b</p>"}])
+        next(chunks)
+        self.assertEqual(bundler.stats()["builds"], 1)
+
+    def test_built_assets_are_cached(self):
+        bundler = SiteBundler()
+        first = bundler.build("index.html", "<p>x</p>", minify=True)
+        self.assertIs(bundler.build("index.html", "<p>x</p>", minify=True), first)
+        self.assertEqual(bundler.stats()["cache_hits"], 1)
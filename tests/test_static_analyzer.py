@@ -0,0 +1,89 @@
+import unittest
+
+import static_analyzer
+from static_analyzer import StaticAnalyzer, is_local_reference, resolve_reference
+
+CLEAN_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta name="viewport" content="width=device-width, initial-scale=1">
+  <title>Home</title>
+  <link rel="stylesheet" href="css/site.css">
+</head>
+<body>
+  <h1>Welcome</h1>
+  <img src="logo.png" alt="Logo" width="10" height="10">
+  <a href="about.html">About</a>
+</body>
+</html>"""
+
+def checks(report, file_name):
+    return {finding["check"] for finding in report["static_analysis"]["findings"] if finding["file"] == file_name}
+
+class StaticAnalyzerTest(unittest.TestCase):
+    def setUp(self):
+        self.analyzer = StaticAnalyzer()
+
+    def test_clean_site_scores_full_marks(self):
+        report = self.analyzer.analyze([
+            {"name": "index.html", "content": CLEAN_PAGE, "file_type": "html"},
+            {"name": "about.html", "content": CLEAN_PAGE, "file_type": "html"},
+            {"name": "css/site.css", "content": "body{margin:0}", "file_type": "css"},
+        ])
+        self.assertEqual(report["static_analysis"]["findings"], [])
+        self.assertEqual((report["performance_score"], report["accessibility_score"],
+                          report["best_practices_score"]), (100, 100, 100))
+
+    def test_html_findings(self):
+        page = '<html><body><img src="a.png"><input id="q"><div id="x"></div><div id="x"></body></html>'
+        report = self.analyzer.analyze([{"name": "index.html", "content": page, "file_type": "html"}])
+        self.assertTrue({"doctype", "html-lang", "title", "viewport", "duplicate-id",
+                         "input-label", "unclosed-tag"} <= checks(report, "index.html"))
+        self.assertLess(report["accessibility_score"], 100)
+
+    def test_broken_references(self):
+        report = self.analyzer.analyze([{"name": "index.html", "content": CLEAN_PAGE, "file_type": "html"}])
+        self.assertIn("broken-reference", checks(report, "index.html"))
+        issues = report["tests"][0]["issues"]
+        self.assertTrue(any("css/site.css" in issue for issue in issues))
+        self.assertFalse(any("logo.png" in issue for issue in issues))
+
+    def test_javascript_findings_ignore_comments(self):
+        code = "// eval(x) is bad\nconsole.log('hi');\ndocument.write('x');"
+        report = self.analyzer.analyze([{"name": "app.js", "content": code, "file_type": "javascript"}])
+        self.assertEqual(checks(report, "app.js"), {"js-console", "js-document-write"})
+
+    def test_python_syntax_error(self):
+        report = self.analyzer.analyze([{"name": "app.py", "content": "def f(:\n", "file_type": "python"}])
+        self.assertEqual(checks(report, "app.py"), {"python-syntax"})
+
+    def test_python_the_compiler_rejects(self):
+        for content in ("-" * 100000 + "1", "a." * 100000 + "b", "x = 1\0"):
+            report = self.analyzer.analyze([{"name": "app.py", "content": content, "file_type": "python"}])
+            self.assertEqual(checks(report, "app.py"), {"python-syntax"})
+
+    def test_large_python_files_are_not_compiled(self):
+        content = "x = 1\n" * (static_analyzer.PYTHON_MAX_BYTES // 6 + 1)
+        report = self.analyzer.analyze([{"name": "app.py", "content": content, "file_type": "python"}])
+        self.assertEqual(checks(report, "app.py"), {"python-unchecked"})
+
+    def test_unknown_file_types_are_not_dispatched(self):
+        # file_type is client-supplied; it must never reach arbitrary methods
+        for file_type in ("minified", "init", "__init__", "stats", "text", ""):
+            report = self.analyzer.analyze([{"name": "notes.txt", "content": "x", "file_type": file_type}])
+            self.assertEqual(checks(report, "notes.txt"), set())
+
+    def test_repeated_findings_are_counted_once_per_check(self):
+        page = CLEAN_PAGE.replace('<a href="about.html">About</a>', '<img src="a.png">' * 5)
+        report = self.analyzer.analyze([{"name": "index.html", "content": page, "file_type": "html"}])
+        findings = [finding for finding in report["static_analysis"]["findings"] if finding["check"] == "img-alt"]
+        self.assertEqual(len(findings), 1)
+        self.assertEqual(findings[0]["count"], 5)
+
+    def test_references(self):
+        self.assertTrue(is_local_reference("css/site.css"))
+        self.assertFalse(is_local_reference("https://cdn.example.com/x.js"))
+        self.assertFalse(is_local_reference("#top"))
+        self.assertFalse(is_local_reference("{{ url }}"))
+        self.assertEqual(resolve_reference("pages/a.html", "../css/site.css?v=1"), "css/site.css")
+        self.assertEqual(resolve_reference("pages/a.html", "/js/app.js#x"), "js/app.js")
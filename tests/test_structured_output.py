@@ -0,0 +1,96 @@
+import asyncio
+import json
+import unittest
+from typing import Any, Dict, List, Optional, Union
+
+from pydantic import BaseModel, ConfigDict, Field
+
+from structured_output import (StructuredOutputError, extract_json_text, gemini_response_schema, loads_tolerant,
+                               parse_structured_output)
+
+class Snippet(BaseModel):
+    title: str
+    code: str
+
+class Step(BaseModel):
+    name: str
+    note: Optional[str] = ""
+
+class Report(BaseModel):
+    model_config = ConfigDict(extra="allow")
+    summary: str = ""
+    steps: List[Step] = []
+    tags: List[Any] = []
+    score: Optional[Union[int, float]] = None
+    extra: Dict[str, Any] = {}
+    stack: Dict[str, Any] = Field({}, json_schema_extra={"properties": {"frontend": {"type": "string"}}})
+
+FENCED_CODE = json.dumps({"title": "Usage", "code": "```python\nprint('hi')\n```"})
+
+class StructuredOutputTest(unittest.TestCase):
+    def test_plain_json_is_not_repaired(self):
+        self.assertEqual(loads_tolerant('{"a": [1, 2]}'), ({"a": [1, 2]}, False))
+
+    def test_fence_inside_string_value(self):
+        value, repaired = loads_tolerant(FENCED_CODE)
+        self.assertEqual(value["code"], "```python\nprint('hi')\n```")
+        self.assertFalse(repaired)
+
+    def test_fenced_response_with_fence_inside_string_value(self):
+        value, repaired = loads_tolerant(f"```json\n{FENCED_CODE}\n```")
+        self.assertEqual(value["code"], "```python\nprint('hi')\n```")
+        self.assertTrue(repaired)
+
+    def test_braces_inside_string_value(self):
+        text = json.dumps({"title": "}{", "code": "function f() { return [1]; }"})
+        self.assertEqual(loads_tolerant(text)[0]["code"], "function f() { return [1]; }")
+
+    def test_fenced_json_after_prose(self):
+        value, repaired = loads_tolerant('Here you go:\n```json\n{"a": 1}\n```\nEnjoy!')
+        self.assertEqual(value, {"a": 1})
+        self.assertTrue(repaired)
+
+    def test_extract_drops_prose_around_json(self):
+        self.assertEqual(extract_json_text('Sure! {"a": 1} Hope that helps.'), '{"a": 1}')
+
+    def test_repairs_trailing_commas_and_truncation(self):
+        self.assertEqual(loads_tolerant('{"a": [1, 2,], "b": "x",}')[0], {"a": [1, 2], "b": "x"})
+        self.assertEqual(loads_tolerant('{"a": {"b": "unterminated')[0], {"a": {"b": "unterminated"}})
+
+    def test_invalid_json_raises(self):
+        with self.assertRaises(ValueError):
+            loads_tolerant("no json here")
+
+    def test_parse_validates_against_the_model(self):
+        result = asyncio.run(parse_structured_output(FENCED_CODE, Snippet))
+        self.assertEqual(result["title"], "Usage")
+        with self.assertRaises(StructuredOutputError):
+            asyncio.run(parse_structured_output('{"title": "x"}', Snippet))
+
+    def test_reask_once_on_invalid_output(self):
+        prompts = []
+
+        async def reask(prompt):
+            prompts.append(prompt)
+            return FENCED_CODE
+
+        result = asyncio.run(parse_structured_output('{"title": "x"}', Snippet, reask=reask))
+        self.assertEqual(result["code"], "```python\nprint('hi')\n```")
+        self.assertEqual(len(prompts), 1)
+
+    def test_gemini_response_schema(self):
+        schema = gemini_response_schema(Report)
+        self.assertEqual(schema["type"], "object")
+        self.assertNotIn("required", schema)
+        properties = schema["properties"]
+        self.assertEqual(properties["steps"]["items"], {
+            "type": "object",
+            "properties": {"name": {"type": "string"}, "note": {"type": "string", "nullable": True}},
+            "required": ["name"],
+        })
+        self.assertEqual(properties["tags"], {"type": "array", "items": {"type": "string"}})
+        self.assertEqual(properties["score"], {"type": "number", "nullable": True})
+        self.assertEqual(properties["stack"], {"type": "object", "properties": {"frontend": {"type": "string"}}})
+        # Free-form objects can't be described in Gemini's schema subset
+        self.assertNotIn("extra", properties)
+        self.assertNotIn("title", json.dumps(schema))